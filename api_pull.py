@@ -1,15 +1,32 @@
 from datetime import datetime
-import time
+import argparse
+import asyncio
+import itertools
+import json
 from bson import ObjectId
 from pymongo import MongoClient
 import requests
 
+from src.transcript_fetcher import (CACHE_SOURCE, fetch_and_store_transcripts, parse_transcript_payload,
+                                    rebuild_from_cache, transcript_url)
+from src.transcript_planner import get_present_keys, get_recent_misses, plan_missing
+from src.universe import UNIVERSES, load_universe
 from src.utils.mongo_utils import connect_mongo, insert_data_into_collection
+from src.utils.transcript_cache import TranscriptCache
+
+transcript_cache = TranscriptCache()
 
 
 def fetch_transcript(ticker, quarter, year):
+    # Serve from the local cache before touching the network
+    cached = transcript_cache.get(CACHE_SOURCE, ticker, quarter, year)
+    if cached is not None:
+        return json.loads(cached)
+    if transcript_cache.offline:
+        return "Failed to fetch data: not cached"
+
     # Construct the URL based on the function parameters
-    url = f"https://discountingcashflows.com/api/transcript/{ticker}/{quarter}/{year}/"
+    url = transcript_url(ticker, quarter, year)
 
     # Make the HTTP GET request
     response = requests.get(url)
@@ -19,6 +36,10 @@ def fetch_transcript(ticker, quarter, year):
         # Extract the 'content' field from the JSON response
         # Parse the JSON response
         data = response.json()
+        entries, error = parse_transcript_payload(data)
+        if entries and error is None:
+            transcript_cache.put(CACHE_SOURCE, ticker, quarter,
+                                 year, response.content, url)
 
         # Check if 'content' is in the response and split it into lines
         if 'content' in data:
@@ -87,19 +108,55 @@ quarters = ["Q1", "Q2", "Q3", "Q4"]
 # Define the range of years
 years = [2021, 2022, 2023]
 
-# Initialize MongoDB connection
-mongo_client = connect_mongo()
-
-
-def process_all_data() -> None:
-    for year in years:
-        for quarter in quarters:
-            for ticker in tickers:
-                print(f'processing {ticker}, {quarter}, {year}')
-                result = process_and_store_data(
-                    ticker, quarter, year, mongo_client)
-                print(
-                    f"Processed: {ticker}, {quarter}, {year}, Result: {result}")
 
-
-process_all_data()
+def process_all_data(
+    mongo_client: MongoClient,
+    universes: list = None,
+    years: list = years,
+    only_missing: bool = True,
+    concurrency: int = 16,
+    batch_size: int = 100,
+    use_cache: bool = True
+) -> None:
+    universe = load_universe(mongo_client, universes) if universes else tickers
+    if only_missing:
+        known = get_present_keys(mongo_client) | get_recent_misses(mongo_client)
+        keys = plan_missing(known, universe, quarters, years)
+    else:
+        keys = [(ticker, quarter, year)
+                for year, quarter, ticker in itertools.product(years, quarters, universe)]
+    stats = asyncio.run(fetch_and_store_transcripts(
+        mongo_client, keys, concurrency=concurrency, batch_size=batch_size,
+        cache=transcript_cache if use_cache else None))
+    print(
+        f"Fetched: {stats.fetched}, Empty: {stats.empty}, Failed: {stats.failed}, Stored: {stats.stored}")
+    for ticker, quarter, year, error in stats.errors:
+        print(f"Failed: {ticker}, {quarter}, {year}, Error: {error}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pull earnings call transcripts into rawTranscripts')
+    parser.add_argument('--universe', nargs='*', choices=UNIVERSES,
+                        help='Ticker universes to pull, defaults to the hard-coded ticker list')
+    parser.add_argument('--years', nargs='*', type=int, default=years)
+    parser.add_argument('--all', action='store_true',
+                        help='Request every combination instead of only missing transcripts')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Bypass the local transcript cache')
+    parser.add_argument('--from-cache', action='store_true',
+                        help='Rebuild rawTranscripts from the local cache only')
+    args = parser.parse_args()
+
+    # Initialize MongoDB connection
+    mongo_client = connect_mongo()
+    if args.from_cache:
+        rebuild_from_cache(mongo_client, transcript_cache,
+                           batch_size=args.batch_size)
+    else:
+        process_all_data(mongo_client, universes=args.universe, years=args.years,
+                         only_missing=not args.all, concurrency=args.concurrency,
+                         batch_size=args.batch_size, use_cache=not args.no_cache)
+    mongo_client.close()
@@ -0,0 +1,108 @@
+"""Recall@k of reduced-dimension and int8 embedding profiles
+
+Compares nearest-neighbour results between staging line items and
+processedTranscripts line items under each candidate profile against the
+stored full-precision vectors.
+
+    python -m benchmarks.embedding_recall --ticker NKE --k 1 5 10
+"""
+from typing import List
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from src.similarity_engine import top_k_similarity
+from src.utils.embedding_codec import encode_embedding, stack_embeddings, truncate_embeddings
+from src.utils.mongo_utils import connect_mongo
+
+
+PROFILES = [
+    ('float32-1536', None, 'float32'),
+    ('float16-1536', None, 'float16'),
+    ('int8-1536', None, 'int8'),
+    ('float32-1024', 1024, 'float32'),
+    ('float32-512', 512, 'float32'),
+    ('int8-512', 512, 'int8'),
+    ('float32-256', 256, 'float32'),
+    ('int8-256', 256, 'int8'),
+]
+
+
+def load_embeddings(client, ticker: str = None, limit: int = 5000, field: str = 'rawLineItemEmbedding') -> tuple:
+    """Loads query (staging) and target (processed) embedding matrices"""
+    db = client['transcripts']
+    query = {field: {'$exists': True}}
+    if ticker is not None:
+        query['companyName'] = ticker
+    targets = [doc[field] for doc in db['processedTranscripts'].find(
+        query, {field: 1, '_id': 0}, limit=limit)]
+
+    staging_query = {field: {'$exists': True}}
+    if ticker is not None:
+        staging_query['companyTicker'] = ticker
+    queries = [doc[field] for doc in db['stagingLineItems'].find(
+        staging_query, {field: 1, '_id': 0}, limit=limit)]
+    return stack_embeddings(queries), stack_embeddings(targets)
+
+
+def apply_profile(matrix: np.ndarray, dimensions: int, dtype: str) -> np.ndarray:
+    """Round-trips full vectors through a profile's truncation and storage dtype"""
+    matrix = truncate_embeddings(matrix, dimensions)
+    if dtype == 'float32':
+        return matrix
+    return stack_embeddings([encode_embedding(row, dtype) for row in matrix])
+
+
+def recall_at_k(baseline: np.ndarray, candidate: np.ndarray, k: int) -> float:
+    hits = [len(set(b[:k]) & set(c[:k])) for b, c in zip(baseline, candidate)]
+    return float(np.mean(hits) / k)
+
+
+def run(queries: np.ndarray, targets: np.ndarray, ks: List[int], threshold: float) -> List[dict]:
+    max_k = max(ks)
+    baseline_idx, baseline_scores = top_k_similarity(queries, targets, max_k)
+    baseline_matched = baseline_scores[:, 0] >= threshold
+    results = []
+    for name, dimensions, dtype in PROFILES:
+        profiled_queries = apply_profile(queries, dimensions, dtype)
+        profiled_targets = apply_profile(targets, dimensions, dtype)
+        start = time.perf_counter()
+        idx, scores = top_k_similarity(profiled_queries, profiled_targets, max_k)
+        elapsed = time.perf_counter() - start
+        matched = scores[:, 0] >= threshold
+        dim = profiled_targets.shape[1]
+        results.append({
+            'profile': name,
+            'bytesPerVector': 16 + dim * np.dtype(dtype).itemsize,
+            **{f'recall@{k}': recall_at_k(baseline_idx, idx, k) for k in ks},
+            'top1Agreement': float(np.mean(idx[:, 0] == baseline_idx[:, 0])),
+            'matchAgreement': float(np.mean(matched == baseline_matched)),
+            'searchSeconds': elapsed,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ticker')
+    parser.add_argument('--limit', type=int, default=5000)
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--threshold', type=float, default=0.98)
+    parser.add_argument('--output', help='Write results as JSON to this path')
+    args = parser.parse_args()
+
+    mongo_client = connect_mongo()
+    queries, targets = load_embeddings(mongo_client, args.ticker, args.limit)
+    mongo_client.close()
+    print(f'{len(queries)} staging line items against {len(targets)} processed line items')
+
+    results = run(queries, targets, args.k, args.threshold)
+    for result in results:
+        print(' '.join(f'{key}={value:.4f}' if isinstance(value, float) else f'{key}={value}'
+                       for key, value in result.items()))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
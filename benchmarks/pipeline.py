@@ -0,0 +1,249 @@
+"""Throughput benchmarks for the transcript pipeline
+
+Times the CPU stages on synthetic transcripts of several sizes and the
+full process_transcript against the local mock OpenAI server, reporting
+p50/p99 latency, transcripts per minute, peak traced memory and OpenAI
+calls per transcript. Results are written as JSON and can be compared to
+an earlier run to catch regressions.
+
+    python -m benchmarks.pipeline --sizes small medium --repeat 5
+    python -m benchmarks.pipeline --baseline benchmarks/results/2024-03-01_12-00-00.json
+
+process_transcript runs against mongomock when it is installed, or the
+database given with --mongo-uri.
+"""
+from typing import Callable, Dict, List
+
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+from bson import ObjectId
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+SIZES = {
+    'small': 20,
+    'medium': 80,
+    'large': 250,
+}
+METRICS = ['Revenue', 'Gross Margin', 'Operating Income', 'Earnings Per Share',
+           'Free Cash Flow', 'Net Income', 'Operating Margin', 'Capital Expenditures']
+FILLER = [
+    'We continued to execute well across our businesses.',
+    'Our teams remain focused on the customer.',
+    'Let me turn to the details of the quarter.',
+    'We are pleased with the momentum we are seeing.',
+    'Thanks for the question.',
+]
+
+
+def synthetic_transcript(paragraphs: int, seed: int = 0, ticker: str = 'BNCH') -> Dict:
+    """Builds a rawTranscripts-shaped document with metric-bearing paragraphs
+
+    Args:
+        paragraphs (int): Number of speaker turns
+        seed (int, optional): Random seed. Defaults to 0.
+        ticker (str, optional): Company ticker. Defaults to 'BNCH'.
+
+    Returns:
+        Dict: Raw transcript document
+    """
+    rng = random.Random(seed)
+    transcript = []
+    for i in range(paragraphs):
+        sentences = rng.sample(FILLER, 2)
+        for _ in range(rng.randint(0, 3)):
+            metric = rng.choice(METRICS)
+            if rng.random() < 0.5:
+                sentences.append(f'{metric} grew {rng.randint(1, 30)}% year over year.')
+            else:
+                sentences.append(
+                    f'We expect {metric.lower()} of ${rng.randint(1, 900)} million next quarter.')
+        rng.shuffle(sentences)
+        transcript.append({
+            'speaker': 'Analyst' if i % 4 == 3 else 'Chief Financial Officer',
+            'text': ' '.join(sentences),
+        })
+    return {
+        '_id': ObjectId(),
+        'companyName': ticker,
+        'companyTicker': ticker,
+        'fiscalYear': 2023,
+        'fiscalQuarter': 2,
+        'transcript': transcript,
+    }
+
+
+def summarize(name: str, durations: List[float], peak_bytes: int, items: int = 1, **extra) -> Dict:
+    """Latency percentiles and throughput of repeated runs"""
+    durations = np.array(durations)
+    return {
+        'stage': name,
+        'runs': len(durations),
+        'p50_ms': float(np.percentile(durations, 50) * 1000),
+        'p99_ms': float(np.percentile(durations, 99) * 1000),
+        'mean_ms': float(durations.mean() * 1000),
+        'items_per_minute': float(items * 60 / durations.mean()) if durations.mean() > 0 else None,
+        'peak_mb': peak_bytes / (1024 * 1024),
+        **extra,
+    }
+
+
+def measure(func: Callable, repeat: int) -> tuple:
+    """Runs func repeat times, returning durations and the peak traced allocation"""
+    durations = []
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return durations, peak
+
+
+def bench_cpu_stages(size: str, repeat: int) -> List[Dict]:
+    from functions import process_transcript_list
+    from run_transcript import metrics_parser, split_transcript
+    from src.matching_framework import calculate_similarity
+
+    doc = synthetic_transcript(SIZES[size])
+    lines = [line['text'] for line in doc['transcript']]
+    qa_response = ('rawPeriod: Q2Y2023 rawLow: 12 rawHigh: 15 rawUnit: percentage '
+                   'rawScale: none metricType: guidance')
+    rng = np.random.default_rng(0)
+    n_items = SIZES[size] * 2
+    processed = rng.standard_normal((n_items, 1536)).astype(np.float32)
+    staging = rng.standard_normal((n_items, 1536)).astype(np.float32)
+
+    stages = [
+        ('split_transcript', lambda: split_transcript(doc), 1),
+        ('metrics_parser', lambda: [metrics_parser(qa_response) for _ in range(100)], 100),
+        ('process_transcript_list', lambda: process_transcript_list(lines, 1000), 1),
+        ('calculate_similarity', lambda: calculate_similarity(processed, staging), 1),
+    ]
+    results = []
+    for name, func, items in stages:
+        durations, peak = measure(func, repeat)
+        results.append(summarize(name, durations, peak, items, size=size))
+    return results
+
+
+def start_mock_server(port: int):
+    """Runs src.mock_openai in a background thread and points the OpenAI SDK at it"""
+    import uvicorn
+    from src.mock_openai import create_app
+
+    app = create_app(seed=0)
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    server.install_signal_handlers = lambda: None
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{port}/v1'
+    os.environ.setdefault('OPENAI_API_KEY', 'mock')
+    return app, server
+
+
+def get_mongo_client(mongo_uri: str = None):
+    if mongo_uri:
+        from src.utils.mongo_utils import connect_mongo
+
+        return connect_mongo(mongo_uri)
+    if importlib.util.find_spec('mongomock') is None:
+        raise RuntimeError('install mongomock or pass --mongo-uri to benchmark process_transcript')
+    import mongomock
+
+    return mongomock.MongoClient()
+
+
+def bench_process_transcript(size: str, repeat: int, mock_app, mongo_client) -> Dict:
+    from run_transcript import process_transcript
+    from src.line_item_store import COLLECTION, DB_NAME
+
+    durations = []
+    calls = []
+    line_items = []
+    tracemalloc.start()
+    for i in range(repeat):
+        doc = synthetic_transcript(SIZES[size], seed=i)
+        before = dict(mock_app.state.stats)
+        start = time.perf_counter()
+        staging_id = asyncio.run(process_transcript(mongo_client, doc))
+        durations.append(time.perf_counter() - start)
+        after = mock_app.state.stats
+        calls.append((after['chat'] - before['chat']) + (after['embeddings'] - before['embeddings']))
+        line_items.append(mongo_client[DB_NAME][COLLECTION].count_documents(
+            {'stagingId': staging_id}))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize('process_transcript', durations, peak, 1, size=size,
+                     calls_per_transcript=float(np.mean(calls)),
+                     line_items_per_transcript=float(np.mean(line_items)))
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Lists stages whose p50 regressed by more than tolerance against the baseline"""
+    previous = {(row['stage'], row.get('size')): row for row in baseline}
+    regressions = []
+    for row in results:
+        old = previous.get((row['stage'], row.get('size')))
+        if old is None or not old['p50_ms']:
+            continue
+        change = row['p50_ms'] / old['p50_ms'] - 1
+        print(f"{row['stage']:<26} {row.get('size', ''):<8} p50 {old['p50_ms']:.2f} -> {row['p50_ms']:.2f} ms "
+              f"({change:+.1%})")
+        if change > tolerance:
+            regressions.append(f"{row['stage']} ({row.get('size')}) p50 {change:+.1%}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--skip-e2e', action='store_true', help='Only run the CPU stages')
+    parser.add_argument('--mongo-uri', help='Database for process_transcript, defaults to mongomock')
+    parser.add_argument('--mock-port', type=int, default=8101)
+    parser.add_argument('--output', help='Results path, defaults to benchmarks/results/<timestamp>.json')
+    parser.add_argument('--baseline', help='Earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed p50 slowdown against the baseline. Defaults to 0.1.')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results += bench_cpu_stages(size, args.repeat)
+    if not args.skip_e2e:
+        mock_app, _ = start_mock_server(args.mock_port)
+        mongo_client = get_mongo_client(args.mongo_uri)
+        for size in args.sizes:
+            results.append(bench_process_transcript(size, args.repeat, mock_app, mongo_client))
+
+    for row in results:
+        print(' '.join(f'{key}={value:.2f}' if isinstance(value, float) else f'{key}={value}'
+                       for key, value in row.items()))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f'{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({'createdAt': datetime.datetime.now().isoformat(), 'results': results}, file, indent=2)
+    print(f'Results written to {output}')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.tolerance)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+            sys.exit(1)
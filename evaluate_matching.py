@@ -0,0 +1,160 @@
+"""Scores staging sessions against golden processedTranscripts in parallel
+
+Pairs are read from a CSV with ticker,quarter,year,session columns or
+given inline as --pair TICKER QUARTER YEAR SESSION:
+
+    python evaluate_matching.py --pairs golden.csv --workers 8 --output-dir eval
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dotenv import find_dotenv, load_dotenv
+from typing import Dict, List, Tuple
+
+import argparse
+import datetime
+import os
+
+import pandas as pd
+
+from src.matching_framework import evaluate_comparison, load_comparison_data
+from src.utils.mongo_utils import connect_mongo
+
+
+load_dotenv(dotenv_path=find_dotenv(), override=True)
+
+FIELD_COLUMNS = ['matchedLow', 'matchedHigh', 'matchedUnit',
+                 'matchedScale', 'matchedPeriod', 'matchedMetricType']
+
+_worker_client = None
+
+
+def _init_worker() -> None:
+    # MongoClient is not fork-safe, every worker process opens its own
+    global _worker_client
+    _worker_client = connect_mongo()
+
+
+def evaluate_pair(pair: Tuple[str, int, int, str], similarity_threshold: float, mode: str) -> Tuple[Dict, pd.DataFrame]:
+    """Matches one staging session against its golden transcript
+
+    Returns:
+        Tuple[Dict, pd.DataFrame]: Summary metrics and per-row comparisons
+    """
+    ticker, quarter, year, session = pair
+    key = {'ticker': ticker, 'quarter': int(quarter), 'year': int(year), 'session': session}
+    processed_doc, staging_doc = load_comparison_data(
+        _worker_client, ticker, quarter, year, session)
+    if len(processed_doc) == 0 or len(staging_doc) == 0:
+        return {**key, 'error': 'no comparison data'}, pd.DataFrame()
+
+    matches_df, misses_df, points_of_interest_df = evaluate_comparison(
+        processed_doc, staging_doc, similarity_threshold=similarity_threshold, mode=mode)
+
+    n_processed, n_staging = len(processed_doc), len(staging_doc)
+    summary = {
+        **key,
+        'error': None,
+        'processedLineItems': n_processed,
+        'stagingLineItems': n_staging,
+        'matches': len(matches_df),
+        # golden line items found by the pipeline / pipeline line items that are golden
+        'recall': (n_processed - len(misses_df)) / n_processed,
+        'precision': (n_staging - len(points_of_interest_df)) / n_staging,
+    }
+    for column in FIELD_COLUMNS:
+        summary[f'{column}Accuracy'] = float(
+            matches_df[column].mean()) if len(matches_df) else None
+
+    rows = matches_df.assign(**key)
+    return summary, rows
+
+
+def run_evaluation(pairs: List[Tuple], workers: int, similarity_threshold: float, mode: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    summaries = []
+    row_frames = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = {executor.submit(evaluate_pair, pair, similarity_threshold, mode): pair
+                   for pair in pairs}
+        for future in as_completed(futures):
+            pair = futures[future]
+            try:
+                summary, rows = future.result()
+            except Exception as exc:
+                summary, rows = {'ticker': pair[0], 'quarter': pair[1], 'year': pair[2],
+                                 'session': pair[3], 'error': str(exc)}, pd.DataFrame()
+            print(f"{pair}: {summary.get('error') or 'precision %.3f recall %.3f' % (summary['precision'], summary['recall'])}")
+            summaries.append(summary)
+            row_frames.append(rows)
+    summary_df = pd.DataFrame(summaries)
+    rows_df = pd.concat(row_frames, ignore_index=True) if row_frames else pd.DataFrame()
+    return summary_df, rows_df
+
+
+def aggregate(summary_df: pd.DataFrame) -> pd.DataFrame:
+    """Micro-averaged precision/recall and mean field accuracy over all pairs"""
+    scored = summary_df[summary_df['error'].isna()] if 'error' in summary_df else summary_df
+    if len(scored) == 0:
+        return pd.DataFrame()
+    totals = {
+        'pairs': len(scored),
+        'failedPairs': len(summary_df) - len(scored),
+        'precision': (scored['precision'] * scored['stagingLineItems']).sum() / scored['stagingLineItems'].sum(),
+        'recall': (scored['recall'] * scored['processedLineItems']).sum() / scored['processedLineItems'].sum(),
+    }
+    for column in FIELD_COLUMNS:
+        weights = scored['matches'].where(scored[f'{column}Accuracy'].notna(), 0)
+        totals[f'{column}Accuracy'] = (scored[f'{column}Accuracy'].fillna(0) * weights).sum() / weights.sum() \
+            if weights.sum() else None
+    return pd.DataFrame([totals])
+
+
+def write_excel(path: str, sheets: Dict[str, pd.DataFrame]) -> None:
+    # write_only workbooks stream rows to disk instead of holding every cell
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    for name, df in sheets.items():
+        sheet = workbook.create_sheet(title=name)
+        sheet.append(list(df.columns))
+        for row in df.itertuples(index=False):
+            sheet.append([None if pd.isna(value) else value if isinstance(value, (int, float, str, bool))
+                          else str(value) for value in row])
+    workbook.save(path)
+
+
+def read_pairs(path: str) -> List[Tuple]:
+    df = pd.read_csv(path)
+    return list(df[['ticker', 'quarter', 'year', 'session']].itertuples(index=False, name=None))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pairs', help='CSV with ticker,quarter,year,session columns')
+    parser.add_argument('--pair', nargs=4, action='append', default=[],
+                        metavar=('TICKER', 'QUARTER', 'YEAR', 'SESSION'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threshold', type=float, default=0.98)
+    parser.add_argument('--mode', choices=['best', 'mutual', 'one_to_one'], default='best')
+    parser.add_argument('--output-dir', default='evaluation')
+    parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet')
+    parser.add_argument('--excel', action='store_true', help='Also write an Excel workbook')
+    args = parser.parse_args()
+
+    pairs = (read_pairs(args.pairs) if args.pairs else []) + [tuple(pair) for pair in args.pair]
+    if not pairs:
+        parser.error('no pairs given, use --pairs or --pair')
+
+    summary_df, rows_df = run_evaluation(pairs, args.workers, args.threshold, args.mode)
+    aggregate_df = aggregate(summary_df)
+    print(aggregate_df.to_string(index=False))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    outputs = {'aggregate': aggregate_df, 'pairs': summary_df, 'rows': rows_df}
+    for name, df in outputs.items():
+        path = os.path.join(args.output_dir, f'{name}_{stamp}.{args.format}')
+        if args.format == 'parquet':
+            df.to_parquet(path, index=False)
+        else:
+            df.to_csv(path, index=False)
+    if args.excel:
+        write_excel(os.path.join(args.output_dir, f'evaluation_{stamp}.xlsx'), outputs)
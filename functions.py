@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import tiktoken
 import json
 import datetime
@@ -54,6 +56,24 @@ def read_json_prompt(json_prompt, updates):
     return messages
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Gets the tokenizer of a model, resolved once per model.
+
+    Args:
+        model (str): The name or version ID of the model.
+
+    Returns:
+        tiktoken.Encoding: The model's encoding, cl100k_base for unknown models.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        print("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
 def count_tokens(model: str, text: str) -> None:
     """
     Counts the number of tokens in the given text using the specified model.
@@ -65,7 +85,7 @@ def count_tokens(model: str, text: str) -> None:
     Returns:
         None
     """
-    enc = tiktoken.encoding_for_model(model)
+    enc = get_encoding(model)
     tokens = enc.encode(text)
     print(len(tokens))
 
@@ -81,11 +101,7 @@ def num_tokens_from_messages(messages: list, model: str = "gpt-3.5-turbo-0613")
     Returns:
         int: The total number of tokens used by the messages.
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model)
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
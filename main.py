@@ -1,8 +1,6 @@
 from fastapi import FastAPI
 from run_transcript import run_transcript_processor
 
-import asyncio
-
 
 app = FastAPI()
 
@@ -10,9 +8,17 @@ app = FastAPI()
 async def run_transcript(
     ticker: str,
     fiscal_year: int,
-    fiscal_quarter: str
+    fiscal_quarter: str,
+    dry_run: bool = False
 ):
-    asyncio.run(run_transcript_processor(ticker, fiscal_year, fiscal_quarter))
+    result = await run_transcript_processor(ticker, fiscal_year, fiscal_quarter, dry_run=dry_run)
+    if dry_run:
+        return {
+            "Ticker": ticker,
+            "FiscalYear": fiscal_year,
+            "FiscalQuarter": fiscal_quarter,
+            "Estimate": result.to_dict()
+        }
     return {
         "Ticker": ticker,
         "FiscalYear": fiscal_year,
@@ -0,0 +1,223 @@
+"""Processes many transcripts across a process pool under one rate limit
+
+Each worker process runs its own event loop with up to --concurrency
+transcripts in flight, taking keys from one shared queue. All workers draw from a single RPM/TPM limiter and
+a single spend budget held in shared memory, so adding processes uses more
+cores without collectively exceeding the OpenAI quota.
+
+    python run_batch.py --universe sp500 --year 2023 --quarter 2 --workers 8 --rpm 5000 --tpm 600000
+    python run_batch.py --ticker IBM MSFT --year 2022 --quarter 3 4 --budget 50
+    python run_batch.py --universe sp500 --year 2023 --quarter 2 --workers 8 --budget 500 --dry-run
+"""
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import find_dotenv, load_dotenv
+from typing import Dict, List, Tuple
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import time
+
+from run_transcript import process_transcript
+from src.utils.costs import BudgetExceededError, CostBudget, set_default_budget
+from src.utils.mongo_utils import connect_mongo, get_data_from_collection
+from src.utils.rate_limiter import SharedRateLimiter, set_rate_limiter
+
+
+load_dotenv(dotenv_path=find_dotenv(), override=True)
+
+_worker_client = None
+
+
+def _init_worker(rate_limiter: SharedRateLimiter, budget: CostBudget) -> None:
+    # MongoClient is not fork-safe, every worker process opens its own
+    global _worker_client
+    _worker_client = connect_mongo()
+    set_rate_limiter(rate_limiter)
+    set_default_budget(budget)
+
+
+async def _process_key(key: Tuple[str, int, int]) -> Dict:
+    ticker, year, quarter = key
+    result = {'ticker': ticker, 'year': year, 'quarter': quarter, 'stagingId': None, 'error': None}
+    start = time.monotonic()
+    documents = get_data_from_collection(
+        _worker_client,
+        'transcripts',
+        'rawTranscripts',
+        projection={},
+        query={'companyTicker': ticker, 'fiscalYear': year, 'fiscalQuarter': quarter},
+        limit=1
+    )
+    if not documents:
+        result['error'] = 'raw transcript not found'
+        return result
+    try:
+        result['stagingId'] = str(await process_transcript(_worker_client, documents[0]))
+    except BudgetExceededError as exc:
+        result['error'] = str(exc)
+        result['budgetExceeded'] = True
+    except Exception as exc:
+        result['error'] = f'{type(exc).__name__}: {exc}'
+    result['seconds'] = time.monotonic() - start
+    return result
+
+
+def process_queue(key_queue, result_queue, concurrency: int) -> int:
+    """Runs process_transcript for keys taken from key_queue until it yields None
+
+    The worker keeps one event loop with concurrency consumers, so a slow
+    transcript holds a single slot while the others keep taking keys.
+
+    Returns:
+        int: Number of keys processed by this worker
+    """
+    async def consume() -> int:
+        loop = asyncio.get_running_loop()
+        processed = 0
+        while True:
+            key = await loop.run_in_executor(None, key_queue.get)
+            if key is None:
+                return processed
+            result_queue.put(await _process_key(key))
+            processed += 1
+
+    async def run() -> int:
+        return sum(await asyncio.gather(*[consume() for _ in range(concurrency)]))
+    return asyncio.run(run())
+
+
+def _stop_consumers(key_queue, consumers: int) -> None:
+    # drop the keys nobody took yet, then let every consumer exit
+    while True:
+        try:
+            key_queue.get_nowait()
+        except queue.Empty:
+            break
+    for _ in range(consumers):
+        key_queue.put(None)
+
+
+def run_batch(
+    keys: List[Tuple[str, int, int]],
+    workers: int,
+    concurrency: int,
+    rate_limiter: SharedRateLimiter = None,
+    budget: CostBudget = None,
+    context=None
+) -> List[Dict]:
+    """Processes transcripts across a process pool
+
+    Keys are fed to the workers through one shared queue, so each worker
+    takes a new transcript as soon as one of its slots frees up.
+
+    Args:
+        keys (List[Tuple[str, int, int]]): (ticker, fiscal year, fiscal quarter) of each transcript
+        workers (int): Worker processes
+        concurrency (int): Transcripts in flight per worker
+        rate_limiter (SharedRateLimiter, optional): Limiter shared by all workers. Defaults to None.
+        budget (CostBudget, optional): Spend limit shared by all workers. Defaults to None.
+        context (optional): multiprocessing context the limiter and budget were created with. Defaults to spawn.
+
+    Returns:
+        List[Dict]: One result per key with stagingId or error
+    """
+    context = context or multiprocessing.get_context('spawn')
+    consumers = workers * concurrency
+    results = []
+    cancelled = False
+    start = time.monotonic()
+    manager = context.Manager()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                   initializer=_init_worker, initargs=(rate_limiter, budget))
+    try:
+        key_queue, result_queue = manager.Queue(), manager.Queue()
+        for key in keys:
+            key_queue.put(key)
+        for _ in range(consumers):
+            key_queue.put(None)
+        futures = [executor.submit(process_queue, key_queue, result_queue, concurrency)
+                   for _ in range(workers)]
+        while len(results) < len(keys):
+            try:
+                result = result_queue.get(timeout=1)
+            except queue.Empty:
+                if all(future.done() for future in futures) and result_queue.empty():
+                    break
+                continue
+            print(f"{result['ticker']} Q{result['quarter']} {result['year']}: "
+                  f"{result['error'] or result['stagingId']}")
+            results.append(result)
+            if result.get('budgetExceeded') and not cancelled:
+                print('Budget exceeded, cancelling remaining transcripts')
+                _stop_consumers(key_queue, consumers)
+                cancelled = True
+        for future in futures:
+            if future.exception() is not None:
+                print(f'Worker failed: {future.exception()}')
+    finally:
+        executor.shutdown(wait=True)
+        manager.shutdown()
+
+    processed = {(result['ticker'], result['year'], result['quarter']) for result in results}
+    results += [{'ticker': ticker, 'year': year, 'quarter': quarter, 'stagingId': None,
+                 'error': 'cancelled' if cancelled else 'not processed'}
+                for ticker, year, quarter in keys if (ticker, year, quarter) not in processed]
+
+    elapsed = time.monotonic() - start
+    done = sum(result['error'] is None for result in results)
+    print(f'{done} of {len(keys)} transcripts processed in {elapsed / 60:.1f} min '
+          f'({done * 60 / elapsed if elapsed else 0:.1f}/min)')
+    if rate_limiter is not None:
+        print(f'Waited {rate_limiter.waited:.0f}s on the rate limiter across workers')
+    if budget is not None:
+        print(f'Spent ${budget.spent:.2f} of ${budget.limit:.2f} over {budget.calls} calls')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ticker', nargs='+', help='Tickers to process')
+    parser.add_argument('--universe', help='Process every ticker of a universe, ex: sp500')
+    parser.add_argument('--year', type=int, required=True)
+    parser.add_argument('--quarter', type=int, nargs='+', required=True)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--concurrency', type=int, default=4, help='Transcripts in flight per worker')
+    parser.add_argument('--rpm', type=float, default=os.getenv('OPENAI_RPM'), help='Requests per minute, all workers')
+    parser.add_argument('--tpm', type=float, default=os.getenv('OPENAI_TPM'), help='Tokens per minute, all workers')
+    parser.add_argument('--budget', type=float, default=os.getenv('OPENAI_BUDGET_USD'), help='USD limit, all workers')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the preflight estimate of calls, tokens and cost, then exit')
+    parser.add_argument('--traces', help='Trace file the dry run reads stage latencies from')
+    args = parser.parse_args()
+
+    tickers = list(args.ticker or [])
+    if args.universe:
+        from src.universe import load_universe
+
+        mongo_client = connect_mongo()
+        tickers += load_universe(mongo_client, [args.universe])
+        mongo_client.close()
+    if not tickers:
+        parser.error('pass --ticker or --universe')
+    batch_keys = [(ticker, args.year, quarter) for ticker in tickers for quarter in args.quarter]
+
+    if args.dry_run:
+        from src.preflight import PlanAssumptions, plan_batch, print_plan
+
+        mongo_client = connect_mongo()
+        plan_assumptions = PlanAssumptions.from_traces(args.traces) if args.traces else PlanAssumptions()
+        print_plan(plan_batch(mongo_client, batch_keys, plan_assumptions),
+                   args.workers * args.concurrency, float(args.budget) if args.budget else None)
+        mongo_client.close()
+        raise SystemExit(0)
+
+    spawn_context = multiprocessing.get_context('spawn')
+    shared_limiter = None
+    if args.rpm or args.tpm:
+        shared_limiter = SharedRateLimiter(args.rpm or float('inf'), args.tpm or float('inf'),
+                                           context=spawn_context)
+    shared_budget = CostBudget(args.budget, context=spawn_context) if args.budget else None
+    run_batch(batch_keys, args.workers, args.concurrency, shared_limiter, shared_budget, spawn_context)
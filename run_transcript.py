@@ -1,8 +1,14 @@
 from dotenv import find_dotenv, load_dotenv
 from langchain.text_splitter import CharacterTextSplitter
+from src.excerpt_store import build_excerpt, store_excerpts
+from src.line_item_store import store_line_items, summarize_line_items
+from src.metric_index import MetricIndex
 from src.prompts import ChatGPTSession, Prompt
+from src.transcript_archive import TranscriptArchive
+from src.utils.costs import BudgetExceededError, CostBudget
 from src.utils.loggers import reg_logger
 from src.utils.mongo_utils import connect_mongo, get_data_from_collection, insert_data_into_collection
+from src.utils.tracing import set_attributes, span, traced
 from typing import List, Dict
 
 import asyncio
@@ -13,6 +19,12 @@ import re
 
 logger = reg_logger('process_transcript')
 
+EXTRACTION_PROMPT_PATH = 'prompts/extraction_prompt.json'
+QA_PROMPTS_PATH = 'prompts/qa_prompts.json'
+EXTRACTION_MODEL = 'gpt-4-1106-preview'
+QA_ONE_MODEL = 'gpt-4'
+QA_TWO_MODEL = 'gpt-4-1106-preview'
+
 load_dotenv(dotenv_path=find_dotenv(), override=True)
 
 
@@ -32,6 +44,7 @@ def metrics_parser(metrics):
     return parsed_metrics
 
 
+@traced('split_transcript')
 def split_transcript(raw_transcript_doc: Dict) -> List:
     """Split transcript into chunks
 
@@ -50,22 +63,30 @@ def split_transcript(raw_transcript_doc: Dict) -> List:
     splitter = CharacterTextSplitter(
         separator=' \n ',
         chunk_size=1000,
-        chunk_overlap=100
+        chunk_overlap=100,
+        add_start_index=True
     )
     transcriptDocument = splitter.create_documents([transcript])
     return transcriptDocument
 
 
-async def process_transcript(mongo_client, raw_transcript_doc: Dict) -> None:
+@traced('process_transcript')
+async def process_transcript(mongo_client, raw_transcript_doc: Dict, budget: CostBudget = None) -> None:
     """Process raw transcript into staging
 
     Args:
         raw_transcript (Dict): Raw transcript
+        budget (CostBudget, optional): Spend limit shared across the run. Defaults to OPENAI_BUDGET_USD.
+
+    Raises:
+        BudgetExceededError: The budget ran out, nothing is stored for this transcript
     """
     companyName = raw_transcript_doc['companyName']
     companyTicker = raw_transcript_doc['companyTicker']
     Year = raw_transcript_doc['fiscalYear']
     Quarter = raw_transcript_doc['fiscalQuarter']
+    set_attributes(transcriptId=str(raw_transcript_doc['_id']), companyTicker=companyTicker,
+                   fiscalYear=Year, fiscalQuarter=Quarter)
     nextYear = Year + 1
     nextQuarter = 1 if Quarter == 4 else Quarter + 1
     QuarterYear = "Q" + str(Quarter) + "Y" + str(Year)
@@ -78,25 +99,39 @@ async def process_transcript(mongo_client, raw_transcript_doc: Dict) -> None:
 
     excerpt_count = 0
 
-    with open('prompts/extraction_prompt.json') as file:
+    with open(EXTRACTION_PROMPT_PATH) as file:
         extraction_prompt_json = json.load(file)
         extraction_prompt_json = extraction_prompt_json['extract_line_items']
 
-    with open('prompts/qa_prompts.json') as file:
+    with open(QA_PROMPTS_PATH) as file:
         qa_prompt_json = json.load(file)
         qa_prompt_json_one = qa_prompt_json['qa_one']
         qa_prompt_json_two = qa_prompt_json['qa_two']
 
     gpt_session = ChatGPTSession(
-        model='gpt-4-1106-preview',
-        termination_key='TERMINATE'
+        model=EXTRACTION_MODEL,
+        termination_key='TERMINATE',
+        budget=budget
     )
+    set_attributes(sessionId=str(gpt_session.session_id))
 
     error_positions = []
     staging_line_items = []
     tasks = []
 
-    for excerpt in split_transcript(raw_transcript_doc)[4:]:
+    excerpts = split_transcript(raw_transcript_doc)[4:]
+    excerpt_ids = []
+    excerpt_docs = []
+    for position, excerpt in enumerate(excerpts, start=1):
+        excerpt_doc = build_excerpt(
+            raw_transcript_doc['_id'], position, excerpt.page_content,
+            excerpt.metadata.get('start_index'))
+        excerpt_ids.append(excerpt_doc['_id'])
+        excerpt_docs.append(excerpt_doc)
+    with span('store_excerpts', excerpts=len(excerpt_docs)):
+        store_excerpts(mongo_client, excerpt_docs)
+
+    for excerpt, excerpt_id in zip(excerpts, excerpt_ids):
         excerpt_count += 1
         if len(excerpt.page_content) > 20:
             guidance_prompt = Prompt(
@@ -115,12 +150,14 @@ async def process_transcript(mongo_client, raw_transcript_doc: Dict) -> None:
                     'nextQuarterYear': nextQuarterYear,
                     'priorQuarterYear': priorQuarterYear
                 },
-                response_type=extraction_prompt_json['response_type']
+                response_type=extraction_prompt_json['response_type'],
+                name='extract_line_items'
             )
-            response = asyncio.run(gpt_session.openai_gpt_api_call(
-                prompt=guidance_prompt,
-                model='gpt-4-1106-preview'
-            ))
+            with span('extraction', excerptId=excerpt_id, position=excerpt_count):
+                response = await gpt_session.openai_gpt_api_call(
+                    prompt=guidance_prompt,
+                    model=EXTRACTION_MODEL
+                )
             logger.debug(response)
             try:
                 line_items = response['lineItems']
@@ -137,16 +174,23 @@ async def process_transcript(mongo_client, raw_transcript_doc: Dict) -> None:
                             'metric_name': line['rawLineItem'],
                             'rawTranscriptSentence': line['rawTranscriptSourceSentence']
                         },
-                        response_type=qa_prompt_json_one['response_type']
+                        response_type=qa_prompt_json_one['response_type'],
+                        name='qa_one'
                     )
-                    response = asyncio.run(gpt_session.openai_gpt_api_call(
-                        prompt=qa_one_prompt,
-                        model='gpt-4'
-                    ))
+                    line_item_attributes = {
+                        'excerptId': excerpt_id,
+                        'lineItemPosition': len(staging_line_items),
+                        'rawLineItem': line['rawLineItem']
+                    }
+                    with span('qa_one', **line_item_attributes):
+                        response = await gpt_session.openai_gpt_api_call(
+                            prompt=qa_one_prompt,
+                            model=QA_ONE_MODEL
+                        )
                     new_line_item = response
                     logger.debug(f"{line['rawLineItem']} to {new_line_item}")
-                    embedding = asyncio.run(
-                        gpt_session.get_embedding(new_line_item))
+                    with span('embedding', **line_item_attributes):
+                        embedding = await gpt_session.get_embedding(new_line_item)
 
                     qa_two_prompt = Prompt(
                         role=qa_prompt_json_two['role'],
@@ -166,12 +210,14 @@ async def process_transcript(mongo_client, raw_transcript_doc: Dict) -> None:
                             'Year': Year,
                             'nextQuarterYear': nextQuarterYear
                         },
-                        response_type=qa_prompt_json_two['response_type']
+                        response_type=qa_prompt_json_two['response_type'],
+                        name='qa_two'
                     )
-                    response = asyncio.run(gpt_session.openai_gpt_api_call(
-                        prompt=qa_two_prompt,
-                        model='gpt-4-1106-preview'
-                    ))
+                    with span('qa_two', **line_item_attributes):
+                        response = await gpt_session.openai_gpt_api_call(
+                            prompt=qa_two_prompt,
+                            model=QA_TWO_MODEL
+                        )
                     corrected_metrics = response
                     parsed_metrics = metrics_parser(corrected_metrics)
 
@@ -183,20 +229,32 @@ async def process_transcript(mongo_client, raw_transcript_doc: Dict) -> None:
                         'rawUnit': parsed_metrics['rawUnit'],
                         'rawScale': parsed_metrics['rawScale'],
                         'metricType': parsed_metrics['metricType'],
-                        'rawTranscriptParagraph': excerpt.page_content,
+                        'excerptId': excerpt_id,
                         'rawTranscriptSourceSentence': line['rawTranscriptSourceSentence'],
                         'transcriptPosition': excerpt_count,
-                        'rawLineItemEmbedding': embedding.data[0].embedding
+                        'rawLineItemEmbedding': gpt_session.embedding_profile.encode(
+                            embedding.data[0].embedding)
                     }
                     logger.debug(
                         {k: v for k, v in staging_line_item.items() if k != 'rawLineItemEmbedding'})
                     staging_line_items.append(staging_line_item)
 
+            except BudgetExceededError:
+                raise
             except Exception as exc:
                 logger.error(exc)
                 error_positions.append((excerpt_count, exc))
                 continue
 
+    metric_index = None
+    try:
+        with span('metric_index', lineItems=len(staging_line_items)):
+            metric_index = MetricIndex(mongo_client, companyTicker)
+            metric_index.assign(staging_line_items)
+    except Exception as exc:
+        metric_index = None
+        logger.error(f"Could not assign canonical metrics: {exc}")
+
     staging_line_item_doc = {
         'companyName': companyName,
         'companyTicker': companyTicker,
@@ -204,7 +262,7 @@ async def process_transcript(mongo_client, raw_transcript_doc: Dict) -> None:
         'fiscalQuarter': Quarter,
         'rawTranscriptId': raw_transcript_doc['_id'],
         'sessionId': gpt_session.session_id,
-        'stagingLineItems': staging_line_items,
+        **summarize_line_items(staging_line_items),
         'createdAt': datetime.datetime.now().isoformat(),
         'updatedAt': datetime.datetime.now().isoformat(),
         'processingStage': 'processing'
@@ -215,16 +273,28 @@ async def process_transcript(mongo_client, raw_transcript_doc: Dict) -> None:
         'stagingTranscripts',
         **staging_line_item_doc
     )
+    set_attributes(stagingId=str(staging_id), lineItems=len(staging_line_items),
+                   errors=len(error_positions))
+    with span('store_line_items', stagingId=str(staging_id)):
+        stored = store_line_items(
+            mongo_client, staging_id, staging_line_item_doc, staging_line_items)
     logger.info(
-        f"Inserted staging line items into collection stagingTranscripts: "
+        f"Inserted {stored} staging line items for stagingTranscripts document "
         f"{staging_id}"
     )
+    if metric_index is not None:
+        # cluster counts only grow once the line items they count are stored
+        try:
+            metric_index.save()
+        except Exception as exc:
+            logger.error(f"Could not save canonical metrics: {exc}")
     if len(error_positions) > 0:
         logger.error(f"Error positions: {error_positions}")
     return staging_id
 
 
-async def async_process_excerpt(excerpt, gpt_session: ChatGPTSession, extraction_prompt_json, qa_prompt_json_one, qa_prompt_json_two, companyName, thisYear, thisQuarter, nextYear, nextQuarter, excerpt_count, error_positions, priorYearQuarter):
+@traced('excerpt')
+async def async_process_excerpt(excerpt, gpt_session: ChatGPTSession, extraction_prompt_json, qa_prompt_json_one, qa_prompt_json_two, companyName, thisYear, thisQuarter, nextYear, nextQuarter, excerpt_count, error_positions, priorYearQuarter, excerpt_id=None):
     thisQuarterYear = "Q" + str(thisQuarter) + ", Y" + str(thisYear)
     nextQuarterYear = "Q" + str(nextQuarter) + ", Y" + str(nextYear)
     staging_line_items = []
@@ -244,7 +314,8 @@ async def async_process_excerpt(excerpt, gpt_session: ChatGPTSession, extraction
                 'priorYearQuarter': priorYearQuarter,
                 'thisQuarterYear': thisQuarterYear
             },
-            response_type=extraction_prompt_json['response_type']
+            response_type=extraction_prompt_json['response_type'],
+            name='extract_line_items'
         )
         response = await gpt_session.openai_gpt_api_call(
             prompt=guidance_prompt,
@@ -268,7 +339,8 @@ async def async_process_excerpt(excerpt, gpt_session: ChatGPTSession, extraction
                     kwargs={
                         'metric_name': line['rawLineItem'],
                     },
-                    response_type=qa_prompt_json_one['response_type']
+                    response_type=qa_prompt_json_one['response_type'],
+                    name='qa_one'
                 )
                 response = await gpt_session.openai_gpt_api_call(
                     prompt=qa_one_prompt,
@@ -299,7 +371,8 @@ async def async_process_excerpt(excerpt, gpt_session: ChatGPTSession, extraction
                         'thisYear': thisYear,
                         'nextQuarterYear': nextQuarterYear
                     },
-                    response_type=qa_prompt_json_two['response_type']
+                    response_type=qa_prompt_json_two['response_type'],
+                    name='qa_two'
                 )
                 response = await gpt_session.openai_gpt_api_call(
                     prompt=qa_two_prompt,
@@ -316,10 +389,11 @@ async def async_process_excerpt(excerpt, gpt_session: ChatGPTSession, extraction
                     'rawUnit': corrected_metrics['rawUnit'],
                     'rawScale': corrected_metrics['rawScale'],
                     'metricType': corrected_metrics['metricType'],
-                    'rawTranscriptParagraph': excerpt.page_content,
+                    'excerptId': excerpt_id,
                     'rawTranscriptSourceSentence': corrected_metrics['rawTranscriptSourceSentence'],
                     'transcriptPosition': excerpt_count,
-                    'rawLineItemEmbedding': embedding.data[0].embedding
+                    'rawLineItemEmbedding': gpt_session.embedding_profile.encode(
+                        embedding.data[0].embedding)
                 }
                 logger.debug(
                     {k: v for k, v in staging_line_item.items() if k != 'rawLineItemEmbedding'})
@@ -331,17 +405,33 @@ async def async_process_excerpt(excerpt, gpt_session: ChatGPTSession, extraction
     return staging_line_items
 
 
-async def run_transcript_processor(ticker: str, fiscal_year: int, fiscal_quarter: int) -> None:
-    """Main function"""
+async def run_transcript_processor(ticker: str, fiscal_year: int, fiscal_quarter: int, archive_dir: str = None, dry_run: bool = False) -> None:
+    """Main function
+
+    Reads the raw transcript from the Parquet archive when archive_dir is
+    given, otherwise from rawTranscripts. A dry run returns the preflight
+    estimate without calling OpenAI.
+    """
     monngo_client = connect_mongo()
-    documents = get_data_from_collection(
-        monngo_client,
-        'transcripts',
-        'rawTranscripts',
-        projection={},
-        query={'companyTicker': ticker, 'fiscalYear': fiscal_year,
-               'fiscalQuarter': fiscal_quarter}
-    )
+    if archive_dir is not None:
+        documents = TranscriptArchive(archive_dir).find(
+            ticker, fiscal_year, fiscal_quarter)
+    else:
+        documents = get_data_from_collection(
+            monngo_client,
+            'transcripts',
+            'rawTranscripts',
+            projection={},
+            query={'companyTicker': ticker, 'fiscalYear': fiscal_year,
+                   'fiscalQuarter': fiscal_quarter}
+        )
+    if dry_run:
+        from src.preflight import estimate_transcript
+
+        estimate = estimate_transcript(documents[0])
+        logger.info(f'Dry run for {ticker} Q{fiscal_quarter} {fiscal_year}: {estimate.summary()}')
+        monngo_client.close()
+        return estimate
     staging_id = await process_transcript(monngo_client, documents[0])
     monngo_client.close()
     return staging_id
@@ -1,6 +1,6 @@
 import src.utils.mongo_utils as mongo_utils
+import argparse
 import logging
-import os
 
 from dotenv import load_dotenv
 
@@ -13,9 +13,12 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s: %(message)s')
 
-client = mongo_utils.connect_mongo()
+parser = argparse.ArgumentParser(description='Scrape earnings call transcripts')
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--num-transcripts', type=int, default=4)
+args = parser.parse_args()
 
-driver = scraper_functions.create_driver()
+client = mongo_utils.connect_mongo()
 
 stock_tickers = mongo_utils.get_data_from_collection(
     client=client,
@@ -25,38 +28,32 @@ stock_tickers = mongo_utils.get_data_from_collection(
     limit=100
 )
 
+# Remove leading/trailing whitespace and newline characters
+tickers = [company['_id'].strip().upper() for company in stock_tickers]
+
 earnings_calls = []
-for company in stock_tickers:
-    # Remove leading/trailing whitespace and newline characters
-    ticker = company['_id'].strip().upper()
-    transcripts = scraper_functions.scrape_ticker_transcript(
-        driver=driver,
+for ticker, transcripts in scraper_functions.scrape_tickers(
         client=client,
-        ticker=ticker,
-        num_transcripts=4)
+        tickers=tickers,
+        num_transcripts=args.num_transcripts,
+        workers=args.workers):
 
     if transcripts:
         # Create collection if it doesn't exist
         collection_name = f'transcripts_{ticker}'
 
         # Insert transcripts into collection
-        for period, transcript in transcripts.items():
-            ec_id = f'{ticker}_{period}'
-            mongo_utils.insert_data_into_collection(
-                client=client,
-                db_name=os.getenv('DB_NAME'),
-                collection_name=collection_name,
-                transcript=transcript['transcript'],
-                time_recorded=transcript['time'],
-                quarter=period,
-                d_id=ec_id
-            )
+        with mongo_utils.BulkWriter(client, scraper_functions.DB_NAME, collection_name) as writer:
+            for period, transcript in transcripts.items():
+                writer.insert({
+                    '_id': f'{ticker}_{period}',
+                    'transcript': transcript['transcript'],
+                    'time_recorded': transcript['time'],
+                    'quarter': period
+                })
 
         earnings_calls.append(collection_name)
 
-# Close the driver
-driver.quit()
-
 # Close the MongoDB connection
 client.close()
 
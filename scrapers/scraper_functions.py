@@ -1,20 +1,37 @@
 import src.utils.mongo_utils as mongo_utils
+from src.utils.loggers import BASE_DIR
+from src.utils.transcript_cache import TranscriptCache
+import importlib.util
+import json
 import logging
+import queue
 import re
 import os
 import sys
+import threading
 import time
 import requests
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from selenium.webdriver.common.by import By
 from pymongo import MongoClient
 from selenium import webdriver
+from urllib.parse import urljoin, urlparse
 
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.webdriver import WebDriver
 
 
+EXCHANGES = ['nasdaq', 'nyse', 'amex']
+EXCHANGE_CACHE_PATH = os.path.join(BASE_DIR, 'cache', 'exchanges.json')
+HOST_INTERVAL = float(os.getenv('SCRAPER_HOST_INTERVAL', '0.5'))
+DB_NAME = os.getenv('DB_NAME', 'transcripts')
+
+HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+
+
 def create_driver() -> WebDriver:
     # Configure Selenium webdriver options
     chrome_options = Options()
@@ -46,24 +63,126 @@ def load_path() -> None:
 load_path()
 
 
-def scrape_ticker_transcript(driver: WebDriver, client: MongoClient, ticker: str, num_transcripts: int) -> dict:
-    logging.info(f'Working on {ticker}')
-    quarter = ''
-    all_transcripts = {}
+class HostRateLimiter:
+    """Spaces out requests to the same host across all worker threads"""
 
-    # find which exchange this ticker is in
-    exchanges = ['nasdaq', 'nyse', 'amex']
-    for exchange in exchanges:
-        search_url = f'https://www.fool.com/quote/{exchange}/{ticker}/#quote-earnings-transcripts'
-        driver.get(search_url)
+    def __init__(self, interval: float = HOST_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slot = {}
 
-        if driver.title != '404':
-            break
+    def wait(self, url: str) -> None:
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ExchangeCache:
+    """Ticker to exchange mapping persisted between runs"""
+
+    def __init__(self, path: str = EXCHANGE_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self._exchanges = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._exchanges = {}
+
+    def get(self, ticker: str) -> str:
+        with self._lock:
+            return self._exchanges.get(ticker)
+
+    def set(self, ticker: str, exchange: str) -> None:
+        with self._lock:
+            self._exchanges[ticker] = exchange
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as file:
+                json.dump(self._exchanges, file)
+
+
+class DriverPool:
+    """Lazily created pool of headless Chrome drivers shared by worker threads"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._drivers = queue.Queue()
+        self._created = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> WebDriver:
+        with self._lock:
+            if self._drivers.empty() and len(self._created) < self.size:
+                driver = create_driver()
+                self._created.append(driver)
+                return driver
+        return self._drivers.get()
+
+    def release(self, driver: WebDriver) -> None:
+        self._drivers.put(driver)
+
+    def quit(self) -> None:
+        for driver in self._created:
+            driver.quit()
+        self._created = []
+
+
+rate_limiter = HostRateLimiter()
+exchange_cache = ExchangeCache()
+transcript_cache = TranscriptCache()
+
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+
+def http_get(url: str) -> requests.Response:
+    rate_limiter.wait(url)
+    return _session.get(url, timeout=30)
+
+
+def quote_url(exchange: str, ticker: str) -> str:
+    return f'https://www.fool.com/quote/{exchange}/{ticker}/'
+
+
+def resolve_exchange(ticker: str) -> str:
+    # exchanges only change on listing transfers, so resolve each ticker once
+    exchange = exchange_cache.get(ticker)
+    if exchange is not None:
+        return exchange
+
+    for exchange in EXCHANGES:
+        response = http_get(quote_url(exchange, ticker))
+        if response.status_code == 200:
+            exchange_cache.set(ticker, exchange)
+            return exchange
+    return None
+
+
+def list_transcript_links_http(ticker: str, exchange: str) -> list:
+    """Reads transcript links from the static quote page without a browser"""
+    response = http_get(quote_url(exchange, ticker))
+    if response.status_code != 200:
+        return []
+    soup = BeautifulSoup(response.text, HTML_PARSER,
+                         parse_only=SoupStrainer(id='earnings-transcript-container'))
+    links = []
+    for link in soup.select('.page a'):
+        title_div = link.find('div')
+        if title_div is None or link.get('href') is None:
+            continue
+        links.append((title_div.get_text(), urljoin(response.url, link['href'])))
+    return links
 
-    if driver.title == '404':
-        logging.warning(f'Could not find exchange for {ticker}')
-        logging.debug(driver.title)
-        return {}
+
+def list_transcript_links_driver(driver: WebDriver, ticker: str, exchange: str, num_transcripts: int) -> list:
+    """Reads transcript links with a browser, clicking "load more" as needed"""
+    search_url = f'{quote_url(exchange, ticker)}#quote-earnings-transcripts'
+    rate_limiter.wait(search_url)
+    driver.get(search_url)
 
     # Extract the link to the latest earnings call transcript
     try:
@@ -84,7 +203,7 @@ def scrape_ticker_transcript(driver: WebDriver, client: MongoClient, ticker: str
         logging.info("finding transcripts")
     except:
         logging.warning(f'Could not find earnings transcript for {ticker}')
-        return {}
+        return []
 
     # make sure that there arre enough transcript links available
     while len(transcripts_obtained) < num_transcripts:
@@ -100,56 +219,122 @@ def scrape_ticker_transcript(driver: WebDriver, client: MongoClient, ticker: str
             logging.info('found all transcripts required')
             break
 
-    for transcript_link in transcripts_obtained:
-
-        title_div = transcript_link.find_element(By.TAG_NAME, 'div')
-        quarter = find_quarter(str(title_div.text))
-        quarter = quarter.replace(' ', '_')
+    return [
+        (transcript_link.find_element(By.TAG_NAME, 'div').text,
+         transcript_link.get_attribute('href'))
+        for transcript_link in transcripts_obtained
+    ]
+
+
+def fetch_transcript_html(transcript_url: str, ticker: str, quarter: str) -> str:
+    # quarter is formatted like Q1_2023
+    fiscal_quarter, fiscal_year = quarter.split('_')
+    cached = transcript_cache.get('fool', ticker, fiscal_quarter, fiscal_year)
+    if cached is not None:
+        logging.info(f'{quarter} transcript served from cache')
+        return cached.decode('utf-8')
+    if transcript_cache.offline:
+        raise LookupError(f'{ticker} {quarter} transcript is not cached')
+
+    transcript_site = http_get(transcript_url)
+    if transcript_site.status_code == 200:
+        transcript_cache.put('fool', ticker, fiscal_quarter, fiscal_year,
+                             transcript_site.content, transcript_url)
+    return transcript_site.text
+
+
+def parse_transcript(transcript_html: str) -> dict:
+    # Only build the tree for the article body, the rest of the page is never read
+    transcript_soup = BeautifulSoup(
+        transcript_html, HTML_PARSER,
+        parse_only=SoupStrainer('div', class_='tailwind-article-body'))
+    transcript_div = transcript_soup.find(
+        'div', class_='tailwind-article-body')
+
+    paragraphs = []
+    first_break_found = False
+
+    datetime_recorded = ''
+
+    for tag in transcript_div.find_all(['p', 'br']):
+        if tag.name == 'br' and not first_break_found:
+            first_break_found = True
+        elif tag.name == 'p' and first_break_found:
+            paragraphs.append(tag.get_text())
+        elif tag.name == 'p' and not first_break_found and not datetime_recorded:
+            date_recorded_tag = tag.find('span', {"id": "date"})
+            time_recorded_tag = tag.find('em', {"id": "time"})
+            if date_recorded_tag and time_recorded_tag:
+                date_recorded = date_recorded_tag.get_text(strip=True)
+                time_recorded = time_recorded_tag.get_text(strip=True)
+                datetime_recorded = date_recorded + ' ' + time_recorded
+
+    return {'transcript': paragraphs, 'time': datetime_recorded}
+
+
+def scrape_ticker_transcript(driver_pool: DriverPool, client: MongoClient, ticker: str, num_transcripts: int) -> dict:
+    logging.info(f'Working on {ticker}')
+    all_transcripts = {}
 
-        # check if the earnings call is already in db
-        exists = mongo_utils.id_exists(
-            client=client,
-            db_name='transcripts',
-            collection_name=f'transcripts_{ticker}',
-            d_id=f'{ticker}_{quarter}'
-        )
+    # find which exchange this ticker is in
+    exchange = resolve_exchange(ticker)
+    if exchange is None:
+        logging.warning(f'Could not find exchange for {ticker}')
+        return {}
 
-        if exists:
-            logging.info('transcript already in DB')
+    # the first page of links is static html, only fall back to a browser to load more
+    transcript_links = list_transcript_links_http(ticker, exchange)
+    if len(transcript_links) < num_transcripts:
+        driver = driver_pool.acquire()
+        try:
+            transcript_links = list_transcript_links_driver(
+                driver, ticker, exchange, num_transcripts)
+        finally:
+            driver_pool.release(driver)
+
+    # resolve every candidate id with one query before fetching anything
+    candidates = {}
+    for title, transcript_url in transcript_links:
+        quarter = find_quarter(str(title)).replace(' ', '_')
+        candidates.setdefault(quarter, transcript_url)
+
+    existing_ids = mongo_utils.get_existing_ids(
+        client=client,
+        db_name=DB_NAME,
+        collection_name=f'transcripts_{ticker}',
+        d_ids=[f'{ticker}_{quarter}' for quarter in candidates]
+    )
+    logging.info(f'{len(existing_ids)} {ticker} transcripts already in DB')
+
+    for quarter, transcript_url in candidates.items():
+        if f'{ticker}_{quarter}' in existing_ids:
             continue
 
         logging.info(f'parsing {quarter} transcript')
-        # Wait for the page to load after clicking
-        transcript_url = transcript_link.get_attribute('href')
         logging.debug(transcript_url)
-        transcript_site = requests.get(transcript_url)
-        time.sleep(2)
-
-        # Find the transcript content within the specific div and p tags
-        transcript_soup = BeautifulSoup(transcript_site.text, 'html.parser')
-        transcript_div = transcript_soup.find(
-            'div', class_='tailwind-article-body')
-
-        paragraphs = []
-        first_break_found = False
-
-        datetime_recorded = ''
-
-        for tag in transcript_div.find_all(['p', 'br']):
-            if tag.name == 'br' and not first_break_found:
-                first_break_found = True
-            elif tag.name == 'p' and first_break_found:
-                paragraphs.append(tag.get_text())
-            elif tag.name == 'p' and not first_break_found and not datetime_recorded:
-                date_recorded_tag = tag.find('span', {"id": "date"})
-                time_recorded_tag = tag.find('em', {"id": "time"})
-                if date_recorded_tag and time_recorded_tag:
-                    date_recorded = date_recorded_tag.get_text(strip=True)
-                    time_recorded = time_recorded_tag.get_text(strip=True)
-                    datetime_recorded = date_recorded + ' ' + time_recorded
+        transcript_html = fetch_transcript_html(
+            transcript_url, ticker, quarter)
 
+        all_transcripts[quarter] = parse_transcript(transcript_html)
         logging.info(f'{quarter} transcript parsed')
-        all_transcripts[quarter] = {
-            'transcript': paragraphs, 'time': datetime_recorded}
 
     return all_transcripts
+
+
+def scrape_tickers(client: MongoClient, tickers: list, num_transcripts: int, workers: int = 4):
+    """Scrapes tickers concurrently, yielding (ticker, transcripts) as each finishes"""
+    driver_pool = DriverPool(workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(scrape_ticker_transcript, driver_pool, client, ticker, num_transcripts): ticker
+                for ticker in tickers
+            }
+            for future in as_completed(futures):
+                ticker = futures[future]
+                try:
+                    yield ticker, future.result()
+                except Exception as exc:
+                    logging.error(f'Failed to scrape {ticker}: {exc}')
+    finally:
+        driver_pool.quit()
@@ -0,0 +1,166 @@
+"""Resumable backfill of missing line item embeddings
+"""
+from typing import Dict, List, Tuple
+
+import argparse
+import asyncio
+
+from pymongo import MongoClient, UpdateOne
+
+from src.prompts import ChatGPTSession
+from src.utils.costs import BudgetExceededError
+from src.utils.loggers import reg_logger
+from src.utils.mongo_utils import connect_mongo
+
+
+logger = reg_logger('embedding_backfill')
+
+EMBEDDING_FIELD = 'rawLineItemEmbedding'
+# line item text embedded in each collection
+TEXT_FIELDS = {
+    'processedTranscripts': 'lineItem',
+    'stagingLineItems': 'rawLineItem',
+}
+
+
+def _get_checkpoint(client: MongoClient, job_id: str):
+    checkpoint = client['transcripts']['jobCheckpoints'].find_one({'_id': job_id})
+    return checkpoint['lastId'] if checkpoint else None
+
+
+def _set_checkpoint(client: MongoClient, job_id: str, last_id) -> None:
+    client['transcripts']['jobCheckpoints'].update_one(
+        {'_id': job_id}, {'$set': {'lastId': last_id}}, upsert=True)
+
+
+def _clear_checkpoint(client: MongoClient, job_id: str) -> None:
+    client['transcripts']['jobCheckpoints'].delete_one({'_id': job_id})
+
+
+async def embed_texts(
+    gpt_session: ChatGPTSession,
+    texts: List[str],
+    batch_size: int = 256,
+    concurrency: int = 4
+) -> Dict[str, object]:
+    """Embeds unique texts in concurrent batches
+
+    Args:
+        gpt_session (ChatGPTSession): Session holding the OpenAI client and embedding profile
+        texts (List[str]): Texts to embed, duplicates are embedded once
+        batch_size (int, optional): Texts per embeddings request. Defaults to 256.
+        concurrency (int, optional): Requests in flight. Defaults to 4.
+
+    Returns:
+        Dict[str, object]: Packed embedding per text, without texts the API rejected
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def embed_batch(batch: List[str]) -> List[Tuple[str, object]]:
+        async with semaphore:
+            try:
+                vectors = await gpt_session.get_embeddings(batch)
+            except BudgetExceededError:
+                raise
+            except Exception as exc:
+                if len(batch) == 1:
+                    logger.warning(f'Could not embed {batch[0]!r}: {exc}')
+                    return []
+                vectors = None
+                logger.warning(f'Embedding batch of {len(batch)} failed ({exc}), embedding one by one')
+        if vectors is None:
+            # find the texts the API rejects instead of failing the whole page
+            results = await asyncio.gather(*(embed_batch([text]) for text in batch))
+            return [pair for result in results for pair in result]
+        return [(text, gpt_session.embedding_profile.encode(vector))
+                for text, vector in zip(batch, vectors)]
+
+    batches = [unique_texts[i:i + batch_size]
+               for i in range(0, len(unique_texts), batch_size)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return {text: embedding for batch in results for text, embedding in batch}
+
+
+async def backfill_collection(
+    client: MongoClient,
+    gpt_session: ChatGPTSession,
+    collection_name: str,
+    page_size: int = 1000,
+    restart: bool = False,
+    **embed_kwargs
+) -> int:
+    """Embeds the line items of a collection that have no embedding
+
+    Progress is checkpointed by _id after every page, so an interrupted run
+    resumes where it stopped. Line items the API rejects are logged and
+    skipped so the checkpoint still advances; they are retried on the next
+    run. The checkpoint is cleared once the collection
+    is done, so the next run picks up line items added since.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        gpt_session (ChatGPTSession): Session holding the OpenAI client and embedding profile
+        collection_name (str): processedTranscripts or stagingLineItems
+        page_size (int, optional): Documents read per page. Defaults to 1000.
+        restart (bool, optional): Ignore the saved checkpoint. Defaults to False.
+        **embed_kwargs: batch_size and concurrency, see embed_texts
+
+    Returns:
+        int: Number of updated documents
+    """
+    text_field = TEXT_FIELDS[collection_name]
+    job_id = f'embeddingBackfill:{collection_name}'
+    collection = client['transcripts'][collection_name]
+    last_id = None if restart else _get_checkpoint(client, job_id)
+    updated = 0
+    skipped = 0
+    while True:
+        # blank texts are rejected by the embeddings API
+        query = {EMBEDDING_FIELD: {'$exists': False}, text_field: {'$type': 'string', '$regex': r'\S'}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        docs = list(collection.find(query, {text_field: 1}).sort('_id', 1).limit(page_size))
+        if not docs:
+            break
+        embeddings = await embed_texts(
+            gpt_session, [doc[text_field] for doc in docs], **embed_kwargs)
+        operations = [
+            UpdateOne({'_id': doc['_id']}, {'$set': {EMBEDDING_FIELD: embeddings[doc[text_field]]}})
+            for doc in docs if doc[text_field] in embeddings
+        ]
+        skipped += len(docs) - len(operations)
+        if operations:
+            result = collection.bulk_write(operations, ordered=False)
+            updated += result.modified_count
+        last_id = docs[-1]['_id']
+        _set_checkpoint(client, job_id, last_id)
+        logger.info(f'{collection_name}: {updated} line items embedded, {skipped} skipped')
+    _clear_checkpoint(client, job_id)
+    return updated
+
+
+async def run_backfill(collections: List[str], restart: bool = False, **embed_kwargs) -> None:
+    mongo_client = connect_mongo()
+    gpt_session = ChatGPTSession(
+        model='gpt-4-1106-preview',
+        termination_key='TERMINATE'
+    )
+    for collection_name in collections:
+        await backfill_collection(mongo_client, gpt_session, collection_name, restart=restart, **embed_kwargs)
+    mongo_client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Embed line items that are missing embeddings')
+    parser.add_argument('--collections', nargs='+',
+                        choices=list(TEXT_FIELDS), default=list(TEXT_FIELDS))
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the saved checkpoint and rescan from the start')
+    args = parser.parse_args()
+
+    asyncio.run(run_backfill(args.collections, restart=args.restart,
+                             batch_size=args.batch_size, concurrency=args.concurrency))
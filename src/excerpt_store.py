@@ -0,0 +1,170 @@
+"""Transcript excerpts stored once and referenced by line items.
+
+Every excerpt sent for extraction is written to transcriptExcerpts, line
+items keep its excerptId instead of a copy of the paragraph. Excerpt ids
+are derived from the transcript id and the text hash, so processing the
+same transcript again reuses its excerpts.
+"""
+from typing import Dict, Iterable, Iterator, List
+
+import argparse
+import hashlib
+
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+from src.utils.loggers import reg_logger
+from src.utils.mongo_utils import connect_mongo
+
+
+logger = reg_logger('excerpt_store')
+
+DB_NAME = 'transcripts'
+COLLECTION = 'transcriptExcerpts'
+PARAGRAPH_FIELD = 'rawTranscriptParagraph'
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def excerpt_id(transcript_id, text: str) -> str:
+    """Deterministic excerpt id of a text within a transcript"""
+    return hashlib.sha256(f'{transcript_id}:{text_hash(text)}'.encode('utf-8')).hexdigest()[:24]
+
+
+def create_indexes(client: MongoClient) -> None:
+    """Creates the excerpt indexes"""
+    client[DB_NAME][COLLECTION].create_index(
+        [('rawTranscriptId', ASCENDING), ('position', ASCENDING)])
+
+
+def build_excerpt(transcript_id, position: int, text: str, start: int = None) -> Dict:
+    """Builds a transcriptExcerpts document
+
+    Args:
+        transcript_id: _id of the rawTranscripts document
+        position (int): Excerpt number within the transcript
+        text (str): Excerpt text
+        start (int, optional): Character offset of the excerpt in the joined transcript. Defaults to None.
+
+    Returns:
+        Dict: Excerpt document
+    """
+    return {
+        '_id': excerpt_id(transcript_id, text),
+        'rawTranscriptId': transcript_id,
+        'position': position,
+        'text': text,
+        'startOffset': start,
+        'endOffset': None if start is None else start + len(text),
+        'hash': text_hash(text),
+    }
+
+
+def store_excerpts(client: MongoClient, excerpts: List[Dict]) -> int:
+    """Upserts excerpts, existing excerpts are left untouched
+
+    Returns:
+        int: Number of newly stored excerpts
+    """
+    if not excerpts:
+        return 0
+    operations = [UpdateOne({'_id': excerpt['_id']}, {'$setOnInsert': excerpt}, upsert=True)
+                  for excerpt in excerpts]
+    result = client[DB_NAME][COLLECTION].bulk_write(operations, ordered=False)
+    return result.upserted_count
+
+
+def get_excerpt_texts(client: MongoClient, excerpt_ids: Iterable[str]) -> Dict[str, str]:
+    """Fetches excerpt texts with a single $in query
+
+    Returns:
+        Dict[str, str]: Text per excerpt id
+    """
+    excerpt_ids = list(set(excerpt_ids))
+    if not excerpt_ids:
+        return {}
+    documents = client[DB_NAME][COLLECTION].find(
+        {'_id': {'$in': excerpt_ids}}, {'text': 1})
+    return {document['_id']: document['text'] for document in documents}
+
+
+def resolve_paragraphs(client: MongoClient, line_items: Iterable[Dict], batch_size: int = 500) -> Iterator[Dict]:
+    """Fills rawTranscriptParagraph on line items from their excerptId
+
+    Line items are resolved in batches with one excerpt query per batch.
+    Items that still carry their own paragraph are passed through as is.
+
+    Yields:
+        Dict: Line item with rawTranscriptParagraph set when its excerpt exists
+    """
+    batch = []
+
+    def flush() -> List[Dict]:
+        texts = get_excerpt_texts(
+            client, [item['excerptId'] for item in batch
+                     if item.get('excerptId') and PARAGRAPH_FIELD not in item])
+        for item in batch:
+            if PARAGRAPH_FIELD not in item and item.get('excerptId') in texts:
+                item[PARAGRAPH_FIELD] = texts[item['excerptId']]
+        return batch
+
+    for line_item in line_items:
+        batch.append(line_item)
+        if len(batch) >= batch_size:
+            yield from flush()
+            batch = []
+    if batch:
+        yield from flush()
+
+
+def migrate_line_item_paragraphs(client: MongoClient, batch_size: int = 500) -> int:
+    """Moves paragraphs copied onto stagingLineItems into transcriptExcerpts
+
+    Returns:
+        int: Number of migrated line items
+    """
+    db = client[DB_NAME]
+    migrated = 0
+    while True:
+        line_items = list(db['stagingLineItems'].find(
+            {PARAGRAPH_FIELD: {'$exists': True}},
+            {PARAGRAPH_FIELD: 1, 'stagingId': 1, 'transcriptPosition': 1}
+        ).limit(batch_size))
+        if not line_items:
+            break
+        parents = {doc['_id']: doc.get('rawTranscriptId') for doc in db['stagingTranscripts'].find(
+            {'_id': {'$in': list({item['stagingId'] for item in line_items})}},
+            {'rawTranscriptId': 1})}
+
+        excerpts = {}
+        operations = []
+        for item in line_items:
+            transcript_id = parents.get(item['stagingId'])
+            position = item.get('transcriptPosition')
+            excerpt = build_excerpt(
+                transcript_id, position if isinstance(position, int) else None, item[PARAGRAPH_FIELD])
+            excerpts[excerpt['_id']] = excerpt
+            operations.append(UpdateOne(
+                {'_id': item['_id']},
+                {'$set': {'excerptId': excerpt['_id']}, '$unset': {PARAGRAPH_FIELD: ''}}
+            ))
+        store_excerpts(client, list(excerpts.values()))
+        db['stagingLineItems'].bulk_write(operations, ordered=False)
+        migrated += len(operations)
+        logger.info(f'Moved {migrated} line item paragraphs into {COLLECTION}')
+    return migrated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Create excerpt indexes and move line item paragraphs into transcriptExcerpts')
+    parser.add_argument('command', choices=['indexes', 'migrate'])
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    mongo_client = connect_mongo()
+    create_indexes(mongo_client)
+    if args.command == 'migrate':
+        migrate_line_item_paragraphs(mongo_client, batch_size=args.batch_size)
+    mongo_client.close()
@@ -1,30 +1,44 @@
 from bson.objectid import ObjectId
 from pymongo.collection import Collection
 from dotenv import find_dotenv, load_dotenv
+from functools import lru_cache
+from openai import OpenAI
 from retry import retry
 
+import copy
 import datetime
 import json
 import openai
 import os
 import pandas as pd
 
+from src.transcript_archive import TranscriptArchive
+
 
 load_dotenv(dotenv_path=find_dotenv(), override=True)
-openai.organization = os.getenv('OPENAI_ORGANIZATION')
-openai.api_key = os.getenv('OPENAI_API_KEY')
 
-with open('prompts/guidance_prompt.json') as fp:
-    topic_json = json.load(fp)
-    list(topic_json)
+GUIDANCE_PROMPT_PATH = 'prompts/guidance_prompt.json'
+
+# base_url follows OPENAI_BASE_URL, so this also runs against src.mock_openai
+openai_client = OpenAI(
+    organization=os.getenv('OPENAI_ORGANIZATION'),
+    api_key=os.getenv('OPENAI_API_KEY'),
+    timeout=20,
+    max_retries=0
+)
+
+
+@lru_cache(maxsize=1)
+def load_topic_json() -> list:
+    with open(GUIDANCE_PROMPT_PATH) as fp:
+        return json.load(fp)
 
 
-@retry(openai.OpenAIError, tries=5, delay=1)
+@retry(openai.OpenAIError, tries=5, delay=1, backoff=2, jitter=(0, 1))
 def response_function(message: str):
-    return openai.ChatCompletion.create(
+    return openai_client.chat.completions.create(
         model="gpt-3.5-turbo",
-        messages=message,
-        request_timeout=20
+        messages=message
     )
 
 
@@ -39,6 +53,7 @@ def binary_classification(collection: Collection, doc: object, use_collection: b
     print(f"Fiscal Year: {fiscal_year}")
     print(f"Fiscal Quarter: {fiscal_quarter}")
 
+    topic_json = copy.deepcopy(load_topic_json())
     results = []
     in_qa_section = False
 
@@ -90,3 +105,21 @@ def binary_classification(collection: Collection, doc: object, use_collection: b
         df = pd.DataFrame(results, columns=["Text", "FurtherProcess", 'index'])
         df.set_index('index', inplace=True)
         return df
+
+
+def classify_archived_transcripts(archive_dir: str, ticker: str = None, fiscal_year: int = None) -> dict:
+    """Runs binary_classification over transcripts read from the Parquet archive
+
+    Args:
+        archive_dir (str): Archive root written by transcript_archive.export_raw_transcripts
+        ticker (str, optional): Company ticker. Defaults to None.
+        fiscal_year (int, optional): Fiscal year. Defaults to None.
+
+    Returns:
+        dict: Classification DataFrame per raw transcript id
+    """
+    archive = TranscriptArchive(archive_dir)
+    return {
+        str(doc['_id']): binary_classification(None, doc, use_collection=False)
+        for doc in archive.iter_transcripts(ticker=ticker, fiscal_year=fiscal_year)
+    }
@@ -0,0 +1,325 @@
+"""Durable job queue in MongoDB
+
+Jobs are documents in queue.jobs. A worker claims the highest priority
+queued job with one atomic find_one_and_update that marks it running and
+gives the worker a lease. The worker extends the lease with heartbeats
+while it runs; a job whose lease expires, because its worker died, is put
+back in the queue by requeue_expired. Failed jobs are retried with
+exponential backoff until max_attempts, after which they are dead-lettered
+with status 'dead' and kept for inspection or retry_dead.
+
+    python -m src.job_queue enqueue --universe sp500 --year 2023 --quarter 2
+    python -m src.job_queue stats
+"""
+from typing import Dict, Iterable, Optional
+
+import argparse
+import datetime
+import random
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne
+
+from src.utils.loggers import reg_logger
+from src.utils.mongo_utils import connect_mongo
+
+
+logger = reg_logger('job_queue')
+
+DB_NAME = 'queue'
+COLLECTION = 'jobs'
+STATUSES = ('queued', 'running', 'done', 'dead')
+LEASE_SECONDS = 300
+RETRY_DELAY = 60.0
+MAX_RETRY_DELAY = 3600.0
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _collection(client: MongoClient):
+    return client[DB_NAME][COLLECTION]
+
+
+def create_indexes(client: MongoClient) -> None:
+    """Creates the claim, lease expiry and de-duplication indexes"""
+    collection = _collection(client)
+    collection.create_index(
+        [('status', ASCENDING), ('priority', DESCENDING), ('availableAt', ASCENDING)])
+    collection.create_index([('status', ASCENDING), ('leaseExpiresAt', ASCENDING)])
+    collection.create_index('dedupeKey', unique=True, sparse=True)
+
+
+def transcript_job_key(ticker: str, fiscal_year: int, fiscal_quarter: int) -> str:
+    return f'run_transcript:{ticker}:{fiscal_year}:{fiscal_quarter}'
+
+
+def _new_job(job_type: str, payload: Dict, priority: int, max_attempts: int) -> Dict:
+    now = _now()
+    return {
+        'type': job_type,
+        'payload': payload,
+        'priority': priority,
+        'status': 'queued',
+        'attempts': 0,
+        'maxAttempts': max_attempts,
+        'availableAt': now,
+        'createdAt': now,
+        'updatedAt': now,
+    }
+
+
+def enqueue(
+    client: MongoClient,
+    job_type: str,
+    payload: Dict,
+    priority: int = 0,
+    max_attempts: int = 3,
+    dedupe_key: str = None
+) -> Optional[ObjectId]:
+    """Adds a job to the queue
+
+    A job with the same dedupe_key is only added once, whatever its status.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        job_type (str): Handler name, ex: run_transcript
+        payload (Dict): Handler arguments
+        priority (int, optional): Higher runs first. Defaults to 0.
+        max_attempts (int, optional): Attempts before the job is dead-lettered. Defaults to 3.
+        dedupe_key (str, optional): Unique key of the job. Defaults to None.
+
+    Returns:
+        Optional[ObjectId]: _id of the new job, None when dedupe_key was already queued
+    """
+    job = _new_job(job_type, payload, priority, max_attempts)
+    if dedupe_key is None:
+        return _collection(client).insert_one(job).inserted_id
+    # the upsert copies dedupeKey from the filter into new jobs
+    result = _collection(client).update_one(
+        {'dedupeKey': dedupe_key}, {'$setOnInsert': job}, upsert=True)
+    return result.upserted_id
+
+
+def enqueue_transcripts(
+    client: MongoClient,
+    keys: Iterable[tuple],
+    priority: int = 0,
+    max_attempts: int = 3
+) -> int:
+    """Queues run_transcript jobs for (ticker, fiscal year, fiscal quarter) keys in one bulk write
+
+    Returns:
+        int: Number of jobs that were not queued already
+    """
+    operations = [
+        UpdateOne(
+            {'dedupeKey': transcript_job_key(ticker, fiscal_year, fiscal_quarter)},
+            {'$setOnInsert': _new_job(
+                'run_transcript',
+                {'ticker': ticker, 'fiscalYear': fiscal_year, 'fiscalQuarter': fiscal_quarter},
+                priority, max_attempts)},
+            upsert=True
+        )
+        for ticker, fiscal_year, fiscal_quarter in keys
+    ]
+    if not operations:
+        return 0
+    result = _collection(client).bulk_write(operations, ordered=False)
+    logger.info(f'Queued {result.upserted_count} of {len(operations)} transcript jobs')
+    return result.upserted_count
+
+
+def claim(
+    client: MongoClient,
+    worker_id: str,
+    job_types: Iterable[str] = None,
+    lease_seconds: float = LEASE_SECONDS
+) -> Optional[Dict]:
+    """Atomically leases the highest priority job that is due
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        worker_id (str): Lease owner
+        job_types (Iterable[str], optional): Job types the worker handles. Defaults to all.
+        lease_seconds (float, optional): Lease length. Defaults to LEASE_SECONDS.
+
+    Returns:
+        Optional[Dict]: The claimed job, None when nothing is due
+    """
+    now = _now()
+    query = {'status': 'queued', 'availableAt': {'$lte': now}}
+    if job_types is not None:
+        query['type'] = {'$in': list(job_types)}
+    return _collection(client).find_one_and_update(
+        query,
+        {
+            '$set': {
+                'status': 'running',
+                'leaseOwner': worker_id,
+                'leaseExpiresAt': now + datetime.timedelta(seconds=lease_seconds),
+                'startedAt': now,
+                'updatedAt': now,
+            },
+            '$inc': {'attempts': 1},
+        },
+        sort=[('priority', DESCENDING), ('availableAt', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def _owned(job_id: ObjectId, worker_id: str) -> Dict:
+    return {'_id': job_id, 'status': 'running', 'leaseOwner': worker_id}
+
+
+def heartbeat(client: MongoClient, job_id: ObjectId, worker_id: str,
+              lease_seconds: float = LEASE_SECONDS) -> bool:
+    """Extends a lease
+
+    Returns:
+        bool: False when the worker no longer holds the lease and should stop the job
+    """
+    now = _now()
+    result = _collection(client).update_one(
+        _owned(job_id, worker_id),
+        {'$set': {'leaseExpiresAt': now + datetime.timedelta(seconds=lease_seconds), 'updatedAt': now}})
+    return result.matched_count == 1
+
+
+def complete(client: MongoClient, job_id: ObjectId, worker_id: str, result: Dict = None) -> bool:
+    """Marks a leased job done
+
+    Returns:
+        bool: False when the lease was lost before completion
+    """
+    now = _now()
+    update = _collection(client).update_one(
+        _owned(job_id, worker_id),
+        {'$set': {'status': 'done', 'result': result, 'finishedAt': now, 'updatedAt': now},
+         '$unset': {'leaseOwner': '', 'leaseExpiresAt': ''}})
+    return update.matched_count == 1
+
+
+def retry_delay(attempts: int) -> float:
+    """Backoff before the next attempt, with full jitter"""
+    return random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (attempts - 1)))
+
+
+def fail(client: MongoClient, job: Dict, worker_id: str, error: str) -> str:
+    """Records a failed attempt, requeueing the job with backoff or dead-lettering it
+
+    Returns:
+        str: The job's new status, queued or dead
+    """
+    now = _now()
+    dead = job['attempts'] >= job['maxAttempts']
+    update = {
+        'status': 'dead' if dead else 'queued',
+        'lastError': error,
+        'updatedAt': now,
+    }
+    if not dead:
+        update['availableAt'] = now + datetime.timedelta(seconds=retry_delay(job['attempts']))
+    _collection(client).update_one(
+        _owned(job['_id'], worker_id),
+        {'$set': update, '$unset': {'leaseOwner': '', 'leaseExpiresAt': ''},
+         '$push': {'errors': {'$each': [{'at': now, 'worker': worker_id, 'error': error}], '$slice': -10}}})
+    if dead:
+        logger.error(f"Job {job['_id']} dead after {job['attempts']} attempts: {error}")
+    return update['status']
+
+
+def release(client: MongoClient, job_id: ObjectId, worker_id: str) -> bool:
+    """Puts a leased job back without counting the attempt, ex: on worker shutdown"""
+    result = _collection(client).update_one(
+        _owned(job_id, worker_id),
+        {'$set': {'status': 'queued', 'availableAt': _now(), 'updatedAt': _now()},
+         '$unset': {'leaseOwner': '', 'leaseExpiresAt': ''},
+         '$inc': {'attempts': -1}})
+    return result.matched_count == 1
+
+
+def requeue_expired(client: MongoClient) -> int:
+    """Requeues running jobs whose lease expired, dead-lettering those out of attempts
+
+    Returns:
+        int: Number of expired jobs
+    """
+    now = _now()
+    collection = _collection(client)
+    expired = {'status': 'running', 'leaseExpiresAt': {'$lt': now}}
+    unset = {'leaseOwner': '', 'leaseExpiresAt': ''}
+    dead = collection.update_many(
+        {**expired, '$expr': {'$gte': ['$attempts', '$maxAttempts']}},
+        {'$set': {'status': 'dead', 'lastError': 'lease expired', 'updatedAt': now}, '$unset': unset})
+    requeued = collection.update_many(
+        expired,
+        {'$set': {'status': 'queued', 'availableAt': now, 'lastError': 'lease expired', 'updatedAt': now},
+         '$unset': unset})
+    count = dead.modified_count + requeued.modified_count
+    if count:
+        logger.warning(f'{requeued.modified_count} expired leases requeued, {dead.modified_count} dead-lettered')
+    return count
+
+
+def retry_dead(client: MongoClient, job_type: str = None) -> int:
+    """Moves dead-lettered jobs back to the queue with fresh attempts"""
+    query = {'status': 'dead'}
+    if job_type is not None:
+        query['type'] = job_type
+    result = _collection(client).update_many(
+        query, {'$set': {'status': 'queued', 'attempts': 0, 'availableAt': _now(), 'updatedAt': _now()}})
+    logger.info(f'Requeued {result.modified_count} dead jobs')
+    return result.modified_count
+
+
+def queue_stats(client: MongoClient) -> Dict[str, Dict[str, int]]:
+    """Job counts per type and status"""
+    stats = {}
+    for row in _collection(client).aggregate([
+        {'$group': {'_id': {'type': '$type', 'status': '$status'}, 'count': {'$sum': 1}}}
+    ]):
+        stats.setdefault(row['_id']['type'], {status: 0 for status in STATUSES})[row['_id']['status']] = row['count']
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the transcript job queue')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    enqueue_parser = subparsers.add_parser('enqueue', help='Queue run_transcript jobs')
+    enqueue_parser.add_argument('--ticker', nargs='+', help='Tickers to process')
+    enqueue_parser.add_argument('--universe', help='Queue every ticker of a universe, ex: sp500')
+    enqueue_parser.add_argument('--year', type=int, required=True)
+    enqueue_parser.add_argument('--quarter', type=int, nargs='+', required=True)
+    enqueue_parser.add_argument('--priority', type=int, default=0, help='Higher runs first')
+    enqueue_parser.add_argument('--max-attempts', type=int, default=3)
+    subparsers.add_parser('stats', help='Job counts per status')
+    subparsers.add_parser('requeue-expired', help='Requeue jobs whose lease expired')
+    subparsers.add_parser('retry-dead', help='Requeue dead-lettered jobs')
+    subparsers.add_parser('indexes', help='Create the queue indexes')
+    args = parser.parse_args()
+
+    mongo_client = connect_mongo()
+    if args.command == 'enqueue':
+        tickers = list(args.ticker or [])
+        if args.universe:
+            from src.universe import load_universe
+
+            tickers += load_universe(mongo_client, [args.universe])
+        if not tickers:
+            parser.error('pass --ticker or --universe')
+        create_indexes(mongo_client)
+        enqueue_transcripts(mongo_client, [(ticker, args.year, quarter) for ticker in tickers
+                                           for quarter in args.quarter],
+                            args.priority, args.max_attempts)
+    elif args.command == 'stats':
+        for job_type, counts in queue_stats(mongo_client).items():
+            print(job_type, ', '.join(f'{status} {count}' for status, count in counts.items()))
+    elif args.command == 'requeue-expired':
+        requeue_expired(mongo_client)
+    elif args.command == 'retry-dead':
+        retry_dead(mongo_client)
+    elif args.command == 'indexes':
+        create_indexes(mongo_client)
+    mongo_client.close()
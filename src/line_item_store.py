@@ -0,0 +1,182 @@
+"""Staging line items stored one document per line item.
+
+stagingTranscripts documents keep a summary of a processing run, the line
+items live in the stagingLineItems collection keyed by (stagingId, position)
+and carry the ticker, fiscal period and session of their run so they can
+be queried without touching the parent.
+"""
+from collections import Counter
+from typing import Dict, Iterator, List
+
+import argparse
+
+from bson import ObjectId
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+from src.excerpt_store import resolve_paragraphs
+from src.utils.loggers import reg_logger
+from src.utils.mongo_utils import connect_mongo
+
+
+logger = reg_logger('line_item_store')
+
+DB_NAME = 'transcripts'
+COLLECTION = 'stagingLineItems'
+PARENT_FIELDS = ['companyTicker', 'fiscalYear', 'fiscalQuarter', 'sessionId']
+# embeddings are most of a line item and older items still carry their paragraph,
+# readers skip both unless asked
+SUMMARY_PROJECTION = {'rawLineItemEmbedding': 0, 'rawTranscriptParagraph': 0}
+
+
+def create_indexes(client: MongoClient) -> None:
+    """Creates the line item indexes"""
+    collection = client[DB_NAME][COLLECTION]
+    collection.create_index(
+        [('stagingId', ASCENDING), ('position', ASCENDING)], unique=True)
+    collection.create_index(
+        [('companyTicker', ASCENDING), ('fiscalYear', ASCENDING), ('fiscalQuarter', ASCENDING)])
+    collection.create_index(
+        [('companyTicker', ASCENDING), ('metricType', ASCENDING), ('fiscalYear', ASCENDING)])
+    collection.create_index([('sessionId', ASCENDING)])
+
+
+def summarize_line_items(line_items: List[Dict]) -> Dict:
+    """Builds the summary fields stored on the parent stagingTranscripts document"""
+    metric_types = Counter(item.get('metricType') for item in line_items
+                           if item.get('metricType') is not None)
+    return {
+        'lineItemCount': len(line_items),
+        'metricTypeCounts': dict(metric_types),
+    }
+
+
+def store_line_items(client: MongoClient, staging_id: ObjectId, parent: Dict, line_items: List[Dict]) -> int:
+    """Writes the line items of one staging document
+
+    Writes are upserts keyed by (stagingId, position), so storing a run again
+    replaces its line items instead of duplicating them.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        staging_id (ObjectId): _id of the parent stagingTranscripts document
+        parent (Dict): Parent document, its ticker, period and session are copied to each line item
+        line_items (List[Dict]): Line items in transcript order
+
+    Returns:
+        int: Number of written line items
+    """
+    if not line_items:
+        return 0
+    shared = {field: parent.get(field) for field in PARENT_FIELDS}
+    operations = [
+        UpdateOne(
+            {'stagingId': staging_id, 'position': position},
+            {'$set': {**line_item, **shared, 'stagingId': staging_id, 'position': position}},
+            upsert=True
+        )
+        for position, line_item in enumerate(line_items)
+    ]
+    client[DB_NAME][COLLECTION].bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def find_line_items(
+    client: MongoClient,
+    query: Dict,
+    include_embeddings: bool = False,
+    include_paragraphs: bool = False
+) -> Iterator[Dict]:
+    """Finds line items in (stagingId, position) order
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        query (Dict): Filter on the line item collection
+        include_embeddings (bool, optional): Return rawLineItemEmbedding. Defaults to False.
+        include_paragraphs (bool, optional): Return rawTranscriptParagraph, resolved from
+            transcriptExcerpts in bulk. Defaults to False.
+
+    Returns:
+        Iterator[Dict]: Line item documents
+    """
+    projection = dict(SUMMARY_PROJECTION)
+    if include_embeddings:
+        projection.pop('rawLineItemEmbedding')
+    if include_paragraphs:
+        projection.pop('rawTranscriptParagraph')
+    cursor = client[DB_NAME][COLLECTION].find(
+        query, projection or None).sort([('stagingId', ASCENDING), ('position', ASCENDING)])
+    if include_paragraphs:
+        return resolve_paragraphs(client, cursor)
+    return cursor
+
+
+def get_guidance(
+    client: MongoClient,
+    ticker: str,
+    fiscal_year: int = None,
+    fiscal_quarter: int = None,
+    metric_type: str = None
+) -> List[Dict]:
+    """Gets the staging line items of a ticker, optionally narrowed by period and metric type
+
+    Returns:
+        List[Dict]: Line items without embeddings or paragraphs
+    """
+    query = {'companyTicker': ticker}
+    if fiscal_year is not None:
+        query['fiscalYear'] = int(fiscal_year)
+    if fiscal_quarter is not None:
+        query['fiscalQuarter'] = fiscal_quarter
+    if metric_type is not None:
+        query['metricType'] = metric_type
+    return list(find_line_items(client, query))
+
+
+def migrate_embedded_line_items(client: MongoClient, batch_size: int = 50) -> int:
+    """Moves stagingLineItems arrays out of stagingTranscripts documents
+
+    Each parent is rewritten as a summary once its line items are stored,
+    so the migration can be interrupted and run again.
+
+    Returns:
+        int: Number of migrated staging documents
+    """
+    parents = client[DB_NAME]['stagingTranscripts']
+    migrated = 0
+    while True:
+        docs = list(parents.find(
+            {'stagingLineItems': {'$exists': True}}).limit(batch_size))
+        if not docs:
+            break
+        for doc in docs:
+            summary = summarize_line_items(doc.get('stagingLineItems') or [])
+            if doc.get('companyTicker') is None or doc.get('fiscalYear') is None:
+                # early staging documents only link their transcript
+                raw_transcript = client[DB_NAME]['rawTranscripts'].find_one(
+                    {'_id': doc.get('rawTranscriptId')},
+                    {'companyTicker': 1, 'fiscalYear': 1, 'fiscalQuarter': 1}) or {}
+                for field in ('companyTicker', 'fiscalYear', 'fiscalQuarter'):
+                    if doc.get(field) is None and raw_transcript.get(field) is not None:
+                        doc[field] = summary[field] = raw_transcript[field]
+            store_line_items(client, doc['_id'], doc, doc.get('stagingLineItems') or [])
+            parents.update_one(
+                {'_id': doc['_id']},
+                {'$set': summary, '$unset': {'stagingLineItems': ''}}
+            )
+        migrated += len(docs)
+        logger.info(f'Migrated {migrated} staging documents')
+    return migrated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Create line item indexes and migrate embedded staging line items')
+    parser.add_argument('command', choices=['indexes', 'migrate'])
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    mongo_client = connect_mongo()
+    create_indexes(mongo_client)
+    if args.command == 'migrate':
+        migrate_embedded_line_items(mongo_client, batch_size=args.batch_size)
+    mongo_client.close()
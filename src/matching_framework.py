@@ -1,73 +1,134 @@
-from utils.mongo_utils import connect_mongo, get_data_from_collection
+from src.line_item_store import find_line_items
+from src.utils.mongo_utils import connect_mongo, get_data_from_collection
+from dataclasses import dataclass
 import pandas as pd
+import uuid
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from dotenv import load_dotenv, find_dotenv
-from prompts import ChatGPTSession
+from src.similarity_engine import (cosine_similarity_matrix, mutual_best_matches, one_to_one_matches,
+                                   top_k_similarity)
+from src.utils.embedding_codec import EmbeddingProfile, stack_embeddings, truncate_embeddings
 
 load_dotenv(dotenv_path=find_dotenv(), override=True)
 
-monngo_conn = connect_mongo()
-
 
 def read_csv(file_path) -> pd.DataFrame:
     return pd.read_csv(file_path)
 
 
 def convert_string_to_array(str_array) -> np.ndarray:
-    # Assuming each string in str_array is a representation of a numeric array
-    return np.array([np.array(vec) for vec in str_array])
-
-
-def calculate_similarity(vectors_1, vectors_2) -> np.ndarray:
-    # Convert to numpy arrays if not already
-    if isinstance(vectors_1, list) or isinstance(vectors_1, pd.Series):
-        vectors_1 = convert_string_to_array(vectors_1)
-    if isinstance(vectors_2, list) or isinstance(vectors_2, pd.Series):
-        vectors_2 = convert_string_to_array(vectors_2)
-
-    # Check if vectors are of the same length
-    if vectors_1.shape[1] != vectors_2.shape[1]:
-        raise ValueError("Embeddings must be of the same length")
-
-    similarity_matrix = cosine_similarity(vectors_1, vectors_2)
-    return similarity_matrix
-
+    # Accepts packed Binary embeddings as well as legacy lists of doubles
+    return stack_embeddings(str_array)
 
-def compare_dataframes(df_processed, df_test, embedding_column, similarity_threshold=0.98) -> tuple[list, list, list]:
-    if embedding_column not in df_processed.columns:
-        df_processed[embedding_column] = df_processed['lineItem'].apply(
-            lambda x: ChatGPTSession.get_embedding(text=x))
-    if embedding_column not in df_test.columns:
-        df_test[embedding_column] = df_test['lineItem'].apply(
-            lambda x: ChatGPTSession.get_embedding(text=x))
-    similarity_matrix = calculate_similarity(
-        df_processed[embedding_column], df_test[embedding_column])
 
-    print(similarity_matrix.shape)
+def prepare_embeddings(vectors, profile: EmbeddingProfile = None) -> np.ndarray:
+    # Decode stored embeddings and bring them to the profile's dimensions
+    profile = profile or EmbeddingProfile.from_env()
+    if isinstance(vectors, list) or isinstance(vectors, pd.Series):
+        return profile.prepare(vectors)
+    return truncate_embeddings(vectors, profile.dimensions)
 
-    matches = []
-    misses = []
-    points_of_interest = []
 
-    max_similarities = np.max(similarity_matrix, axis=1)
-    max_indices = np.argmax(similarity_matrix, axis=1)
-
-    for i, (max_similarity, max_index) in enumerate(zip(max_similarities, max_indices)):
-        if max_similarity >= similarity_threshold:
-            processed_row = df_processed.iloc[i]
-            test_row = df_test.iloc[max_index]
-            matches.append((processed_row, test_row))
-        else:
-            processed_row = df_processed.iloc[i]
-            misses.append(processed_row)
+def calculate_similarity(vectors_1, vectors_2, profile: EmbeddingProfile = None) -> np.ndarray:
+    # Convert to numpy arrays if not already
+    vectors_1 = prepare_embeddings(vectors_1, profile)
+    vectors_2 = prepare_embeddings(vectors_2, profile)
+    # float32 and filled block by block, see similarity_engine
+    return cosine_similarity_matrix(vectors_1, vectors_2)
+
+
+@dataclass
+class MatchResult:
+    processed_indices: np.ndarray
+    test_indices: np.ndarray
+    scores: np.ndarray
+    missed_processed_indices: np.ndarray
+    unmatched_test_indices: np.ndarray
+
+
+def match_embeddings(vectors_1, vectors_2, similarity_threshold=0.98, mode='best', memory_cap_mb=256, profile: EmbeddingProfile = None) -> MatchResult:
+    """Matches two sets of embeddings without building the full similarity matrix
+
+    Args:
+        vectors_1: Processed line item embeddings, shape (n, dim)
+        vectors_2: Test line item embeddings, shape (m, dim)
+        similarity_threshold (float, optional): Minimum cosine similarity for a match. Defaults to 0.98.
+        mode (str, optional): 'best' matches every row to its nearest neighbour,
+            'mutual' keeps only mutual nearest neighbours and 'one_to_one'
+            assigns each test row at most once. Defaults to 'best'.
+        memory_cap_mb (float, optional): Working memory budget per block. Defaults to 256.
+        profile (EmbeddingProfile, optional): Embedding profile to compare under. Defaults to the environment profile.
+
+    Returns:
+        MatchResult: Positional indices and scores of matches and misses
+    """
+    vectors_1 = prepare_embeddings(vectors_1, profile)
+    vectors_2 = prepare_embeddings(vectors_2, profile)
+
+    if mode not in ('best', 'mutual', 'one_to_one'):
+        raise ValueError(f"Invalid match mode {mode}")
+    if len(vectors_1) == 0 or len(vectors_2) == 0:
+        # nothing to match: every processed row is a miss, every test row unmatched
+        processed_indices = test_indices = np.empty(0, dtype=np.int64)
+        scores = np.empty(0, dtype=np.float32)
+    elif mode == 'best':
+        indices, scores = top_k_similarity(
+            vectors_1, vectors_2, k=1, memory_cap_mb=memory_cap_mb)
+        matched = scores[:, 0] >= similarity_threshold
+        processed_indices = np.flatnonzero(matched)
+        test_indices = indices[matched, 0]
+        scores = scores[matched, 0]
+    elif mode == 'mutual':
+        processed_indices, test_indices, scores = mutual_best_matches(
+            vectors_1, vectors_2, similarity_threshold, memory_cap_mb)
+    elif mode == 'one_to_one':
+        processed_indices, test_indices, scores = one_to_one_matches(
+            vectors_1, vectors_2, similarity_threshold, memory_cap_mb=memory_cap_mb)
+
+    return MatchResult(
+        processed_indices=processed_indices,
+        test_indices=test_indices,
+        scores=scores,
+        missed_processed_indices=np.setdiff1d(
+            np.arange(len(vectors_1)), processed_indices),
+        unmatched_test_indices=np.setdiff1d(
+            np.arange(len(vectors_2)), test_indices)
+    )
 
-    matched_test_indices = {test_row.name for _, test_row in matches}
-    for i, test_row in df_test.iterrows():
-        if i not in matched_test_indices:
-            points_of_interest.append(test_row)
 
-    return matches, misses, points_of_interest
+def compare_dataframes(df_processed, df_test, embedding_column, similarity_threshold=0.98, mode='best') -> MatchResult:
+    """Matches line items on stored embeddings
+
+    Rows without an embedding are never embedded here; they are reported as
+    misses / points of interest. Run src.embedding_backfill to fill them in.
+    """
+    for name, df in (('processed', df_processed), ('test', df_test)):
+        if embedding_column not in df.columns:
+            raise ValueError(
+                f"{name} line items have no {embedding_column} column, run src.embedding_backfill first")
+    processed_rows = np.flatnonzero(df_processed[embedding_column].notna().to_numpy())
+    test_rows = np.flatnonzero(df_test[embedding_column].notna().to_numpy())
+    if len(processed_rows) < len(df_processed) or len(test_rows) < len(df_test):
+        print(f'WARNING: {len(df_processed) - len(processed_rows)} processed and '
+              f'{len(df_test) - len(test_rows)} test line items have no embedding')
+
+    result = match_embeddings(
+        df_processed[embedding_column].iloc[processed_rows],
+        df_test[embedding_column].iloc[test_rows],
+        similarity_threshold=similarity_threshold, mode=mode)
+
+    # map positions within the embedded subsets back to dataframe positions
+    processed_indices = processed_rows[result.processed_indices]
+    test_indices = test_rows[result.test_indices]
+    return MatchResult(
+        processed_indices=processed_indices,
+        test_indices=test_indices,
+        scores=result.scores,
+        missed_processed_indices=np.setdiff1d(
+            np.arange(len(df_processed)), processed_indices),
+        unmatched_test_indices=np.setdiff1d(
+            np.arange(len(df_test)), test_indices)
+    )
 
 
 def compare_specific_columns(processed_row, test_row):
@@ -91,12 +152,10 @@ def compare_specific_columns(processed_row, test_row):
         comparison_results[key] = processed_val == test_val
     return comparison_results
 
-# Example usage
-
 
-def compare_chats(ticker: str, processedQuarter: int, processedYear: int, staging: str):
+def load_comparison_data(client, ticker: str, processedQuarter: int, processedYear: int, staging: str) -> tuple[pd.DataFrame, pd.DataFrame]:
     processed_doc_lines = get_data_from_collection(
-        monngo_conn,
+        client,
         'transcripts',
         'processedTranscripts',
         projection={},
@@ -106,46 +165,50 @@ def compare_chats(ticker: str, processedQuarter: int, processedYear: int, stagin
     )
     processed_doc = pd.DataFrame(processed_doc_lines)
 
-    staging_doc_lines = get_data_from_collection(
-        monngo_conn,
-        'transcripts',
-        'stagingTranscripts',
-        projection={},
-        query={'sessionId': staging}
-    )
-    staging_doc = pd.DataFrame(staging_doc_lines)
-    if len(staging_doc) == 1 and 'stagingLineItems' in staging_doc.columns:
-        df_exploded = staging_doc.explode(
-            'stagingLineItems').drop(["_id"], axis=1)
-        line_items_df = pd.json_normalize(df_exploded['stagingLineItems'])
-        df_exploded = df_exploded.reset_index(drop=True)
-        staging_doc = pd.concat(
-            [df_exploded.drop(columns=['stagingLineItems']), line_items_df], axis=1)
+    staging_doc = pd.DataFrame(list(find_line_items(
+        client, {'sessionId': uuid.UUID(str(staging))}, include_embeddings=True, include_paragraphs=True)))
+    return processed_doc, staging_doc
 
-    if len(staging_doc) == 0 or len(processed_doc) == 0:
-        print('ERROR! theres no comparison data! aborting...')
-        return
 
-    matches, misses, points_of_interest = compare_dataframes(
-        processed_doc, staging_doc, 'rawLineItemEmbedding')
+def evaluate_comparison(processed_doc: pd.DataFrame, staging_doc: pd.DataFrame, similarity_threshold=0.98, mode='best') -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    match_result = compare_dataframes(
+        processed_doc, staging_doc, 'rawLineItemEmbedding',
+        similarity_threshold=similarity_threshold, mode=mode)
     comparison_results = []
 
-    for processed_row, test_row in matches:
+    for i, j, score in zip(match_result.processed_indices, match_result.test_indices, match_result.scores):
+        processed_row = processed_doc.iloc[i]
+        test_row = staging_doc.iloc[j]
         column_comparisons = compare_specific_columns(processed_row, test_row)
         comparison_results.append({
             'Processed Line Item': processed_row['lineItem'],
             'Processed Raw Transcript Source Sentence': processed_row['rawTranscriptSourceSentence'],
             'Test Line Item': test_row['rawLineItem'],
             'Test Raw Transcript Source Sentence': test_row['rawTranscriptSourceSentence'],
+            'Similarity': float(score),
             **column_comparisons
         })
 
     matches_df = pd.DataFrame(comparison_results)
-    misses_df = pd.DataFrame(misses)
-    points_of_interest_df = pd.DataFrame(points_of_interest)
+    misses_df = processed_doc.iloc[match_result.missed_processed_indices]
+    points_of_interest_df = staging_doc.iloc[match_result.unmatched_test_indices]
+    return matches_df, misses_df, points_of_interest_df
+
+
+def compare_chats(ticker: str, processedQuarter: int, processedYear: int, staging: str, client=None):
+    client = client or connect_mongo()
+    processed_doc, staging_doc = load_comparison_data(
+        client, ticker, processedQuarter, processedYear, staging)
+
+    if len(staging_doc) == 0 or len(processed_doc) == 0:
+        print('ERROR! theres no comparison data! aborting...')
+        return
+
+    matches_df, misses_df, points_of_interest_df = evaluate_comparison(
+        processed_doc, staging_doc)
 
     # Save to Excel
-    output_file = f'{processed_doc_lines[0]["companyName"]}_Q{processed_doc_lines[0]["transcriptPeriod"]["fiscalQuarter"]}_comparison_results.xlsx'
+    output_file = f'{ticker}_Q{processedQuarter}_comparison_results.xlsx'
     with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
         matches_df.to_excel(writer, sheet_name='Matches', index=False)
         misses_df.to_excel(writer, sheet_name='Misses', index=False)
@@ -153,5 +216,6 @@ def compare_chats(ticker: str, processedQuarter: int, processedYear: int, stagin
             writer, sheet_name='Points of Interest', index=False)
 
 
-compare_chats(ticker='NKE', processedQuarter=2, processedYear=2023,
-              staging='de263777-580b-4586-8b8f-876c987607ee')
+if __name__ == '__main__':
+    compare_chats(ticker='NKE', processedQuarter=2, processedYear=2023,
+                  staging='de263777-580b-4586-8b8f-876c987607ee')
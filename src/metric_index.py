@@ -0,0 +1,332 @@
+"""Per-ticker index of canonical metrics clustered from line item embeddings.
+"""
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import argparse
+import hashlib
+
+import numpy as np
+from bson import ObjectId
+from pymongo import ASCENDING, MongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from src.line_item_store import SUMMARY_PROJECTION
+from src.similarity_engine import normalize_rows, top_k_similarity
+from src.utils.embedding_codec import EmbeddingProfile
+from src.utils.loggers import reg_logger
+from src.utils.mongo_utils import connect_mongo
+
+
+logger = reg_logger('metric_index')
+
+EMBEDDING_FIELD = 'rawLineItemEmbedding'
+CLUSTER_FIELD = 'canonicalMetricId'
+SIMILARITY_THRESHOLD = 0.9
+LOCK_COLLECTION = 'metricIndexLocks'
+# a rebuild renews its lock after every batch, an expired lock belongs to a dead rebuild
+REBUILD_LOCK_SECONDS = 600
+
+
+class MetricIndexLockedError(Exception):
+    """Exceptions for writes to a ticker's clusters while they are being rebuilt
+    """
+
+
+def _locks(client: MongoClient):
+    return client['transcripts'][LOCK_COLLECTION]
+
+
+def acquire_rebuild_lock(client: MongoClient, ticker: str) -> ObjectId:
+    """Takes the ticker's rebuild lock, or an expired one
+
+    Raises:
+        MetricIndexLockedError: Another rebuild holds the lock
+
+    Returns:
+        ObjectId: Lock token, pass it to renew and release the lock
+    """
+    token = ObjectId()
+    now = datetime.now()
+    lock = {'owner': token, 'expiresAt': now + timedelta(seconds=REBUILD_LOCK_SECONDS)}
+    try:
+        _locks(client).insert_one({'_id': ticker, **lock})
+        return token
+    except DuplicateKeyError:
+        pass
+    if _locks(client).find_one_and_update(
+            {'_id': ticker, 'expiresAt': {'$lt': now}}, {'$set': lock}) is None:
+        raise MetricIndexLockedError(f'{ticker} metric index is being rebuilt')
+    return token
+
+
+def renew_rebuild_lock(client: MongoClient, ticker: str, token: ObjectId) -> None:
+    expires_at = datetime.now() + timedelta(seconds=REBUILD_LOCK_SECONDS)
+    if _locks(client).update_one({'_id': ticker, 'owner': token},
+                                 {'$set': {'expiresAt': expires_at}}).matched_count != 1:
+        raise MetricIndexLockedError(f'{ticker} rebuild lost its lock')
+
+
+def release_rebuild_lock(client: MongoClient, ticker: str, token: ObjectId) -> None:
+    _locks(client).delete_one({'_id': ticker, 'owner': token})
+
+
+def is_rebuilding(client: MongoClient, ticker: str) -> bool:
+    return _locks(client).find_one({'_id': ticker, 'expiresAt': {'$gte': datetime.now()}}) is not None
+
+
+def create_indexes(client: MongoClient) -> None:
+    """Creates the indexes used by cluster assignment and history lookups"""
+    db = client['transcripts']
+    db['metricClusters'].create_index(
+        [('companyTicker', ASCENDING), ('label', ASCENDING)], unique=True)
+    db['stagingLineItems'].create_index(
+        [('companyTicker', ASCENDING), (CLUSTER_FIELD, ASCENDING)])
+
+
+def metric_cluster_id(ticker: str, label: str) -> ObjectId:
+    """Id of a ticker's cluster, derived from its label so every process creates the same one"""
+    return ObjectId(hashlib.sha256(f'{ticker}:{label}'.encode('utf-8')).hexdigest()[:24])
+
+
+class MetricIndex:
+    """Canonical metric clusters of one ticker
+
+    Each cluster stores its member count and the sum of its members'
+    normalized embeddings; the centroid is the normalized sum. A line item
+    joins the closest cluster when the cosine similarity is at least
+    threshold, otherwise it starts a new cluster.
+    """
+
+    def __init__(
+        self,
+        client: MongoClient,
+        ticker: str,
+        threshold: float = SIMILARITY_THRESHOLD,
+        profile: EmbeddingProfile = None,
+        load: bool = True
+    ):
+        self.client = client
+        self.collection = client['transcripts']['metricClusters']
+        self.ticker = ticker
+        self.threshold = threshold
+        self.profile = profile or EmbeddingProfile.from_env()
+        clusters = list(self.collection.find({'companyTicker': ticker})) if load else []
+        self.cluster_ids = [cluster['_id'] for cluster in clusters]
+        self.labels = [cluster['label'] for cluster in clusters]
+        self.counts = [cluster['count'] for cluster in clusters]
+        self.sums = np.vstack([self._member_sum(cluster) for cluster in clusters]) if clusters else None
+        self.centroids = normalize_rows(self.sums) if clusters else None
+        # sums of clusters written before vectorSum existed, used once to seed it
+        self._legacy_sums = {position: self.sums[position].copy()
+                             for position, cluster in enumerate(clusters) if 'vectorSum' not in cluster}
+        # position -> (count increment, vector sum increment) since the last save
+        self._increments = {}
+
+    def _member_sum(self, cluster: Dict) -> np.ndarray:
+        if 'vectorSum' in cluster:
+            return np.asarray(cluster['vectorSum'], dtype=np.float32)
+        centroid = normalize_rows(self.profile.prepare([cluster['centroid']]))[0]
+        return centroid * cluster['count']
+
+    def _add_cluster(self, label: str, vector: np.ndarray) -> ObjectId:
+        cluster_id = metric_cluster_id(self.ticker, label)
+        self.cluster_ids.append(cluster_id)
+        self.labels.append(label)
+        self.counts.append(0)
+        row = np.zeros((1, vector.shape[0]), dtype=np.float32)
+        self.sums = row if self.sums is None else np.vstack([self.sums, row])
+        self.centroids = row.copy() if self.centroids is None else np.vstack([self.centroids, row])
+        return self._join_cluster(len(self.cluster_ids) - 1, vector)
+
+    def _join_cluster(self, position: int, vector: np.ndarray) -> ObjectId:
+        self.sums[position] += vector
+        self.centroids[position] = self.sums[position] / (np.linalg.norm(self.sums[position]) or 1)
+        self.counts[position] += 1
+        count, total = self._increments.get(position, (0, 0))
+        self._increments[position] = (count + 1, total + vector)
+        return self.cluster_ids[position]
+
+    def assign(self, line_items: List[Dict]) -> List[ObjectId]:
+        """Assigns line items to clusters and stores the cluster id on each item
+
+        Nothing is written until save(), so callers can save only once the
+        line items themselves are stored.
+
+        Args:
+            line_items (List[Dict]): Staging line items with rawLineItem and rawLineItemEmbedding
+
+        Returns:
+            List[ObjectId]: Cluster id per line item, None where the item has no embedding
+        """
+        cluster_ids = []
+        embedded = [item for item in line_items if item.get(EMBEDDING_FIELD) is not None]
+        if not embedded:
+            return [None] * len(line_items)
+        vectors = normalize_rows(self.profile.prepare(
+            [item[EMBEDDING_FIELD] for item in embedded]))
+        if self.centroids is not None and self.centroids.shape[1] != vectors.shape[1]:
+            raise ValueError(
+                f"{self.ticker} clusters have {self.centroids.shape[1]} dimensions, "
+                f"line items have {vectors.shape[1]}")
+
+        vector_iter = iter(vectors)
+        for item in line_items:
+            if item.get(EMBEDDING_FIELD) is None:
+                cluster_ids.append(None)
+                continue
+            vector = next(vector_iter)
+            cluster_id = None
+            if self.centroids is not None:
+                indices, scores = top_k_similarity(
+                    vector[None, :], self.centroids, k=1, normalized=True)
+                if scores[0, 0] >= self.threshold:
+                    cluster_id = self._join_cluster(int(indices[0, 0]), vector)
+            if cluster_id is None:
+                label = item.get('rawLineItem')
+                if label in self.labels:
+                    # labels are unique per ticker, a new cluster with a known label joins it
+                    cluster_id = self._join_cluster(self.labels.index(label), vector)
+                else:
+                    cluster_id = self._add_cluster(label, vector)
+            item[CLUSTER_FIELD] = cluster_id
+            cluster_ids.append(cluster_id)
+        return cluster_ids
+
+    def save(self) -> None:
+        """Adds the increments since the last save to the stored clusters in one bulk write
+
+        Counts and vector sums are added on the server in a single update per
+        cluster, so processes saving the same ticker at once do not overwrite
+        each other. New clusters are upserted on their label-derived id.
+
+        Raises:
+            MetricIndexLockedError: The ticker's clusters are being rebuilt
+        """
+        if not self._increments:
+            return
+        if is_rebuilding(self.client, self.ticker):
+            raise MetricIndexLockedError(
+                f'{self.ticker} metric index is being rebuilt, run rebuild_index again once it is done')
+        self._write()
+
+    def _write(self) -> None:
+        if not self._increments:
+            return
+        now = datetime.now()
+        operations = []
+        for position, (count, total) in self._increments.items():
+            seed = self._legacy_sums.get(position, np.zeros_like(total))
+            operations.append(UpdateOne(
+                {'_id': self.cluster_ids[position]},
+                [
+                    {'$set': {
+                        'companyTicker': self.ticker,
+                        'label': self.labels[position],
+                        'count': {'$add': [{'$ifNull': ['$count', 0]}, count]},
+                        'vectorSum': {'$map': {
+                            'input': {'$range': [0, len(total)]},
+                            'as': 'i',
+                            'in': {'$add': [
+                                {'$arrayElemAt': [{'$ifNull': ['$vectorSum', seed.tolist()]}, '$$i']},
+                                {'$arrayElemAt': [total.tolist(), '$$i']}
+                            ]}
+                        }},
+                        'createdAt': {'$ifNull': ['$createdAt', now]},
+                        'updatedAt': now
+                    }},
+                    {'$unset': 'centroid'}
+                ],
+                upsert=True
+            ))
+        self.collection.bulk_write(operations, ordered=False)
+        logger.info(f'Saved {len(operations)} {self.ticker} metric clusters')
+        for position in self._increments:
+            self._legacy_sums.pop(position, None)
+        self._increments = {}
+
+
+def get_metric_history(client: MongoClient, ticker: str, cluster_id: ObjectId) -> List[Dict]:
+    """Gets every staging line item of a canonical metric in period order
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        ticker (str): Company ticker
+        cluster_id (ObjectId): Canonical metric id
+
+    Returns:
+        List[Dict]: Line items with their fiscal period, without embeddings
+    """
+    return list(client['transcripts']['stagingLineItems'].find(
+        {'companyTicker': ticker, CLUSTER_FIELD: cluster_id},
+        SUMMARY_PROJECTION
+    ).sort([('fiscalYear', ASCENDING), ('fiscalQuarter', ASCENDING)]))
+
+
+def rebuild_index(client: MongoClient, ticker: str, threshold: float = SIMILARITY_THRESHOLD, batch_size: int = 1000) -> int:
+    """Clusters all existing staging line items of a ticker in period order
+
+    The new clusters are built in memory and replace the stored ones at the
+    end. The ticker's rebuild lock is held throughout, and MetricIndex.save
+    refuses to write while it is, so transcripts of the ticker should not be
+    processed during a rebuild; line items whose save was refused keep a
+    stale cluster id until the next rebuild.
+
+    Raises:
+        MetricIndexLockedError: Another rebuild of the ticker is running
+
+    Returns:
+        int: Number of assigned line items
+    """
+    token = acquire_rebuild_lock(client, ticker)
+    try:
+        return _rebuild(client, ticker, token, threshold, batch_size)
+    finally:
+        release_rebuild_lock(client, ticker, token)
+
+
+def _rebuild(client: MongoClient, ticker: str, token: ObjectId, threshold: float, batch_size: int) -> int:
+    collection = client['transcripts']['stagingLineItems']
+    index = MetricIndex(client, ticker, threshold=threshold, load=False)
+    assigned = 0
+    docs = collection.find(
+        {'companyTicker': ticker},
+        {'rawLineItem': 1, EMBEDDING_FIELD: 1}
+    ).sort([('fiscalYear', ASCENDING), ('fiscalQuarter', ASCENDING),
+            ('stagingId', ASCENDING), ('position', ASCENDING)])
+
+    def assign_batch(batch: List[Dict]) -> int:
+        cluster_ids = index.assign(batch)
+        operations = [UpdateOne({'_id': doc['_id']}, {'$set': {CLUSTER_FIELD: cluster_id}})
+                      for doc, cluster_id in zip(batch, cluster_ids) if cluster_id is not None]
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+        renew_rebuild_lock(client, ticker, token)
+        return len(operations)
+
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            assigned += assign_batch(batch)
+            batch = []
+    if batch:
+        assigned += assign_batch(batch)
+    client['transcripts']['metricClusters'].delete_many({'companyTicker': ticker})
+    index._write()
+    logger.info(f'Assigned {assigned} {ticker} line items to {len(index.cluster_ids)} metrics')
+    return assigned
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rebuild the canonical metric index of tickers')
+    parser.add_argument('tickers', nargs='+')
+    parser.add_argument('--threshold', type=float, default=SIMILARITY_THRESHOLD)
+    args = parser.parse_args()
+
+    mongo_client = connect_mongo()
+    create_indexes(mongo_client)
+    for ticker in args.tickers:
+        rebuild_index(mongo_client, ticker, threshold=args.threshold)
+    mongo_client.close()
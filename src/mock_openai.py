@@ -0,0 +1,335 @@
+"""Local OpenAI-compatible server for offline runs, load tests and fault drills
+
+Serves /v1/chat/completions and /v1/embeddings. A chat request is answered
+from a recording with the same request hash when one exists, otherwise a
+response is synthesized from the prompt: lineItems JSON for extraction
+prompts, pass-through answers for the QA prompts and a keyword verdict for
+guidance classification. Embeddings are deterministic per input text.
+
+Latency, 429s, 500s and hanging requests are injected according to a
+FaultConfig, which can be changed at runtime through POST /mock/config.
+
+Point clients at it with:
+
+    OPENAI_BASE_URL=http://localhost:8100/v1 OPENAI_API_KEY=mock python run_transcript.py
+
+and record real responses for later replay with:
+
+    python -m src.mock_openai --upstream https://api.openai.com/v1
+"""
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, List, Optional
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+import httpx
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from src.utils.loggers import BASE_DIR, reg_logger
+
+
+logger = reg_logger('mock_openai')
+
+RECORDINGS_DIR = os.getenv('MOCK_OPENAI_RECORDINGS',
+                           os.path.join(BASE_DIR, 'cache', 'openai_recordings'))
+EMBEDDING_DIMENSIONS = {
+    'text-embedding-3-small': 1536,
+    'text-embedding-3-large': 3072,
+    'text-embedding-ada-002': 1536,
+}
+METRIC_KEYWORDS = [
+    'earnings per share', 'eps', 'gross margin', 'operating margin', 'operating income',
+    'net income', 'free cash flow', 'revenue', 'sales', 'capital expenditures', 'dividend',
+]
+GUIDANCE_WORDS = ('expect', 'outlook', 'guidance', 'anticipate', 'forecast', 'will ', 'next year')
+NUMBER_PATTERN = re.compile(
+    r'(\$)?(-?\d[\d,]*(?:\.\d+)?)\s*(%|percent|basis points|million|billion|thousand)?', re.I)
+
+
+@dataclass
+class FaultConfig:
+    """Injected latency and failures
+
+    Latency is lognormal around latency_median seconds. The *_rate fields are
+    per-request probabilities.
+    """
+    latency_median: float = 0.0
+    latency_sigma: float = 0.5
+    rate_limit_rate: float = 0.0
+    retry_after: float = 1.0
+    server_error_rate: float = 0.0
+    timeout_rate: float = 0.0
+    timeout_seconds: float = 600.0
+
+    @classmethod
+    def from_env(cls) -> 'FaultConfig':
+        """Reads each field from MOCK_OPENAI_<FIELD>, ex: MOCK_OPENAI_RATE_LIMIT_RATE"""
+        values = {}
+        for field in fields(cls):
+            value = os.getenv(f'MOCK_OPENAI_{field.name.upper()}')
+            if value is not None:
+                values[field.name] = float(value)
+        return cls(**values)
+
+
+def request_hash(body: Dict) -> str:
+    """Hash of the parts of a request that determine its response"""
+    key = {name: body.get(name) for name in
+           ('model', 'messages', 'response_format', 'temperature', 'presence_penalty',
+            'functions', 'function_call', 'tools')}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class RecordingStore:
+    """Recorded responses stored as <request hash>.json files
+    """
+
+    def __init__(self, directory: str = RECORDINGS_DIR):
+        self.directory = directory
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key: str) -> Optional[Dict]:
+        try:
+            with open(self._path(key)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, response: Dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(response, file)
+        os.replace(path + '.tmp', path)
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _metric_name(sentence: str) -> str:
+    lowered = sentence.lower()
+    for keyword in METRIC_KEYWORDS:
+        if keyword in lowered:
+            return keyword.upper() if keyword == 'eps' else keyword.title()
+    return 'Other Metric'
+
+
+def synthesize_line_items(content: str) -> Dict:
+    """Builds a plausible extraction response from the excerpt in an extraction prompt"""
+    excerpt = content.split('Excerpt:', 1)[-1]
+    period = re.search(r'Use the format (\S+?)\.', content)
+    period = period.group(1) if period else None
+    line_items = []
+    for sentence in re.split(r'(?<=[.!?])\s+', excerpt):
+        match = NUMBER_PATTERN.search(sentence)
+        if match is None or not any(char.isalpha() for char in sentence):
+            continue
+        dollar, value, suffix = match.groups()
+        suffix = (suffix or '').lower()
+        lowered = sentence.lower()
+        line_items.append({
+            'rawLineItem': _metric_name(sentence),
+            'rawPeriod': period,
+            'rawLow': value.replace(',', ''),
+            'rawHigh': None,
+            'rawUnit': 'percentage' if suffix in ('%', 'percent') else
+                       'basis points' if suffix == 'basis points' else 'USD' if dollar else 'other',
+            'rawScale': suffix + 's' if suffix in ('million', 'billion', 'thousand') else 'none',
+            'metricType': 'guidance' if any(word in lowered for word in GUIDANCE_WORDS) else 'retrospective',
+            'rawTranscriptSourceSentence': sentence.strip(),
+        })
+    if not line_items:
+        return {'finish': 'TERMINATE'}
+    return {'lineItems': line_items}
+
+
+def synthesize_content(body: Dict) -> str:
+    """Synthesizes the assistant message for a chat request"""
+    messages = body.get('messages') or []
+    content = '\n'.join(str(message.get('content', '')) for message in messages)
+    json_mode = (body.get('response_format') or {}).get('type') == 'json_object'
+
+    if 'Metrics to correct are' in content:
+        # qa_two, answer with the metrics unchanged
+        metrics = content.split('Metrics to correct are', 1)[1].strip()
+        if not json_mode:
+            return metrics
+        pattern = r'(rawPeriod|rawLow|rawHigh|rawUnit|rawScale|metricType|rawTranscriptSourceSentence):\s*(.*?)(?=,\s*\w+:|$)'
+        return json.dumps({key: value.strip() for key, value in re.findall(pattern, metrics, re.S)})
+    if 'line item:' in content:
+        # qa_one, keep the metric name
+        return content.split('line item:', 1)[1].split(', source sentence:', 1)[0].strip()
+    if json_mode and 'lineItems' in content:
+        return json.dumps(synthesize_line_items(content))
+    if 'transcript paragraph' in content:
+        lowered = content.lower()
+        return 'True' if any(word in lowered for word in GUIDANCE_WORDS) else 'False'
+    return '{}' if json_mode else 'OK'
+
+
+def chat_completion(body: Dict, content: str) -> Dict:
+    prompt_text = ''.join(str(message.get('content', '')) for message in body.get('messages') or [])
+    prompt_tokens, completion_tokens = _count_tokens(prompt_text), _count_tokens(content)
+    return {
+        'id': f'chatcmpl-mock-{uuid.uuid4().hex[:24]}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model'),
+        'system_fingerprint': 'mock',
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content,
+                        'function_call': None, 'tool_calls': None},
+            'logprobs': None,
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+def embed_text(text: str, dimensions: int) -> List[float]:
+    """Deterministic unit vector for a text"""
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def create_app(
+    faults: FaultConfig = None,
+    recordings: RecordingStore = None,
+    upstream: str = None,
+    seed: int = None
+) -> FastAPI:
+    """Builds the mock server
+
+    Args:
+        faults (FaultConfig, optional): Injected faults. Defaults to FaultConfig.from_env().
+        recordings (RecordingStore, optional): Recorded responses. Defaults to RECORDINGS_DIR.
+        upstream (str, optional): Base URL requests without a recording are proxied to and recorded from. Defaults to None.
+        seed (int, optional): Seed for fault injection. Defaults to None.
+    """
+    app = FastAPI()
+    app.state.faults = faults or FaultConfig.from_env()
+    app.state.stats = {'chat': 0, 'embeddings': 0, 'replayed': 0, 'recorded': 0,
+                       'synthesized': 0, 'rate_limited': 0, 'server_errors': 0, 'timeouts': 0}
+    recordings = recordings or RecordingStore()
+    rng = random.Random(seed)
+
+    async def inject_faults() -> Optional[JSONResponse]:
+        config = app.state.faults
+        if config.latency_median > 0:
+            await asyncio.sleep(rng.lognormvariate(np.log(config.latency_median), config.latency_sigma))
+        roll = rng.random()
+        if roll < config.rate_limit_rate:
+            app.state.stats['rate_limited'] += 1
+            return JSONResponse(
+                {'error': {'message': 'Rate limit reached (mock)', 'type': 'requests',
+                           'code': 'rate_limit_exceeded'}},
+                status_code=429,
+                headers={'retry-after': str(config.retry_after),
+                         'retry-after-ms': str(int(config.retry_after * 1000))})
+        roll -= config.rate_limit_rate
+        if roll < config.server_error_rate:
+            app.state.stats['server_errors'] += 1
+            return JSONResponse(
+                {'error': {'message': 'The server had an error (mock)', 'type': 'server_error'}},
+                status_code=500)
+        roll -= config.server_error_rate
+        if roll < config.timeout_rate:
+            app.state.stats['timeouts'] += 1
+            await asyncio.sleep(config.timeout_seconds)
+        return None
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.stats['chat'] += 1
+        fault = await inject_faults()
+        if fault is not None:
+            return fault
+
+        key = request_hash(body)
+        recorded = recordings.get(key)
+        if recorded is not None:
+            app.state.stats['replayed'] += 1
+            return recorded
+        if upstream:
+            async with httpx.AsyncClient(timeout=600) as client:
+                response = await client.post(
+                    f'{upstream.rstrip("/")}/chat/completions', json=body,
+                    headers={'Authorization': f"Bearer {os.getenv('OPENAI_UPSTREAM_API_KEY')}"})
+            if response.status_code != 200:
+                return JSONResponse(response.json(), status_code=response.status_code)
+            recordings.put(key, response.json())
+            app.state.stats['recorded'] += 1
+            return response.json()
+        app.state.stats['synthesized'] += 1
+        return chat_completion(body, synthesize_content(body))
+
+    @app.post('/v1/embeddings')
+    async def embeddings(request: Request):
+        body = await request.json()
+        app.state.stats['embeddings'] += 1
+        fault = await inject_faults()
+        if fault is not None:
+            return fault
+        texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+        model = body.get('model', 'text-embedding-3-small')
+        dimensions = body.get('dimensions') or EMBEDDING_DIMENSIONS.get(model, 1536)
+        return {
+            'object': 'list',
+            'model': model,
+            'data': [{'object': 'embedding', 'index': i, 'embedding': embed_text(str(text), dimensions)}
+                     for i, text in enumerate(texts)],
+            'usage': {'prompt_tokens': sum(_count_tokens(str(text)) for text in texts),
+                      'total_tokens': sum(_count_tokens(str(text)) for text in texts)},
+        }
+
+    @app.get('/mock/stats')
+    async def stats():
+        return {**app.state.stats, 'faults': asdict(app.state.faults)}
+
+    @app.post('/mock/config')
+    async def configure(request: Request):
+        updates = await request.json()
+        app.state.faults = FaultConfig(**{**asdict(app.state.faults), **updates})
+        logger.info(f'Fault config set to {app.state.faults}')
+        return asdict(app.state.faults)
+
+    return app
+
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='Run the local OpenAI-compatible mock server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--recordings', default=RECORDINGS_DIR)
+    parser.add_argument('--upstream', help='Proxy and record requests that have no recording')
+    parser.add_argument('--seed', type=int)
+    for field in fields(FaultConfig):
+        parser.add_argument(f'--{field.name.replace("_", "-")}', type=float,
+                            default=getattr(FaultConfig.from_env(), field.name))
+    args = parser.parse_args()
+
+    faults = FaultConfig(**{field.name: getattr(args, field.name) for field in fields(FaultConfig)})
+    uvicorn.run(create_app(faults, RecordingStore(args.recordings), args.upstream, args.seed),
+                host=args.host, port=args.port)
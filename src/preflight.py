@@ -0,0 +1,299 @@
+"""Preflight estimates of OpenAI calls, tokens, cost and wall time
+
+Transcripts are split exactly as process_transcript splits them and the
+extraction prompt is counted per excerpt with the model's tokenizer. How
+many line items an excerpt yields is only known after extraction, so the
+QA stages are estimated from PlanAssumptions. Stage latencies default to
+rough constants and can be read from a trace file written by
+src.utils.tracing.
+
+    python -m src.preflight --ticker IBM --year 2022 --quarter 4
+    python -m src.preflight --universe sp500 --year 2023 --quarter 2 --concurrency 8 --traces logs/traces.jsonl
+"""
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, Tuple
+
+import argparse
+import json
+
+from pymongo import MongoClient
+
+from functions import num_tokens_from_messages
+from run_transcript import (EXTRACTION_MODEL, EXTRACTION_PROMPT_PATH, QA_ONE_MODEL, QA_PROMPTS_PATH,
+                            QA_TWO_MODEL, split_transcript)
+from src.utils.costs import token_cost
+from src.utils.embedding_codec import EmbeddingProfile
+from src.utils.loggers import reg_logger
+from src.utils.mongo_utils import connect_mongo
+
+
+logger = reg_logger('preflight')
+
+STAGES = ('extraction', 'qa_one', 'embedding', 'qa_two')
+
+
+@dataclass
+class PlanAssumptions:
+    """Per-call figures that can't be counted before the run
+    """
+    line_items_per_excerpt: float = 2.0
+    extraction_output_tokens_per_line_item: int = 120
+    source_sentence_tokens: int = 40
+    raw_value_tokens: int = 20
+    qa_one_output_tokens: int = 10
+    qa_two_output_tokens: int = 60
+    embedding_tokens: int = 8
+    latency: Dict[str, float] = field(default_factory=lambda: {
+        'extraction': 15.0,
+        'qa_one': 1.5,
+        'embedding': 0.3,
+        'qa_two': 5.0,
+    })
+
+    @classmethod
+    def from_traces(cls, path: str, **kwargs) -> 'PlanAssumptions':
+        """Uses the p50 latency of each stage recorded in a trace file"""
+        from src.utils.tracing import load_spans, stage_latencies
+
+        assumptions = cls(**kwargs)
+        for row in stage_latencies(load_spans(path)):
+            if row['name'] in assumptions.latency:
+                assumptions.latency[row['name']] = row['p50']
+        return assumptions
+
+
+@dataclass
+class StageEstimate:
+    calls: float = 0
+    prompt_tokens: float = 0
+    completion_tokens: float = 0
+    cost: float = 0.0
+    seconds: float = 0.0
+
+    def add(self, other: 'StageEstimate') -> None:
+        self.calls += other.calls
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cost += other.cost
+        self.seconds += other.seconds
+
+
+@dataclass
+class TranscriptEstimate:
+    """Estimate for one transcript, or the sum of a batch
+    """
+    transcripts: int = 1
+    excerpts: int = 0
+    stages: Dict[str, StageEstimate] = field(
+        default_factory=lambda: {stage: StageEstimate() for stage in STAGES})
+
+    @property
+    def calls(self) -> float:
+        return sum(stage.calls for stage in self.stages.values())
+
+    @property
+    def cost(self) -> float:
+        return sum(stage.cost for stage in self.stages.values())
+
+    @property
+    def seconds(self) -> float:
+        """Sequential call time, process_transcript awaits its calls one at a time"""
+        return sum(stage.seconds for stage in self.stages.values())
+
+    def add(self, other: 'TranscriptEstimate') -> None:
+        self.transcripts += other.transcripts
+        self.excerpts += other.excerpts
+        for name, stage in other.stages.items():
+            self.stages[name].add(stage)
+
+    def wall_time(self, concurrency: int = 1) -> float:
+        """Expected seconds with concurrency transcripts processed at once"""
+        return self.seconds / max(concurrency, 1)
+
+    def summary(self) -> str:
+        return (f'{self.transcripts} transcripts, {self.excerpts} excerpts, {self.calls:.0f} calls, '
+                f'${self.cost:.2f}, {self.seconds / 60:.1f} min sequential')
+
+    def to_dict(self) -> Dict:
+        return {'transcripts': self.transcripts, 'excerpts': self.excerpts, 'calls': self.calls,
+                'cost': self.cost, 'seconds': self.seconds,
+                'stages': {name: asdict(stage) for name, stage in self.stages.items()}}
+
+
+def _tokenizer_model(model: str) -> str:
+    # num_tokens_from_messages only knows pinned snapshots
+    return 'gpt-4-0613' if 'gpt-4' in model else 'gpt-3.5-turbo-0613'
+
+
+def _fill(template: str, **kwargs) -> str:
+    return template.format_map(defaultdict(str, kwargs))
+
+
+def load_prompts() -> Tuple[Dict, Dict, Dict]:
+    """Loads the extraction, qa_one and qa_two prompts used by process_transcript"""
+    with open(EXTRACTION_PROMPT_PATH) as file:
+        extraction = json.load(file)['extract_line_items']
+    with open(QA_PROMPTS_PATH) as file:
+        qa_prompts = json.load(file)
+    return extraction, qa_prompts['qa_one'], qa_prompts['qa_two']
+
+
+def _stage(model: str, calls: float, prompt_tokens: float, completion_tokens: float,
+           latency: float) -> StageEstimate:
+    return StageEstimate(
+        calls=calls,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost=token_cost(model, prompt_tokens, completion_tokens) or 0.0,
+        seconds=calls * latency
+    )
+
+
+def estimate_transcript(
+    raw_transcript_doc: Dict,
+    assumptions: PlanAssumptions = None,
+    prompts: Tuple[Dict, Dict, Dict] = None,
+    embedding_model: str = None
+) -> TranscriptEstimate:
+    """Estimates the calls, tokens, cost and time process_transcript will spend
+
+    Args:
+        raw_transcript_doc (Dict): Raw transcript
+        assumptions (PlanAssumptions, optional): Figures for the QA stages. Defaults to PlanAssumptions().
+        prompts (Tuple[Dict, Dict, Dict], optional): Loaded prompts, read from disk when None. Defaults to None.
+        embedding_model (str, optional): Embedding model. Defaults to the EmbeddingProfile from the environment.
+
+    Returns:
+        TranscriptEstimate: Per-stage estimate
+    """
+    assumptions = assumptions or PlanAssumptions()
+    extraction, qa_one, qa_two = prompts or load_prompts()
+    embedding_model = embedding_model or EmbeddingProfile.from_env().model
+    year = raw_transcript_doc['fiscalYear']
+    quarter = raw_transcript_doc['fiscalQuarter']
+    period = {
+        'companyName': raw_transcript_doc['companyName'],
+        'Year': year,
+        'Quarter': quarter,
+        'nextYear': year + 1,
+        'nextQuarter': 1 if quarter == 4 else quarter + 1,
+        'QuarterYear': f'Q{quarter}Y{year}',
+        'nextQuarterYear': f'Q{1 if quarter == 4 else quarter + 1}Y{year}',
+        'priorQuarterYear': f'Q{quarter}Y{year - 1}',
+    }
+
+    excerpts = [excerpt.page_content for excerpt in split_transcript(raw_transcript_doc)[4:]
+                if len(excerpt.page_content) > 20]
+    extraction_tokens = sum(
+        num_tokens_from_messages(
+            [{'role': extraction['role'], 'content': _fill(extraction['content'], excerpt=excerpt, **period)}],
+            _tokenizer_model(EXTRACTION_MODEL))
+        for excerpt in excerpts)
+    line_items = len(excerpts) * assumptions.line_items_per_excerpt
+
+    sentence = assumptions.source_sentence_tokens
+    qa_one_tokens = num_tokens_from_messages(
+        [{'role': qa_one['role'], 'content': _fill(qa_one['content'])}], _tokenizer_model(QA_ONE_MODEL)) + sentence
+    qa_two_tokens = num_tokens_from_messages(
+        [{'role': qa_two['role'], 'content': _fill(qa_two['content'], **period)}],
+        _tokenizer_model(QA_TWO_MODEL)) + sentence + assumptions.raw_value_tokens
+
+    estimate = TranscriptEstimate(excerpts=len(excerpts))
+    estimate.stages = {
+        'extraction': _stage(
+            EXTRACTION_MODEL, len(excerpts), extraction_tokens,
+            line_items * assumptions.extraction_output_tokens_per_line_item,
+            assumptions.latency['extraction']),
+        'qa_one': _stage(
+            QA_ONE_MODEL, line_items, line_items * qa_one_tokens,
+            line_items * assumptions.qa_one_output_tokens, assumptions.latency['qa_one']),
+        'embedding': _stage(
+            embedding_model, line_items, line_items * assumptions.embedding_tokens, 0,
+            assumptions.latency['embedding']),
+        'qa_two': _stage(
+            QA_TWO_MODEL, line_items, line_items * qa_two_tokens,
+            line_items * assumptions.qa_two_output_tokens, assumptions.latency['qa_two']),
+    }
+    return estimate
+
+
+def plan_batch(
+    client: MongoClient,
+    keys: Iterable[Tuple[str, int, int]],
+    assumptions: PlanAssumptions = None
+) -> TranscriptEstimate:
+    """Estimates a batch of rawTranscripts, keyed by (ticker, fiscal year, fiscal quarter)
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        keys (Iterable[Tuple[str, int, int]]): Transcripts to plan
+        assumptions (PlanAssumptions, optional): Figures for the QA stages. Defaults to PlanAssumptions().
+
+    Returns:
+        TranscriptEstimate: Summed estimate, transcripts counts the ones found
+    """
+    prompts = load_prompts()
+    embedding_model = EmbeddingProfile.from_env().model
+    keys = list(keys)
+    projection = {'companyName': 1, 'companyTicker': 1, 'fiscalYear': 1, 'fiscalQuarter': 1,
+                  'transcript': 1}
+    total = TranscriptEstimate(transcripts=0)
+    found = 0
+    for index in range(0, len(keys), 500):
+        query = {'$or': [{'companyTicker': ticker, 'fiscalYear': year, 'fiscalQuarter': quarter}
+                         for ticker, year, quarter in keys[index:index + 500]]}
+        for doc in client['transcripts']['rawTranscripts'].find(query, projection):
+            total.add(estimate_transcript(doc, assumptions, prompts, embedding_model))
+            found += 1
+    if found < len(keys):
+        logger.warning(f'{len(keys) - found} of {len(keys)} transcripts not found in rawTranscripts')
+    return total
+
+
+def print_plan(estimate: TranscriptEstimate, concurrency: int, budget: float = None) -> None:
+    print(f"{'stage':<12}{'calls':>10}{'prompt tok':>14}{'output tok':>14}{'cost $':>10}{'call min':>10}")
+    for name, stage in estimate.stages.items():
+        print(f'{name:<12}{stage.calls:>10.0f}{stage.prompt_tokens:>14,.0f}{stage.completion_tokens:>14,.0f}'
+              f'{stage.cost:>10.2f}{stage.seconds / 60:>10.1f}')
+    print(estimate.summary())
+    print(f'Expected wall time at concurrency {concurrency}: '
+          f'{estimate.wall_time(concurrency) / 3600:.2f} h')
+    if budget is not None and estimate.cost > budget:
+        print(f'Estimated cost ${estimate.cost:.2f} exceeds the ${budget:.2f} budget')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the OpenAI cost of processing transcripts')
+    parser.add_argument('--ticker', nargs='+', help='Tickers to plan')
+    parser.add_argument('--universe', help='Plan every ticker of a universe, ex: sp500')
+    parser.add_argument('--year', type=int, required=True)
+    parser.add_argument('--quarter', type=int, nargs='+', required=True)
+    parser.add_argument('--concurrency', type=int, default=1, help='Transcripts processed at once')
+    parser.add_argument('--line-items-per-excerpt', type=float, default=PlanAssumptions.line_items_per_excerpt)
+    parser.add_argument('--traces', help='Trace file to read stage latencies from')
+    parser.add_argument('--budget', type=float, help='Warn when the estimate exceeds this many USD')
+    parser.add_argument('--json', action='store_true', help='Print the estimate as JSON')
+    args = parser.parse_args()
+
+    mongo_client = connect_mongo()
+    tickers = list(args.ticker or [])
+    if args.universe:
+        from src.universe import load_universe
+
+        tickers += load_universe(mongo_client, [args.universe])
+    if not tickers:
+        parser.error('pass --ticker or --universe')
+    if args.traces:
+        plan_assumptions = PlanAssumptions.from_traces(
+            args.traces, line_items_per_excerpt=args.line_items_per_excerpt)
+    else:
+        plan_assumptions = PlanAssumptions(line_items_per_excerpt=args.line_items_per_excerpt)
+
+    plan = plan_batch(mongo_client, [(ticker, args.year, quarter) for ticker in tickers
+                                     for quarter in args.quarter], plan_assumptions)
+    if args.json:
+        print(json.dumps({**plan.to_dict(), 'wallTime': plan.wall_time(args.concurrency)}, indent=2))
+    else:
+        print_plan(plan, args.concurrency, args.budget)
+    mongo_client.close()
@@ -3,7 +3,6 @@
 from dataclasses import dataclass
 from dotenv import find_dotenv, load_dotenv
 from openai import AsyncOpenAI
-from retry import retry
 from typing import Any, List
 
 import asyncio
@@ -12,8 +11,14 @@ import openai
 import os
 import uuid
 
+from src.utils.async_retry import RetryPolicy, async_retry
+from src.utils.costs import CostBudget, default_budget, token_cost
+from src.utils.embedding_codec import EmbeddingProfile
+from src.utils.hedging import HedgeBudget, HedgePolicy, hedged_call
 from src.utils.loggers import openai_logger, reg_logger
 from src.utils.mongo_utils import connect_mongo
+from src.utils.rate_limiter import SharedRateLimiter, estimate_tokens, get_rate_limiter
+from src.utils.tracing import span
 
 
 client = connect_mongo()
@@ -23,6 +28,19 @@ logger = reg_logger('prompt_logger')
 
 load_dotenv(dotenv_path=find_dotenv(), override=True)
 
+# rate limiter estimate for a completion, corrected with the actual usage
+EXPECTED_COMPLETION_TOKENS = 256
+COMPLETION_RETRY = RetryPolicy(max_attempts=6, base_delay=1.0, deadline=300.0)
+EMBEDDING_RETRY = RetryPolicy(max_attempts=5, base_delay=0.5, deadline=60.0)
+
+
+def _completion_breaker(session, prompt=None, model=None, *args, **kwargs) -> str:
+    return model or session.default_model
+
+
+def _embedding_breaker(session, texts=None, model=None, *args, **kwargs) -> str:
+    return model or session.embedding_profile.model
+
 
 class OpenAIResponseError(Exception):
     """Exceptions for parsing OpenAI responses
@@ -54,6 +72,7 @@ class Prompt:
     kwargs: dict = None
     response_type: str = 'str'
     next_prompt_key: str = None
+    name: str = None
     _response: str = None
 
     def __post_init__(self):
@@ -105,44 +124,8 @@ class OpenAICompletion:
         self.prompt_tokens = self.raw_response.usage.prompt_tokens
         self.completion_tokens = self.raw_response.usage.completion_tokens
         self.total_tokens = self.raw_response.usage.total_tokens
-        per_token_cost = {
-            'gpt-4-0125-preview': {
-                'input': 0.00001,
-                'output': 0.00003
-            },
-            'gpt-4-1106-preview': {
-                'input': 0.00001,
-                'output': 0.00003
-            },
-            'gpt-4': {
-                'input': 0.00003,
-                'output': 0.00006
-            },
-            'gpt-4-0613': {
-                'input': 0.00003,
-                'output': 0.00006
-            },
-            'gpt-4-32k': {
-                'input': 0.00006,
-                'output': 0.00012,
-            },
-            'gpt-3.5-turbo': {
-                'input': 0.0000015,
-                'output': 0.000002,
-            },
-            'gpt-3.5-turbo-0613': {
-                'input': 0.0000015,
-                'output': 0.000002,
-            },
-            'gpt-3.5-turbo-16k': {
-                'input': 0.000003,
-                'output': 0.000004,
-            }
-        }
-        try:
-            self.cost = (self.prompt_tokens * per_token_cost[self.model]['input']) + \
-                (self.completion_tokens * per_token_cost[self.model]['output'])
-        except KeyError:
+        self.cost = token_cost(self.model, self.prompt_tokens, self.completion_tokens)
+        if self.cost is None:
             self.cost = 'Unrecognized model: ' + self.model
 
     def to_dict(self):
@@ -173,11 +156,17 @@ class ChatGPTSession:
         self,
         model: str,
         termination_key: str,
-        base_context: List[Prompt] = None
+        base_context: List[Prompt] = None,
+        embedding_profile: EmbeddingProfile = None,
+        hedge_policy: HedgePolicy = None,
+        budget: CostBudget = None,
+        rate_limiter: SharedRateLimiter = None
     ):
+        # retries are handled by async_retry, SDK retries would multiply them
         self.openai_client = AsyncOpenAI(
             organization = os.getenv('OPENAI_ORGANIZATION'),
-            api_key=os.getenv("OPENAI_API_KEY")
+            api_key=os.getenv("OPENAI_API_KEY"),
+            max_retries=0
         )
         self.default_model = model
         self.termination_key = termination_key
@@ -186,6 +175,11 @@ class ChatGPTSession:
         else:
             self.base_context = base_context
         self.past_prompts = []
+        self.embedding_profile = embedding_profile or EmbeddingProfile.from_env()
+        self.hedge_policy = hedge_policy or HedgePolicy.from_env()
+        self.hedge_budget = HedgeBudget(self.hedge_policy.max_hedge_ratio)
+        self.budget = budget if budget is not None else default_budget()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter()
         self.session_id = uuid.uuid4()
         self._current_prompt = None
 
@@ -214,7 +208,7 @@ class ChatGPTSession:
         """
         self.base_context.append(prompt)
 
-    @retry(openai.APITimeoutError, tries=5, delay=1)
+    @async_retry(COMPLETION_RETRY, breaker_key=_completion_breaker)
     async def openai_gpt_api_call(
         self,
         prompt: Prompt,
@@ -243,22 +237,32 @@ class ChatGPTSession:
 
         if model is None:
             model = self.default_model
+        if self.budget is not None:
+            self.budget.check(model)
 
         try:
-            raw_response = await self.openai_client.chat.completions.create(
-                model=model,
-                response_format={ "type": prompt.response_type },
-                messages=prompts,
-                temperature=prompt.temperature,
-                presence_penalty=prompt.prescence_penalty
-            )
-
-            response = OpenAICompletion(
-                session_id=self.session_id,
-                base_context=base_context,
-                prompt=prompt.content,
-                raw_response=raw_response
-            )
+            with span('openai.chat', model=model, prompt=prompt.name or prompt.response_type) as current:
+                raw_response = await hedged_call(
+                    lambda: self._create_completion(
+                        model=model,
+                        response_format={ "type": prompt.response_type },
+                        messages=prompts,
+                        temperature=prompt.temperature,
+                        presence_penalty=prompt.prescence_penalty
+                    ),
+                    key=f'{model}:{prompt.name or prompt.response_type}',
+                    policy=self.hedge_policy,
+                    budget=self.hedge_budget
+                )
+
+                response = OpenAICompletion(
+                    session_id=self.session_id,
+                    base_context=base_context,
+                    prompt=prompt.content,
+                    raw_response=raw_response
+                )
+                current.set_attributes(promptTokens=response.prompt_tokens,
+                                       completionTokens=response.completion_tokens)
             prompt.response = response.content
             self.past_prompts.append(prompt)
         except Exception as exc:
@@ -266,6 +270,40 @@ class ChatGPTSession:
         # db_logger.info(response.to_dict())
         return self.process_response(prompt, response)
 
+    async def _create_completion(self, **kwargs):
+        # every request, hedges included, draws from the shared rate limit and is charged
+        if self.rate_limiter is None:
+            raw_response = await self.openai_client.chat.completions.create(**kwargs)
+        else:
+            estimated = estimate_tokens(
+                ''.join(message['content'] for message in kwargs['messages']), EXPECTED_COMPLETION_TOKENS)
+            await self.rate_limiter.acquire(estimated)
+            raw_response = await self.openai_client.chat.completions.create(**kwargs)
+            if raw_response.usage is not None:
+                self.rate_limiter.reconcile(estimated, raw_response.usage.total_tokens)
+        self._charge_completion(raw_response, kwargs['model'])
+        return raw_response
+
+    def _charge_completion(self, raw_response, model: str) -> None:
+        if self.budget is None or raw_response.usage is None:
+            return
+        usage = raw_response.usage
+        # the response names a dated snapshot, which may only be priced under the requested alias
+        cost = token_cost(raw_response.model, usage.prompt_tokens, usage.completion_tokens)
+        if cost is None:
+            cost = token_cost(model, usage.prompt_tokens, usage.completion_tokens)
+        self.budget.charge(cost, model)
+
+    async def _create_embedding(self, texts: List[str], model: str, **kwargs):
+        if self.rate_limiter is None:
+            return await self.openai_client.embeddings.create(input=texts, model=model, **kwargs)
+        estimated = estimate_tokens(''.join(texts))
+        await self.rate_limiter.acquire(estimated)
+        response = await self.openai_client.embeddings.create(input=texts, model=model, **kwargs)
+        if response.usage is not None:
+            self.rate_limiter.reconcile(estimated, response.usage.total_tokens)
+        return response
+
     def gpt_function_call(
         self,
         prompt: Prompt,
@@ -342,8 +380,40 @@ class ChatGPTSession:
         else:
             raise ValueError("Invalid response type")
 
-    @retry(tries=3)
-    async def get_embedding(self, text, model="text-embedding-3-small"):
+    @async_retry(EMBEDDING_RETRY, breaker_key=_embedding_breaker)
+    async def get_embedding(self, text, model=None):
         text = text.replace("\n", " ")
-        response = await self.openai_client.embeddings.create(input=[text], model=model)
+        kwargs = {}
+        if self.embedding_profile.dimensions is not None:
+            kwargs['dimensions'] = self.embedding_profile.dimensions
+        with span('openai.embedding', model=model or self.embedding_profile.model, texts=1):
+            response = await self._create_embedding(
+                [text], model or self.embedding_profile.model, **kwargs)
+        self._charge_embedding(response, model)
         return response
+
+    def _charge_embedding(self, response, model: str = None) -> None:
+        if self.budget is not None and response.usage is not None:
+            model = model or self.embedding_profile.model
+            self.budget.charge(token_cost(model, response.usage.prompt_tokens), model)
+
+    @async_retry(EMBEDDING_RETRY, breaker_key=_embedding_breaker)
+    async def get_embeddings(self, texts: List[str], model=None) -> List[List[float]]:
+        """Embeds a batch of texts in one request
+
+        Args:
+            texts (List[str]): Texts to embed
+            model (str, optional): Embedding model. Defaults to the session's embedding profile.
+
+        Returns:
+            List[List[float]]: Embeddings in the order of texts
+        """
+        texts = [text.replace("\n", " ") for text in texts]
+        kwargs = {}
+        if self.embedding_profile.dimensions is not None:
+            kwargs['dimensions'] = self.embedding_profile.dimensions
+        with span('openai.embedding', model=model or self.embedding_profile.model, texts=len(texts)):
+            response = await self._create_embedding(
+                texts, model or self.embedding_profile.model, **kwargs)
+        self._charge_embedding(response, model)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
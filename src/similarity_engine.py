@@ -0,0 +1,184 @@
+"""Blocked cosine similarity and top-k search for matching line item embeddings.
+"""
+from typing import Tuple
+
+import numpy as np
+
+
+def normalize_rows(vectors: np.ndarray, dtype=np.float32) -> np.ndarray:
+    """L2-normalizes row vectors, leaving zero rows as zeros
+
+    Args:
+        vectors (np.ndarray): Matrix of shape (n, dim)
+        dtype (optional): Output dtype. Defaults to np.float32.
+
+    Returns:
+        np.ndarray: Row-normalized matrix
+    """
+    vectors = np.asarray(vectors, dtype=dtype)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _block_rows(n_targets: int, k: int, memory_cap_mb: float) -> int:
+    """Rows per block so the score block and its partition scratch fit the cap"""
+    # float32 scores plus an int64 argpartition result per target column
+    bytes_per_row = n_targets * (4 + 8) + k * (4 + 8)
+    return max(1, int(memory_cap_mb * 1024 * 1024 // bytes_per_row))
+
+
+def cosine_similarity_matrix(
+    queries: np.ndarray,
+    targets: np.ndarray,
+    memory_cap_mb: float = 256
+) -> np.ndarray:
+    """Full cosine similarity matrix in float32
+
+    Scores are written block by block into the preallocated output, so the
+    only memory beyond the result is one normalized copy of each input.
+
+    Args:
+        queries (np.ndarray): Matrix of shape (n, dim)
+        targets (np.ndarray): Matrix of shape (m, dim)
+        memory_cap_mb (float, optional): Working memory budget per block. Defaults to 256.
+
+    Raises:
+        ValueError: The embeddings have different dimensions
+
+    Returns:
+        np.ndarray: float32 matrix of shape (n, m)
+    """
+    if len(queries) == 0 or len(targets) == 0:
+        return np.empty((len(queries), len(targets)), dtype=np.float32)
+    if queries.shape[1] != targets.shape[1]:
+        raise ValueError("Embeddings must be of the same length")
+    queries = normalize_rows(queries)
+    targets_t = np.ascontiguousarray(normalize_rows(targets).T)
+    scores = np.empty((queries.shape[0], targets_t.shape[1]), dtype=np.float32)
+    block = _block_rows(targets_t.shape[1], 0, memory_cap_mb)
+    for start in range(0, queries.shape[0], block):
+        np.matmul(queries[start:start + block], targets_t, out=scores[start:start + block])
+    return scores
+
+
+def top_k_similarity(
+    queries: np.ndarray,
+    targets: np.ndarray,
+    k: int = 1,
+    memory_cap_mb: float = 256,
+    normalized: bool = False
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds the k most cosine-similar targets for each query row
+
+    The similarity matrix is never materialized: queries are processed in
+    float32 blocks sized so each block stays under memory_cap_mb.
+
+    Args:
+        queries (np.ndarray): Matrix of shape (n, dim)
+        targets (np.ndarray): Matrix of shape (m, dim)
+        k (int, optional): Neighbours per query. Defaults to 1.
+        memory_cap_mb (float, optional): Working memory budget per block. Defaults to 256.
+        normalized (bool, optional): Inputs are already L2-normalized float32. Defaults to False.
+
+    Raises:
+        ValueError: The embeddings have different dimensions
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (n, k) target indices and scores, best first
+    """
+    if queries.shape[1] != targets.shape[1]:
+        raise ValueError("Embeddings must be of the same length")
+    if not normalized:
+        queries = normalize_rows(queries)
+        targets = normalize_rows(targets)
+
+    n_queries, n_targets = queries.shape[0], targets.shape[0]
+    k = min(k, n_targets)
+    indices = np.empty((n_queries, k), dtype=np.int64)
+    scores = np.empty((n_queries, k), dtype=np.float32)
+    if k == 0:
+        return indices, scores
+
+    block = _block_rows(n_targets, k, memory_cap_mb)
+    targets_t = np.ascontiguousarray(targets.T)
+    for start in range(0, n_queries, block):
+        stop = min(start + block, n_queries)
+        block_scores = queries[start:stop] @ targets_t
+        if k < n_targets:
+            top = np.argpartition(block_scores, -k, axis=1)[:, -k:]
+        else:
+            top = np.broadcast_to(np.arange(n_targets), block_scores.shape)
+        top_scores = np.take_along_axis(block_scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        indices[start:stop] = np.take_along_axis(top, order, axis=1)
+        scores[start:stop] = np.take_along_axis(top_scores, order, axis=1)
+    return indices, scores
+
+
+def mutual_best_matches(
+    queries: np.ndarray,
+    targets: np.ndarray,
+    threshold: float = 0.0,
+    memory_cap_mb: float = 256
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Pairs queries and targets that are each other's nearest neighbour
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Query indices, target indices and scores
+    """
+    if queries.shape[0] == 0 or targets.shape[0] == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float32)
+    queries = normalize_rows(queries)
+    targets = normalize_rows(targets)
+    forward, forward_scores = top_k_similarity(
+        queries, targets, 1, memory_cap_mb, normalized=True)
+    backward, _ = top_k_similarity(
+        targets, queries, 1, memory_cap_mb, normalized=True)
+    query_idx = np.arange(queries.shape[0])
+    target_idx = forward[:, 0]
+    mutual = (backward[target_idx, 0] == query_idx) & (
+        forward_scores[:, 0] >= threshold)
+    return query_idx[mutual], target_idx[mutual], forward_scores[mutual, 0]
+
+
+def one_to_one_matches(
+    queries: np.ndarray,
+    targets: np.ndarray,
+    threshold: float = 0.0,
+    k: int = 5,
+    memory_cap_mb: float = 256
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Greedy one-to-one assignment over each query's top-k candidates
+
+    Candidate pairs are taken in descending score order, skipping any pair
+    whose query or target has already been assigned.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Query indices, target indices and scores
+    """
+    indices, scores = top_k_similarity(queries, targets, k, memory_cap_mb)
+    query_rows = np.repeat(np.arange(indices.shape[0]), indices.shape[1])
+    target_cols = indices.ravel()
+    flat_scores = scores.ravel()
+    order = np.argsort(-flat_scores, kind='stable')
+
+    used_queries = np.zeros(queries.shape[0], dtype=bool)
+    used_targets = np.zeros(targets.shape[0], dtype=bool)
+    pairs = []
+    for position in order:
+        score = flat_scores[position]
+        if score < threshold:
+            break
+        query, target = query_rows[position], target_cols[position]
+        if used_queries[query] or used_targets[target]:
+            continue
+        used_queries[query] = used_targets[target] = True
+        pairs.append((query, target, score))
+
+    if not pairs:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float32)
+    query_idx, target_idx, pair_scores = map(np.array, zip(*pairs))
+    return query_idx, target_idx, pair_scores.astype(np.float32)
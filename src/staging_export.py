@@ -0,0 +1,230 @@
+"""Streaming export of staging line items to CSV or Parquet.
+
+Rows are shaped server side with an aggregation over the stagingLineItems
+collection, so an export is one cursor pass with memory bounded by the
+batch size.
+"""
+from typing import Dict, Iterator, List
+
+import os
+import shutil
+import uuid
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+from pymongo import MongoClient
+
+from src.utils.loggers import reg_logger
+
+
+logger = reg_logger('staging_export')
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('companyTicker', pa.string()), ('fiscalYear', pa.int64())]),
+    flavor='hive'
+)
+SCHEMA = pa.schema([
+    ('stagingId', pa.string()),
+    ('rawTranscriptId', pa.string()),
+    ('sessionId', pa.string()),
+    ('companyTicker', pa.string()),
+    ('fiscalYear', pa.int64()),
+    ('fiscalQuarter', pa.string()),
+    ('rawLineItem', pa.string()),
+    ('rawPeriod', pa.string()),
+    ('rawLow', pa.string()),
+    ('rawHigh', pa.string()),
+    ('rawUnit', pa.string()),
+    ('rawScale', pa.string()),
+    ('metricType', pa.string()),
+    ('rawTranscriptSourceSentence', pa.string()),
+    ('rawTranscriptParagraph', pa.string()),
+    ('transcriptPosition', pa.string()),
+    ('createdAt', pa.string()),
+])
+COLUMNS = [field.name for field in SCHEMA]
+LINE_ITEM_FIELDS = ['rawLineItem', 'rawPeriod', 'rawLow', 'rawHigh', 'rawUnit', 'rawScale',
+                    'metricType', 'rawTranscriptSourceSentence', 'rawTranscriptParagraph']
+
+
+def build_pipeline(
+    tickers: List[str] = None,
+    fiscal_year: int = None,
+    fiscal_quarter: int = None,
+    session_ids: List[str] = None
+) -> List[Dict]:
+    """Builds the aggregation over the stagingLineItems collection
+
+    Filters use the ticker, period and session copied onto each line item.
+    The parent stagingTranscripts document is looked up for its transcript
+    id and creation time, and transcriptExcerpts for the paragraph.
+
+    Args:
+        tickers (List[str], optional): Company tickers. Defaults to None.
+        fiscal_year (int, optional): Fiscal year. Defaults to None.
+        fiscal_quarter (int, optional): Fiscal quarter. Defaults to None.
+        session_ids (List[str], optional): Processing session ids, as UUIDs or their strings. Defaults to None.
+
+    Returns:
+        List[Dict]: Aggregation pipeline
+    """
+    match = {}
+    if tickers:
+        match['companyTicker'] = {'$in': list(tickers)}
+    if fiscal_year is not None:
+        match['fiscalYear'] = int(fiscal_year)
+    if fiscal_quarter is not None:
+        quarter = int(str(fiscal_quarter).upper().lstrip('Q'))
+        match['fiscalQuarter'] = {'$in': [quarter, str(quarter), f'Q{quarter}']}
+    if session_ids:
+        # sessions are stored as UUIDs, not their string form
+        match['sessionId'] = {'$in': [uuid.UUID(str(session_id)) for session_id in session_ids]}
+
+    position = '$transcriptPosition'
+    return [
+        {'$match': match},
+        {'$project': {'rawLineItemEmbedding': 0}},
+        # let/$expr lookups rather than localField with pipeline, which needs MongoDB 5.0
+        {'$lookup': {
+            'from': 'stagingTranscripts',
+            'let': {'stagingId': '$stagingId'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$_id', '$$stagingId']}}},
+                {'$project': {'rawTranscriptId': 1, 'createdAt': 1}},
+            ],
+            'as': 'staging'
+        }},
+        {'$lookup': {
+            'from': 'transcriptExcerpts',
+            'let': {'excerptId': '$excerptId'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$_id', '$$excerptId']}}},
+                {'$project': {'text': 1}},
+            ],
+            'as': 'excerpt'
+        }},
+        {'$set': {
+            'staging': {'$first': '$staging'},
+            'rawTranscriptParagraph': {
+                '$ifNull': ['$rawTranscriptParagraph', {'$first': '$excerpt.text'}]},
+        }},
+        {'$project': {
+            '_id': 0,
+            'stagingId': {'$toString': '$stagingId'},
+            'rawTranscriptId': {'$toString': '$staging.rawTranscriptId'},
+            'sessionId': 1,
+            'companyTicker': 1,
+            'fiscalYear': 1,
+            'fiscalQuarter': {'$toString': '$fiscalQuarter'},
+            **{field: 1 for field in LINE_ITEM_FIELDS},
+            'transcriptPosition': {'$cond': [
+                {'$eq': [{'$type': position}, 'object']},
+                {'$concat': ['From ', {'$toString': f'{position}.from'},
+                             ' to ', {'$toString': f'{position}.to'}]},
+                {'$toString': position}
+            ]},
+            'createdAt': {'$toString': '$staging.createdAt'},
+        }},
+    ]
+
+
+def _to_row(doc: Dict) -> Dict:
+    row = {}
+    for column in COLUMNS:
+        value = doc.get(column)
+        if column == 'fiscalYear':
+            row[column] = None if value is None else int(value)
+        else:
+            row[column] = None if value is None else str(value)
+    return row
+
+
+def iter_staging_line_items(client: MongoClient, batch_size: int = 1000, **filters) -> Iterator[List[Dict]]:
+    """Streams flattened staging line items in batches
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        batch_size (int, optional): Rows per yielded batch. Defaults to 1000.
+        **filters: tickers, fiscal_year, fiscal_quarter and session_ids, see build_pipeline
+
+    Yields:
+        List[Dict]: Rows with the SCHEMA columns
+    """
+    cursor = client['transcripts']['stagingLineItems'].aggregate(
+        build_pipeline(**filters), allowDiskUse=True, batchSize=batch_size)
+    rows = []
+    for doc in cursor:
+        rows.append(_to_row(doc))
+        if len(rows) >= batch_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+def _replace_dir(source: str, target: str) -> None:
+    os.makedirs(source, exist_ok=True)
+    previous = f'{target}.old-{os.getpid()}'
+    if os.path.exists(target):
+        os.rename(target, previous)
+    os.rename(source, target)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def export_staging_line_items(
+    client: MongoClient,
+    output: str,
+    file_format: str = 'csv',
+    batch_size: int = 1000,
+    **filters
+) -> int:
+    """Exports staging line items to a CSV file or a partitioned Parquet dataset
+
+    A Parquet export replaces the whole dataset directory once it is
+    written, rather than adding to files left by earlier exports.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        output (str): CSV file path or Parquet dataset directory
+        file_format (str, optional): csv or parquet. Defaults to 'csv'.
+        batch_size (int, optional): Rows written at a time. Defaults to 1000.
+        **filters: tickers, fiscal_year, fiscal_quarter and session_ids, see build_pipeline
+
+    Returns:
+        int: Number of exported line items
+    """
+    if file_format not in ('csv', 'parquet'):
+        raise ValueError(f"Unsupported export format {file_format}")
+    exported = 0
+    if file_format == 'csv':
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with pa_csv.CSVWriter(output, SCHEMA) as writer:
+            for rows in iter_staging_line_items(client, batch_size, **filters):
+                writer.write_table(pa.Table.from_pylist(rows, schema=SCHEMA))
+                exported += len(rows)
+    else:
+        # write next to the target and swap it in, so no part file of an earlier export survives
+        output = os.path.abspath(output)
+        staging_dir = f'{output}.tmp-{os.getpid()}'
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        try:
+            parquet_format = ds.ParquetFileFormat()
+            file_options = parquet_format.make_write_options(compression='zstd')
+            for batch_index, rows in enumerate(iter_staging_line_items(client, batch_size, **filters)):
+                ds.write_dataset(
+                    pa.Table.from_pylist(rows, schema=SCHEMA),
+                    staging_dir,
+                    format=parquet_format,
+                    file_options=file_options,
+                    partitioning=PARTITIONING,
+                    basename_template=f'part-{batch_index}-{{i}}.parquet',
+                    existing_data_behavior='overwrite_or_ignore'
+                )
+                exported += len(rows)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        _replace_dir(staging_dir, output)
+    logger.info(f'Exported {exported} staging line items to {output}')
+    return exported
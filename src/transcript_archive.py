@@ -0,0 +1,229 @@
+"""Parquet archive of rawTranscripts partitioned by ticker and fiscal year.
+"""
+from typing import Dict, Iterator, List
+
+import argparse
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+from bson import ObjectId, json_util
+from pymongo import MongoClient
+
+from src.utils.loggers import BASE_DIR, reg_logger
+from src.utils.mongo_utils import connect_mongo, insert_many_into_collection
+
+
+logger = reg_logger('transcript_archive')
+
+ARCHIVE_DIR = os.getenv('TRANSCRIPT_ARCHIVE_DIR',
+                        os.path.join(BASE_DIR, 'archive', 'rawTranscripts'))
+PARTITIONING = ds.partitioning(
+    pa.schema([('companyTicker', pa.string()), ('fiscalYear', pa.int64())]),
+    flavor='hive'
+)
+SCHEMA = pa.schema([
+    ('_id', pa.string()),
+    ('companyName', pa.string()),
+    ('companyTicker', pa.string()),
+    ('dateOfRecord', pa.string()),
+    ('fiscalYear', pa.int64()),
+    ('fiscalQuarter', pa.string()),
+    # transcript lines are kept as extended JSON so dict and str lines round trip
+    ('transcript', pa.list_(pa.string())),
+    ('extra', pa.string()),
+])
+COLUMNS = [field.name for field in SCHEMA if field.name != 'extra']
+
+
+def _to_row(doc: Dict) -> Dict:
+    extra = {k: v for k, v in doc.items() if k not in COLUMNS}
+    return {
+        '_id': str(doc['_id']),
+        'companyName': doc.get('companyName'),
+        'companyTicker': doc.get('companyTicker'),
+        'dateOfRecord': None if doc.get('dateOfRecord') is None else str(doc['dateOfRecord']),
+        'fiscalYear': doc.get('fiscalYear'),
+        'fiscalQuarter': None if doc.get('fiscalQuarter') is None else str(doc['fiscalQuarter']),
+        'transcript': [json_util.dumps(line) for line in doc.get('transcript') or []],
+        'extra': json_util.dumps(extra),
+    }
+
+
+def _from_row(row: Dict) -> Dict:
+    doc = json_util.loads(row['extra']) if row.get('extra') else {}
+    quarter = row['fiscalQuarter']
+    doc.update({
+        '_id': ObjectId(row['_id']) if ObjectId.is_valid(row['_id']) else row['_id'],
+        'companyName': row['companyName'],
+        'companyTicker': row['companyTicker'],
+        'dateOfRecord': row['dateOfRecord'],
+        'fiscalYear': row['fiscalYear'],
+        'fiscalQuarter': int(quarter) if quarter is not None and quarter.isdigit() else quarter,
+        'transcript': [json_util.loads(line) for line in row['transcript'] or []],
+    })
+    return doc
+
+
+def export_raw_transcripts(
+    client: MongoClient,
+    archive_dir: str = ARCHIVE_DIR,
+    query: dict = {},
+    batch_size: int = 500
+) -> int:
+    """Snapshots rawTranscripts into a zstd-compressed Parquet dataset
+
+    The snapshot is written next to archive_dir and swapped in once complete,
+    so readers never see a partially written archive.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        archive_dir (str, optional): Archive root. Defaults to ARCHIVE_DIR.
+        query (dict, optional): Filter on rawTranscripts. Defaults to {}.
+        batch_size (int, optional): Documents per written row group. Defaults to 500.
+
+    Returns:
+        int: Number of exported transcripts
+    """
+    staging_dir = archive_dir.rstrip('/') + '.tmp'
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    file_format = ds.ParquetFileFormat()
+    file_options = file_format.make_write_options(compression='zstd')
+
+    collection = client['transcripts']['rawTranscripts']
+    cursor = collection.find(query, batch_size=batch_size)
+    exported = 0
+    rows = []
+
+    def write_batch(batch_index: int) -> None:
+        table = pa.Table.from_pylist(rows, schema=SCHEMA)
+        ds.write_dataset(
+            table,
+            staging_dir,
+            format=file_format,
+            file_options=file_options,
+            partitioning=PARTITIONING,
+            basename_template=f'part-{batch_index}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore'
+        )
+
+    batch_index = 0
+    for doc in cursor:
+        if doc.get('companyTicker') is None or doc.get('fiscalYear') is None:
+            logger.warning(f"Skipping transcript {doc['_id']} without ticker or year")
+            continue
+        rows.append(_to_row(doc))
+        if len(rows) >= batch_size:
+            write_batch(batch_index)
+            exported += len(rows)
+            batch_index += 1
+            rows = []
+    if rows:
+        write_batch(batch_index)
+        exported += len(rows)
+
+    if exported == 0:
+        logger.warning('No transcripts exported, keeping the existing archive')
+        return 0
+    shutil.rmtree(archive_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(archive_dir.rstrip('/')), exist_ok=True)
+    os.replace(staging_dir, archive_dir)
+    logger.info(f'Exported {exported} transcripts to {archive_dir}')
+    return exported
+
+
+class TranscriptArchive:
+    """Reader for the rawTranscripts Parquet archive
+    """
+
+    def __init__(self, archive_dir: str = ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        self.dataset = ds.dataset(
+            archive_dir, format='parquet', partitioning=PARTITIONING)
+
+    def iter_transcripts(
+        self,
+        ticker: str = None,
+        fiscal_year: int = None,
+        fiscal_quarter=None,
+        batch_size: int = 100
+    ) -> Iterator[Dict]:
+        """Iterates archived transcripts as rawTranscripts documents
+
+        Args:
+            ticker (str, optional): Company ticker. Defaults to None.
+            fiscal_year (int, optional): Fiscal year. Defaults to None.
+            fiscal_quarter (optional): Fiscal quarter. Defaults to None.
+            batch_size (int, optional): Rows decoded at a time. Defaults to 100.
+
+        Yields:
+            Dict: Transcript document
+        """
+        expression = None
+        conditions = []
+        if ticker is not None:
+            conditions.append(ds.field('companyTicker') == ticker)
+        if fiscal_year is not None:
+            conditions.append(ds.field('fiscalYear') == int(fiscal_year))
+        if fiscal_quarter is not None:
+            conditions.append(ds.field('fiscalQuarter') == str(fiscal_quarter))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+
+        for batch in self.dataset.to_batches(filter=expression, batch_size=batch_size):
+            for row in batch.to_pylist():
+                yield _from_row(row)
+
+    def find(self, ticker: str = None, fiscal_year: int = None, fiscal_quarter=None) -> List[Dict]:
+        """Gets archived transcripts matching the filters
+
+        Returns:
+            List[Dict]: Transcript documents
+        """
+        return list(self.iter_transcripts(ticker, fiscal_year, fiscal_quarter))
+
+
+def import_raw_transcripts(
+    client: MongoClient,
+    archive_dir: str = ARCHIVE_DIR,
+    db_name: str = 'transcripts',
+    collection_name: str = 'rawTranscripts',
+    batch_size: int = 500
+) -> int:
+    """Loads an archive back into a collection, skipping existing _ids
+
+    Returns:
+        int: Number of inserted transcripts
+    """
+    archive = TranscriptArchive(archive_dir)
+    inserted = 0
+    docs = []
+    for doc in archive.iter_transcripts(batch_size=batch_size):
+        docs.append(doc)
+        if len(docs) >= batch_size:
+            inserted += len(insert_many_into_collection(
+                client, db_name, collection_name, docs))
+            docs = []
+    inserted += len(insert_many_into_collection(
+        client, db_name, collection_name, docs))
+    logger.info(f'Imported {inserted} transcripts into {collection_name}')
+    return inserted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export or import the rawTranscripts Parquet archive')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--collection', default='rawTranscripts',
+                        help='Collection to import into')
+    args = parser.parse_args()
+
+    mongo_client = connect_mongo()
+    if args.command == 'export':
+        export_raw_transcripts(mongo_client, args.archive_dir)
+    else:
+        import_raw_transcripts(
+            mongo_client, args.archive_dir, collection_name=args.collection)
+    mongo_client.close()
@@ -0,0 +1,350 @@
+"""Concurrent transcript fetcher for the discountingcashflows transcript API.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import asyncio
+import json
+import os
+import random
+
+import httpx
+from pymongo import MongoClient
+
+from src.utils.loggers import reg_logger
+from src.utils.mongo_utils import BulkWriter
+from src.utils.transcript_cache import TranscriptCache
+
+
+logger = reg_logger('transcript_fetcher')
+
+TRANSCRIPT_API_URL = os.getenv(
+    'TRANSCRIPT_API_URL', 'https://discountingcashflows.com/api/transcript')
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# longest Retry-After honored, a misbehaving server can ask for hours
+MAX_RETRY_DELAY = 60.0
+CACHE_SOURCE = 'dcf'
+# fields of a transcript entry read by build_raw_transcript_doc
+ENTRY_FIELDS = ('symbol', 'date', 'content')
+
+
+@dataclass
+class FetchResult:
+    ticker: str
+    quarter: str
+    year: int
+    status_code: int = None
+    data: list = None
+    error: str = None
+    attempts: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and bool(self.data)
+
+
+@dataclass
+class FetchStats:
+    fetched: int = 0
+    empty: int = 0
+    failed: int = 0
+    stored: int = 0
+    errors: List[Tuple[str, str, int, str]] = field(default_factory=list)
+
+
+def transcript_url(ticker: str, quarter: str, year: int) -> str:
+    """Builds the transcript API url for a ticker and period
+
+    Args:
+        ticker (str): Company ticker
+        quarter (str): Fiscal quarter, ex: Q1
+        year (int): Fiscal year
+
+    Returns:
+        str: Transcript API url
+    """
+    return f"{TRANSCRIPT_API_URL.rstrip('/')}/{ticker}/{quarter}/{year}/"
+
+
+def build_raw_transcript_doc(ticker: str, quarter: str, year: int, data: Dict) -> Dict:
+    """Builds a rawTranscripts document from a transcript API payload
+
+    Args:
+        ticker (str): Company ticker
+        quarter (str): Fiscal quarter
+        year (int): Fiscal year
+        data (Dict): Single transcript entry returned by the API
+
+    Returns:
+        Dict: Document in the rawTranscripts schema
+    """
+    content = data["content"]
+    if isinstance(content, str):
+        content = content.split('\n')
+    return {
+        "companyName": data["symbol"],
+        "companyTicker": ticker,
+        "dateOfRecord": data["date"],
+        "fiscalYear": year,
+        "fiscalQuarter": quarter,
+        "transcript": content,
+    }
+
+
+def parse_transcript_payload(payload) -> Tuple[list, Optional[str]]:
+    """Splits a transcript API payload into its entries or the error it reports
+
+    The API answers with a list of transcript entries, an empty list when
+    it has no transcript, and an object or entry with an error key when the
+    request failed. An entry without the ENTRY_FIELDS build_raw_transcript_doc
+    reads is reported as an error too.
+
+    Args:
+        payload: Decoded JSON body
+
+    Returns:
+        Tuple[list, Optional[str]]: Transcript entries and the API error, if any
+    """
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list):
+        return [], f"Unexpected payload: {type(payload).__name__}"
+    if not payload:
+        return [], None
+    entry = payload[0]
+    if not isinstance(entry, dict):
+        return [], f"Unexpected entry: {type(entry).__name__}"
+    if "error" in entry:
+        return [], f"API error: {entry['error']}"
+    missing = [key for key in ENTRY_FIELDS if key not in entry]
+    if missing:
+        return [], f"Entry is missing {', '.join(missing)}"
+    return payload, None
+
+
+def _retry_delay(attempt: int, response: Optional[httpx.Response], base_delay: float) -> float:
+    """Exponential backoff with jitter, honoring Retry-After up to MAX_RETRY_DELAY"""
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return min(max(float(retry_after), 0.0), MAX_RETRY_DELAY)
+            except ValueError:
+                pass
+    return min(base_delay * (2 ** attempt), MAX_RETRY_DELAY) * random.uniform(0.5, 1.5)
+
+
+async def fetch_transcript_async(
+    http_client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    ticker: str,
+    quarter: str,
+    year: int,
+    max_retries: int = 5,
+    base_delay: float = 1.0,
+    cache: TranscriptCache = None
+) -> FetchResult:
+    """Fetches a single transcript, retrying on 429/5xx and transport errors
+
+    Args:
+        http_client (httpx.AsyncClient): Pooled HTTP client
+        semaphore (asyncio.Semaphore): Bounds the number of in-flight requests
+        ticker (str): Company ticker
+        quarter (str): Fiscal quarter
+        year (int): Fiscal year
+        max_retries (int, optional): Retries after the first attempt. Defaults to 5.
+        base_delay (float, optional): Base backoff delay in seconds. Defaults to 1.0.
+        cache (TranscriptCache, optional): Raw response cache consulted before the API. Defaults to None.
+
+    Returns:
+        FetchResult: Result holding the parsed payload or the error
+    """
+    result = FetchResult(ticker=ticker, quarter=quarter, year=year)
+    url = transcript_url(ticker, quarter, year)
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, CACHE_SOURCE, ticker, quarter, year)
+        if cached is not None:
+            result.status_code = 200
+            result.data, result.error = parse_transcript_payload(json.loads(cached))
+            return result
+        if cache.offline:
+            result.error = 'Not cached and cache is offline'
+            return result
+    for attempt in range(max_retries + 1):
+        result.attempts = attempt + 1
+        response = None
+        try:
+            async with semaphore:
+                response = await http_client.get(url)
+            result.status_code = response.status_code
+            if response.status_code == 200:
+                try:
+                    payload = response.json()
+                except ValueError as exc:
+                    # the same body would come back, retrying does not help
+                    result.error = f"Malformed payload: {exc}"
+                    return result
+                result.data, result.error = parse_transcript_payload(payload)
+                if cache is not None and result.data:
+                    await asyncio.to_thread(
+                        cache.put, CACHE_SOURCE, ticker, quarter, year, response.content, url)
+                return result
+            result.error = f"Failed to fetch data: {response.status_code}"
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return result
+        except httpx.TransportError as exc:
+            result.error = f"{exc.__class__.__name__}: {exc}"
+        if attempt < max_retries:
+            delay = _retry_delay(attempt, response, base_delay)
+            logger.debug(
+                f'retrying {ticker} {quarter} {year} in {delay:.2f}s ({result.error})')
+            await asyncio.sleep(delay)
+    return result
+
+
+def store_transcripts(client: MongoClient, docs: List[Dict]) -> int:
+    """Upserts raw transcripts with a BulkWriter
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        docs (List[Dict]): Documents built by build_raw_transcript_doc
+
+    Returns:
+        int: Number of inserted or modified documents
+    """
+    if not docs:
+        return 0
+    now = datetime.now()
+    with BulkWriter(client, 'transcripts', 'rawTranscripts', batch_size=len(docs)) as writer:
+        for doc in docs:
+            writer.upsert(
+                {
+                    "companyTicker": doc["companyTicker"],
+                    "fiscalYear": doc["fiscalYear"],
+                    "fiscalQuarter": doc["fiscalQuarter"]
+                },
+                {
+                    "$set": {**doc, "updatedAt": now},
+                    "$setOnInsert": {"createdAt": now, "__v": 0}
+                }
+            )
+    return writer.stats.upserted + writer.stats.modified
+
+
+def record_misses(client: MongoClient, keys: List[Tuple[str, str, int]]) -> None:
+    """Records keys the API returned no transcript for so planners can skip them
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        keys (List[Tuple[str, str, int]]): (ticker, quarter, year) keys
+    """
+    if not keys:
+        return
+    now = datetime.now()
+    with BulkWriter(client, 'transcripts', 'transcriptMisses') as writer:
+        for ticker, quarter, year in keys:
+            writer.upsert(
+                {"companyTicker": ticker, "fiscalYear": year, "fiscalQuarter": quarter},
+                {"$set": {"checkedAt": now}}
+            )
+
+
+async def fetch_and_store_transcripts(
+    client: MongoClient,
+    keys: Iterable[Tuple[str, str, int]],
+    concurrency: int = 16,
+    batch_size: int = 100,
+    max_retries: int = 5,
+    timeout: float = 30.0,
+    cache: TranscriptCache = None
+) -> FetchStats:
+    """Fetches transcripts concurrently and writes them to rawTranscripts in batches
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        keys (Iterable[Tuple[str, str, int]]): (ticker, quarter, year) keys to fetch
+        concurrency (int, optional): Maximum in-flight requests. Defaults to 16.
+        batch_size (int, optional): Documents per bulk write. Defaults to 100.
+        max_retries (int, optional): Retries per request. Defaults to 5.
+        timeout (float, optional): Per-request timeout in seconds. Defaults to 30.0.
+        cache (TranscriptCache, optional): Raw response cache consulted before the API. Defaults to None.
+
+    Returns:
+        FetchStats: Aggregate counts and failed keys
+    """
+    stats = FetchStats()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    pending_docs = []
+    missed_keys = []
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as http_client:
+        tasks = [
+            asyncio.create_task(fetch_transcript_async(
+                http_client, semaphore, ticker, quarter, year,
+                max_retries=max_retries, cache=cache))
+            for ticker, quarter, year in keys
+        ]
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            if result.error is None and result.data:
+                try:
+                    doc = build_raw_transcript_doc(
+                        result.ticker, result.quarter, result.year, result.data[0])
+                except (KeyError, TypeError, AttributeError) as exc:
+                    result.error = f"Malformed entry: {exc.__class__.__name__}: {exc}"
+            if result.error is not None:
+                stats.failed += 1
+                stats.errors.append(
+                    (result.ticker, result.quarter, result.year, result.error))
+                logger.warning(
+                    f'{result.ticker} {result.quarter} {result.year}: {result.error}')
+                continue
+            if not result.data:
+                stats.empty += 1
+                missed_keys.append((result.ticker, result.quarter, result.year))
+                logger.info(
+                    f'no transcript for {result.ticker} {result.quarter} {result.year}')
+                continue
+            stats.fetched += 1
+            pending_docs.append(doc)
+            if len(pending_docs) >= batch_size:
+                stats.stored += await asyncio.to_thread(store_transcripts, client, pending_docs)
+                pending_docs = []
+
+    stats.stored += await asyncio.to_thread(store_transcripts, client, pending_docs)
+    await asyncio.to_thread(record_misses, client, missed_keys)
+    logger.info(
+        f'fetched {stats.fetched}, empty {stats.empty}, failed {stats.failed}, stored {stats.stored}')
+    return stats
+
+
+def rebuild_from_cache(client: MongoClient, cache: TranscriptCache, batch_size: int = 100) -> int:
+    """Rebuilds rawTranscripts from cached API responses without network access
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        cache (TranscriptCache): Raw response cache
+        batch_size (int, optional): Documents per bulk write. Defaults to 100.
+
+    Returns:
+        int: Number of inserted or modified documents
+    """
+    stored = 0
+    docs = []
+    for entry in cache.entries(CACHE_SOURCE):
+        body = cache.get(CACHE_SOURCE, entry['ticker'],
+                         entry['quarter'], entry['year'])
+        data = parse_transcript_payload(json.loads(body))[0] if body is not None else None
+        if not data:
+            continue
+        docs.append(build_raw_transcript_doc(
+            entry['ticker'], entry['quarter'], entry['year'], data[0]))
+        if len(docs) >= batch_size:
+            stored += store_transcripts(client, docs)
+            docs = []
+    stored += store_transcripts(client, docs)
+    logger.info(f'rebuilt {stored} transcripts from cache')
+    return stored
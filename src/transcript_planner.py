@@ -0,0 +1,104 @@
+"""Plans transcript pulls by diffing the requested universe against rawTranscripts.
+
+Universe membership comes from src.universe.
+"""
+from datetime import datetime, timedelta
+from typing import Iterable, List, Set, Tuple
+
+from pymongo import MongoClient
+
+from src.utils.loggers import reg_logger
+
+
+logger = reg_logger('transcript_planner')
+
+
+def normalize_quarter(quarter) -> str:
+    """Normalizes a fiscal quarter to the API format
+
+    Args:
+        quarter (str | int): Quarter as stored, ex: 2, '2' or 'Q2'
+
+    Returns:
+        str: Quarter in the 'Q2' format
+    """
+    quarter = str(quarter).strip().upper()
+    return quarter if quarter.startswith('Q') else f'Q{quarter}'
+
+
+def get_present_keys(client: MongoClient) -> Set[Tuple[str, int, str]]:
+    """Gets the (ticker, year, quarter) keys already stored in rawTranscripts
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+
+    Returns:
+        Set[Tuple[str, int, str]]: Keys of stored transcripts
+    """
+    pipeline = [
+        {'$group': {'_id': {
+            'ticker': '$companyTicker',
+            'year': '$fiscalYear',
+            'quarter': '$fiscalQuarter'
+        }}}
+    ]
+    collection = client['transcripts']['rawTranscripts']
+    present = set()
+    for doc in collection.aggregate(pipeline, allowDiskUse=True):
+        key = doc['_id']
+        if key.get('ticker') is None or key.get('year') is None or key.get('quarter') is None:
+            continue
+        present.add((key['ticker'], int(key['year']),
+                    normalize_quarter(key['quarter'])))
+    logger.info(f'Found {len(present)} stored transcripts')
+    return present
+
+
+def get_recent_misses(client: MongoClient, max_age_days: int = 7) -> Set[Tuple[str, int, str]]:
+    """Gets keys the API recently reported as having no transcript
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        max_age_days (int, optional): How long a miss suppresses refetching. Defaults to 7.
+
+    Returns:
+        Set[Tuple[str, int, str]]: Keys checked within max_age_days
+    """
+    collection = client['transcripts']['transcriptMisses']
+    cutoff = datetime.now() - timedelta(days=max_age_days)
+    misses = {
+        (doc['companyTicker'], int(doc['fiscalYear']),
+         normalize_quarter(doc['fiscalQuarter']))
+        for doc in collection.find({'checkedAt': {'$gte': cutoff}}, {'_id': 0})
+    }
+    logger.info(f'Skipping {len(misses)} recently missed transcripts')
+    return misses
+
+
+def plan_missing(
+    present: Set[Tuple[str, int, str]],
+    tickers: Iterable[str],
+    quarters: Iterable,
+    years: Iterable[int]
+) -> List[Tuple[str, str, int]]:
+    """Diffs the requested universe against the stored keys
+
+    Args:
+        present (Set[Tuple[str, int, str]]): Keys from get_present_keys
+        tickers (Iterable[str]): Requested tickers
+        quarters (Iterable): Requested quarters
+        years (Iterable[int]): Requested fiscal years
+
+    Returns:
+        List[Tuple[str, str, int]]: Missing (ticker, quarter, year) keys in fetcher order
+    """
+    quarters = [normalize_quarter(quarter) for quarter in quarters]
+    missing = [
+        (ticker, quarter, year)
+        for year in years
+        for quarter in quarters
+        for ticker in tickers
+        if (ticker, int(year), quarter) not in present
+    ]
+    logger.info(f'{len(missing)} transcripts missing')
+    return missing
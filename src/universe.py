@@ -0,0 +1,275 @@
+"""Ticker universes: sources, incremental sync and cached membership.
+
+Universes are stored one collection per universe in the tickers database
+with the symbol as _id. A sync diffs the source against the stored members
+and only writes additions, removals and changed fields. Members written by
+the old scrapers, keyed by ObjectId with the symbol in d_id, are re-keyed
+by the first sync and read by their d_id until then.
+"""
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+import argparse
+import os
+import time
+
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+
+from src.utils.loggers import BASE_DIR, reg_logger
+from src.utils.mongo_utils import BulkWriter, connect_mongo
+
+
+logger = reg_logger('universe')
+
+DB_NAME = 'tickers'
+UNIVERSES = ('sp500', 'all_tickers', 'oef')
+OEF_HOLDINGS_PATH = os.path.join(BASE_DIR, 'scrapers', 'OEF_holdings.txt')
+CACHE_TTL = float(os.getenv('UNIVERSE_CACHE_TTL', 3600))
+# members written by the old scrapers have an ObjectId _id and the symbol here
+LEGACY_SYMBOL_FIELD = 'd_id'
+# share of stored members a sync may remove before it is refused as a truncated source
+MAX_REMOVED_FRACTION = 0.2
+
+_cache: Dict[str, tuple] = {}
+
+
+class UnsafeSyncError(Exception):
+    """Exceptions for syncs refused because the source looks empty or truncated
+    """
+
+
+@dataclass
+class SyncResult:
+    universe: str
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    updated: List[str] = field(default_factory=list)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.removed or self.updated)
+
+
+def _finnhub_client():
+    import finnhub
+
+    return finnhub.Client(api_key=os.getenv('FINNHUB_API_KEY'))
+
+
+def fetch_sp500() -> Dict[str, Dict]:
+    """Gets S&P 500 constituents and weights from Finnhub"""
+    constituents = _finnhub_client().indices_const(symbol="^GSPC")
+    return {company['symbol']: {'name': company['name'], 'weight': company['weight']}
+            for company in constituents['constituentsBreakdown']}
+
+
+def fetch_all_tickers() -> Dict[str, Dict]:
+    """Gets every US listed symbol from Finnhub"""
+    return {company['symbol']: {'name': company['description'], 'type': company['type']}
+            for company in _finnhub_client().stock_symbols(exchange='US')}
+
+
+def read_oef_holdings(path: str = OEF_HOLDINGS_PATH) -> Dict[str, Dict]:
+    """Reads the OEF holdings flat file
+
+    Args:
+        path (str, optional): Path to the holdings file. Defaults to OEF_HOLDINGS_PATH.
+
+    Returns:
+        Dict[str, Dict]: Holdings tickers, without fields
+    """
+    with open(path) as file:
+        return {line.strip().upper(): {} for line in file if line.strip()}
+
+
+SOURCES = {
+    'sp500': fetch_sp500,
+    'all_tickers': fetch_all_tickers,
+    'oef': read_oef_holdings,
+}
+
+
+def diff_universe(stored: Dict[str, Dict], source: Dict[str, Dict]) -> SyncResult:
+    """Diffs source members against stored members
+
+    Args:
+        stored (Dict[str, Dict]): Stored fields per symbol
+        source (Dict[str, Dict]): Source fields per symbol
+
+    Returns:
+        SyncResult: Added, removed and updated symbols
+    """
+    result = SyncResult(universe=None)
+    result.added = sorted(set(source) - set(stored))
+    result.removed = sorted(set(stored) - set(source))
+    result.updated = sorted(
+        symbol for symbol in set(source) & set(stored)
+        if any(stored[symbol].get(key) != value for key, value in source[symbol].items())
+    )
+    return result
+
+
+def _member_symbol(doc: Dict) -> Optional[str]:
+    symbol = doc.get(LEGACY_SYMBOL_FIELD) if isinstance(doc['_id'], ObjectId) else doc['_id']
+    return str(symbol).strip().upper() if symbol else None
+
+
+def migrate_legacy_members(client: MongoClient, name: str) -> int:
+    """Re-keys members stored by the old scrapers by their symbol
+
+    Their fields only fill in symbols that are not stored under the new key
+    yet, then the legacy documents are deleted.
+
+    Returns:
+        int: Number of legacy documents migrated
+    """
+    collection = client[DB_NAME][name]
+    legacy = list(collection.find({'_id': {'$type': 'objectId'}}))
+    if not legacy:
+        return 0
+    operations = [
+        UpdateOne(
+            {'_id': _member_symbol(doc)},
+            {'$setOnInsert': {'_id': _member_symbol(doc),
+                              **{key: value for key, value in doc.items()
+                                 if key not in ('_id', LEGACY_SYMBOL_FIELD)}}},
+            upsert=True)
+        for doc in legacy if _member_symbol(doc)
+    ]
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    collection.delete_many({'_id': {'$in': [doc['_id'] for doc in legacy]}})
+    invalidate(name)
+    logger.info(f'{name}: migrated {len(legacy)} legacy members to symbol keys')
+    return len(legacy)
+
+
+def sync_universe(
+    client: MongoClient,
+    name: str,
+    source: Dict[str, Dict] = None,
+    force: bool = False,
+    max_removed_fraction: float = MAX_REMOVED_FRACTION
+) -> SyncResult:
+    """Applies the difference between a universe source and its collection
+
+    A failed or partial fetch looks like a universe that lost its members,
+    so unless forced, a sync from an empty source or one that would remove
+    more than max_removed_fraction of the stored members writes nothing.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        name (str): Universe name
+        source (Dict[str, Dict], optional): Members to sync, fetched from SOURCES when None. Defaults to None.
+        force (bool, optional): Apply the sync whatever it removes. Defaults to False.
+        max_removed_fraction (float, optional): Largest share of members a sync may remove. Defaults to MAX_REMOVED_FRACTION.
+
+    Raises:
+        UnsafeSyncError: The source is empty or would remove too many members
+
+    Returns:
+        SyncResult: Applied changes
+    """
+    if name not in UNIVERSES:
+        raise ValueError(f'Unknown universe {name}')
+    source = SOURCES[name]() if source is None else source
+    collection = client[DB_NAME][name]
+    migrate_legacy_members(client, name)
+    stored = {doc.pop('_id'): doc for doc in collection.find({})}
+    result = diff_universe(stored, source)
+    result.universe = name
+    if not force and stored:
+        if not source:
+            raise UnsafeSyncError(f'{name}: source is empty, refusing to remove all {len(stored)} members')
+        if len(result.removed) / len(stored) > max_removed_fraction:
+            raise UnsafeSyncError(
+                f'{name}: sync would remove {len(result.removed)} of {len(stored)} members, '
+                f'more than {max_removed_fraction:.0%}; pass force to apply it')
+
+    if result.added or result.updated:
+        with BulkWriter(client, DB_NAME, name) as writer:
+            for symbol in result.added + result.updated:
+                writer.upsert({'_id': symbol}, {'$set': source[symbol]})
+    if result.removed:
+        collection.delete_many({'_id': {'$in': result.removed}})
+    invalidate(name)
+    logger.info(f'{name}: {len(result.added)} added, {len(result.removed)} removed, '
+                f'{len(result.updated)} updated, {len(source)} members')
+    return result
+
+
+def invalidate(name: str = None) -> None:
+    """Drops cached members of one universe, or of all of them"""
+    if name is None:
+        _cache.clear()
+    else:
+        _cache.pop(name, None)
+
+
+def get_members(client: MongoClient, name: str, max_age: float = CACHE_TTL) -> FrozenSet[str]:
+    """Gets the members of a universe, cached in memory for max_age seconds
+
+    OEF falls back to its holdings file until it has been synced.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        name (str): Universe name
+        max_age (float, optional): Cache lifetime in seconds. Defaults to CACHE_TTL.
+
+    Returns:
+        FrozenSet[str]: Member symbols
+    """
+    if name not in UNIVERSES:
+        raise ValueError(f'Unknown universe {name}')
+    cached = _cache.get(name)
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+    symbols = (_member_symbol(doc)
+               for doc in client[DB_NAME][name].find({}, {'_id': 1, LEGACY_SYMBOL_FIELD: 1}))
+    members = frozenset(symbol for symbol in symbols if symbol)
+    if not members and name == 'oef':
+        members = frozenset(read_oef_holdings())
+    _cache[name] = (time.monotonic(), members)
+    return members
+
+
+def load_universe(client: MongoClient, names: Iterable[str]) -> List[str]:
+    """Loads the union of the named ticker universes
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        names (Iterable[str]): Universe names, any of sp500, all_tickers or oef
+
+    Returns:
+        List[str]: Sorted, de-duplicated tickers
+    """
+    names = list(names)
+    tickers = set()
+    for name in names:
+        tickers.update(get_members(client, name))
+    logger.info(f'Loaded {len(tickers)} tickers from {names}')
+    return sorted(tickers)
+
+
+def is_member(client: MongoClient, ticker: str, names: Iterable[str] = UNIVERSES) -> bool:
+    """Checks membership against the cached universes"""
+    ticker = ticker.strip().upper()
+    return any(ticker in get_members(client, name) for name in names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Sync ticker universes into the tickers database')
+    parser.add_argument('universes', nargs='*', help=f'Any of {", ".join(UNIVERSES)}, defaults to all')
+    parser.add_argument('--force', action='store_true',
+                        help='Apply syncs that empty a universe or remove many members')
+    args = parser.parse_args()
+
+    mongo_client = connect_mongo()
+    for universe in args.universes or UNIVERSES:
+        try:
+            sync_universe(mongo_client, universe, force=args.force)
+        except UnsafeSyncError as exc:
+            logger.error(exc)
+    mongo_client.close()
@@ -0,0 +1,238 @@
+"""Retry policy and circuit breaker for async provider calls
+
+Retries use exponential backoff with full jitter, so concurrent callers
+that fail together spread their retries out instead of retrying in lock
+step. A 429 with a Retry-After header waits at least that long. Every call
+has a deadline covering all of its attempts.
+
+A circuit breaker per key (the model name for OpenAI calls) opens after
+consecutive retryable failures. While it is open, calls fail immediately
+with CircuitOpenError instead of adding load to a provider that is down.
+After reset_timeout a single probe call is let through; its result closes
+or re-opens the circuit.
+"""
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from functools import wraps
+from typing import Callable, Dict, Optional
+
+import asyncio
+import datetime
+import random
+import threading
+import time
+
+import openai
+
+from src.utils.loggers import reg_logger
+
+
+logger = reg_logger('async_retry')
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Exceptions for calls rejected by an open circuit breaker
+    """
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Reads the server requested delay from an error response
+
+    Returns:
+        Optional[float]: Delay in seconds, None when the response has no usable header
+    """
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.datetime.now(when.tzinfo)).total_seconds())
+
+
+@dataclass
+class RetryPolicy:
+    """Backoff and deadline settings for retried calls
+    """
+    max_attempts: int = 6
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    deadline: float = 180.0
+
+    def is_retryable(self, exc: BaseException) -> bool:
+        """Timeouts, connection errors, rate limits and 5xx are retryable, other errors are fatal"""
+        if isinstance(exc, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        if isinstance(exc, openai.APIStatusError):
+            return exc.status_code in RETRYABLE_STATUS_CODES or exc.status_code >= 500
+        return False
+
+    def delay(self, attempt: int, exc: BaseException = None) -> float:
+        """Full jitter backoff for the given 0-based attempt, at least the Retry-After of exc"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        requested = retry_after(exc) if exc is not None else None
+        if requested is not None:
+            delay = max(delay, min(requested, self.max_delay))
+        return delay
+
+
+class CircuitBreaker:
+    """Consecutive failure circuit breaker
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def before_call(self) -> None:
+        """Raises CircuitOpenError unless the call may go through"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half_open' and not self._probing:
+                self._probing = True
+                return
+        raise CircuitOpenError(f'Circuit for {self.name} is open')
+
+    def abandon_call(self) -> None:
+        """Frees the half-open probe slot of a call that ended without a result, ex: cancelled"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f'Circuit for {self.name} closed')
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._probing:
+                    logger.warning(
+                        f'Circuit for {self.name} opened after {self.failures} failures')
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str, **kwargs) -> CircuitBreaker:
+    """Gets the process-wide circuit breaker for a key, creating it on first use"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **kwargs)
+        return _breakers[name]
+
+
+async def call_with_retry(
+    func: Callable,
+    *args,
+    policy: RetryPolicy = None,
+    breaker: CircuitBreaker = None,
+    **kwargs
+):
+    """Awaits func(*args, **kwargs) under a retry policy and circuit breaker
+
+    Args:
+        func (Callable): Coroutine function
+        policy (RetryPolicy, optional): Retry settings. Defaults to RetryPolicy().
+        breaker (CircuitBreaker, optional): Breaker guarding the call. Defaults to None.
+
+    Raises:
+        CircuitOpenError: The breaker is open
+        Exception: The last error once it is fatal, attempts run out or the deadline passes
+
+    Returns:
+        The result of func
+    """
+    policy = policy or RetryPolicy()
+    deadline = time.monotonic() + policy.deadline
+    attempt = 0
+    while True:
+        if breaker is not None:
+            breaker.before_call()
+        remaining = deadline - time.monotonic()
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), timeout=max(remaining, 0.001))
+        except Exception as exc:
+            retryable = policy.is_retryable(exc)
+            if breaker is not None:
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    # a fatal error still means the provider answered
+                    breaker.record_success()
+            attempt += 1
+            if not retryable or attempt >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempt - 1, exc)
+            if time.monotonic() + delay >= deadline:
+                logger.warning(f'{func.__qualname__}: deadline reached after {attempt} attempts')
+                raise
+            logger.warning(
+                f'{func.__qualname__} failed ({type(exc).__name__}), '
+                f'retry {attempt} in {delay:.2f}s')
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # cancelled, the half-open probe slot must not stay taken
+            if breaker is not None:
+                breaker.abandon_call()
+            raise
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
+def async_retry(policy: RetryPolicy = None, breaker_key: Callable[..., str] = None):
+    """Decorator form of call_with_retry
+
+    Args:
+        policy (RetryPolicy, optional): Retry settings. Defaults to RetryPolicy().
+        breaker_key (Callable[..., str], optional): Called with the call's arguments,
+            returns the circuit breaker key. Defaults to no breaker.
+    """
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            breaker = get_breaker(breaker_key(*args, **kwargs)) if breaker_key else None
+            return await call_with_retry(func, *args, policy=policy, breaker=breaker, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,171 @@
+"""OpenAI pricing and spend budgets
+"""
+from typing import Optional
+
+import multiprocessing
+import os
+import threading
+
+from src.utils.loggers import reg_logger
+
+
+logger = reg_logger('costs')
+
+# USD per token
+PER_TOKEN_COST = {
+    'gpt-4-0125-preview': {
+        'input': 0.00001,
+        'output': 0.00003
+    },
+    'gpt-4-1106-preview': {
+        'input': 0.00001,
+        'output': 0.00003
+    },
+    'gpt-4': {
+        'input': 0.00003,
+        'output': 0.00006
+    },
+    'gpt-4-0613': {
+        'input': 0.00003,
+        'output': 0.00006
+    },
+    'gpt-4-32k': {
+        'input': 0.00006,
+        'output': 0.00012,
+    },
+    'gpt-3.5-turbo': {
+        'input': 0.0000015,
+        'output': 0.000002,
+    },
+    'gpt-3.5-turbo-0613': {
+        'input': 0.0000015,
+        'output': 0.000002,
+    },
+    'gpt-3.5-turbo-16k': {
+        'input': 0.000003,
+        'output': 0.000004,
+    },
+    'text-embedding-3-small': {
+        'input': 0.00000002,
+        'output': 0.0,
+    },
+    'text-embedding-3-large': {
+        'input': 0.00000013,
+        'output': 0.0,
+    },
+    'text-embedding-ada-002': {
+        'input': 0.0000001,
+        'output': 0.0,
+    },
+}
+
+
+def token_cost(model: str, prompt_tokens: int, completion_tokens: int = 0) -> Optional[float]:
+    """Cost of a call in USD
+
+    Args:
+        model (str): OpenAI model
+        prompt_tokens (int): Input tokens
+        completion_tokens (int, optional): Output tokens. Defaults to 0.
+
+    Returns:
+        Optional[float]: Cost, None for models missing from PER_TOKEN_COST
+    """
+    if model not in PER_TOKEN_COST:
+        return None
+    return prompt_tokens * PER_TOKEN_COST[model]['input'] + \
+        completion_tokens * PER_TOKEN_COST[model]['output']
+
+
+class BudgetExceededError(Exception):
+    """Exceptions for runs whose actual spend passed their budget
+    """
+
+
+class CostBudget:
+    """Cumulative spend with a hard limit, shared by every session of a run
+
+    Spend is kept in shared memory, so a budget handed to pool workers through
+    their initializer is shared by all of them.
+    """
+
+    def __init__(self, limit: float, context=None):
+        context = context or multiprocessing.get_context()
+        self.limit = limit
+        self._spent = context.RawValue('d', 0.0)
+        self._calls = context.RawValue('i', 0)
+        self._lock = context.Lock()
+
+    @property
+    def spent(self) -> float:
+        return self._spent.value
+
+    @property
+    def calls(self) -> int:
+        return self._calls.value
+
+    @classmethod
+    def from_env(cls) -> Optional['CostBudget']:
+        """Budget from OPENAI_BUDGET_USD, None when it is not set"""
+        limit = os.getenv('OPENAI_BUDGET_USD')
+        return cls(float(limit)) if limit else None
+
+    @property
+    def remaining(self) -> float:
+        return self.limit - self.spent
+
+    def check(self, model: str = None) -> None:
+        """Raises BudgetExceededError once the budget is spent, or when model has no price"""
+        if model is not None and model not in PER_TOKEN_COST:
+            raise BudgetExceededError(
+                f'{model} is missing from PER_TOKEN_COST, its calls cannot be held to the budget')
+        if self.spent >= self.limit:
+            raise BudgetExceededError(
+                f'Spent ${self.spent:.4f} of the ${self.limit:.2f} budget')
+
+    def charge(self, cost: Optional[float], model: str = None) -> None:
+        """Adds the actual cost of a finished call
+
+        A call that could not be priced fails closed rather than being
+        counted as free.
+
+        Args:
+            cost (Optional[float]): Cost from token_cost, None when the model has no price
+            model (str, optional): Model of the call, for the error message. Defaults to None.
+
+        Raises:
+            BudgetExceededError: Spend passed the limit, or the call has no price
+        """
+        with self._lock:
+            self._calls.value += 1
+            if cost:
+                self._spent.value += cost
+        if cost is None:
+            logger.error(f'No price for {model or "an unknown model"}, spend can no longer be tracked, '
+                         f'add it to PER_TOKEN_COST')
+            raise BudgetExceededError(
+                f'{model or "Unknown model"} is missing from PER_TOKEN_COST, its calls cannot be held to the budget')
+        if self.spent > self.limit:
+            logger.error(f'Budget exceeded: ${self.spent:.4f} of ${self.limit:.2f} '
+                         f'after {self.calls} calls')
+        self.check()
+
+
+_default_budget = None
+_default_budget_lock = threading.Lock()
+
+
+def default_budget() -> Optional[CostBudget]:
+    """Process-wide budget from OPENAI_BUDGET_USD, created on first use"""
+    global _default_budget
+    with _default_budget_lock:
+        if _default_budget is None:
+            _default_budget = CostBudget.from_env()
+        return _default_budget
+
+
+def set_default_budget(budget: Optional[CostBudget]) -> None:
+    """Sets the budget sessions of this process use by default, ex: a pool worker's shared budget"""
+    global _default_budget
+    with _default_budget_lock:
+        _default_budget = budget
@@ -0,0 +1,193 @@
+"""Packed binary storage for embedding vectors
+
+Embeddings are stored as BSON Binary values holding a 16 byte header
+followed by the little-endian vector payload:
+
+    magic (4s) | dtype code (B) | padding (3x) | dim (I) | scale (f)
+
+int8 payloads are symmetric scalar quantized, the stored value times
+scale recovers the float vector. Documents written before this format
+hold a plain list of doubles and are still accepted by every reader here.
+"""
+from dataclasses import dataclass
+from typing import Iterable, Union
+
+import os
+import struct
+
+import numpy as np
+from bson.binary import Binary
+
+
+MAGIC = b'EMB1'
+HEADER = struct.Struct('<4sBxxxIf')
+DTYPE_CODES = {
+    'float32': 1,
+    'float16': 2,
+    'int8': 3,
+}
+CODE_DTYPES = {code: np.dtype(name).newbyteorder('<')
+               for name, code in DTYPE_CODES.items()}
+
+
+class EmbeddingFormatError(Exception):
+    """Exceptions for malformed embedding payloads
+    """
+
+
+def encode_embedding(vector: Iterable[float], dtype: str = 'float32') -> Binary:
+    """Packs an embedding into a BSON Binary value
+
+    Args:
+        vector (Iterable[float]): Embedding vector
+        dtype (str, optional): Storage dtype, float32, float16 or int8. Defaults to 'float32'.
+
+    Returns:
+        Binary: Header followed by the little-endian payload
+    """
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported embedding dtype {dtype}")
+    scale = 1.0
+    if dtype == 'int8':
+        vector = np.asarray(vector, dtype=np.float32)
+        max_abs = float(np.max(np.abs(vector))) if vector.size else 0.0
+        scale = max_abs / 127 if max_abs > 0 else 1.0
+        array = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+    else:
+        array = np.asarray(vector, dtype=CODE_DTYPES[DTYPE_CODES[dtype]])
+    header = HEADER.pack(MAGIC, DTYPE_CODES[dtype], array.shape[0], scale)
+    return Binary(header + array.tobytes())
+
+
+def read_header(value: bytes) -> tuple:
+    """Reads the header of a packed embedding
+
+    Returns:
+        tuple: (numpy dtype, dim, scale)
+    """
+    if len(value) < HEADER.size:
+        raise EmbeddingFormatError("Embedding payload is shorter than its header")
+    magic, code, dim, scale = HEADER.unpack_from(value)
+    if magic != MAGIC or code not in CODE_DTYPES:
+        raise EmbeddingFormatError("Unrecognized embedding header")
+    dtype = CODE_DTYPES[code]
+    if len(value) != HEADER.size + dim * dtype.itemsize:
+        raise EmbeddingFormatError("Embedding payload does not match its header")
+    return dtype, dim, scale
+
+
+def decode_embedding(value: Union[bytes, list]) -> np.ndarray:
+    """Decodes a stored embedding into a float32 vector
+
+    Args:
+        value (Union[bytes, list]): Packed Binary value or legacy list of doubles
+
+    Returns:
+        np.ndarray: float32 vector
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        dtype, dim, scale = read_header(value)
+        vector = np.frombuffer(value, dtype=dtype, count=dim, offset=HEADER.size)
+        if dtype == np.int8:
+            return vector.astype(np.float32) * np.float32(scale)
+        return vector.astype(np.float32, copy=False)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _stored_width(value: Union[bytes, list]) -> int:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return read_header(value)[1]
+    return len(value)
+
+
+def stack_embeddings(values: Iterable[Union[bytes, list]], dim: int = None) -> np.ndarray:
+    """Stacks stored embeddings into one (n, dim) float32 matrix
+
+    When every value is packed with the same dtype and dimension, the
+    payloads are joined and read with a single np.frombuffer call, and
+    int8 rows are rescaled with one broadcast multiply.
+
+    Args:
+        values (Iterable[Union[bytes, list]]): Packed Binary values or legacy lists
+        dim (int, optional): Width of the matrix returned when values is empty. Defaults to 0.
+
+    Returns:
+        np.ndarray: float32 matrix with one row per embedding
+    """
+    values = list(values)
+    if not values:
+        return np.empty((0, dim or 0), dtype=np.float32)
+    if all(isinstance(value, (bytes, bytearray)) for value in values):
+        # dtype code and dim live in bytes 4-12, the scale may differ per row
+        layouts = {bytes(value[4:12]) for value in values}
+        if len(layouts) == 1:
+            dtype, dim, _ = read_header(values[0])
+            payload = b''.join(memoryview(value)[HEADER.size:] for value in values)
+            matrix = np.frombuffer(payload, dtype=dtype).reshape(len(values), dim)
+            if dtype == np.int8:
+                scales = np.array([HEADER.unpack_from(value)[3] for value in values],
+                                  dtype=np.float32)
+                return matrix.astype(np.float32) * scales[:, None]
+            return matrix.astype(np.float32, copy=False)
+    return np.vstack([decode_embedding(value) for value in values])
+
+
+def truncate_embeddings(matrix: np.ndarray, dimensions: int) -> np.ndarray:
+    """Shortens embeddings to their first dimensions and re-normalizes them
+
+    text-embedding-3 models are trained so a prefix of the vector is itself
+    a usable embedding, which is what the API returns when dimensions is set.
+
+    Args:
+        matrix (np.ndarray): Matrix of shape (n, dim)
+        dimensions (int): Target dimension
+
+    Returns:
+        np.ndarray: float32 matrix of shape (n, dimensions)
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dimensions is None or matrix.shape[1] <= dimensions:
+        return matrix
+    truncated = matrix[:, :dimensions]
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return truncated / norms
+
+
+@dataclass
+class EmbeddingProfile:
+    """Embedding request and storage settings shared by writers and matchers
+    """
+    model: str = 'text-embedding-3-small'
+    dimensions: int = None
+    storage_dtype: str = 'float32'
+
+    @classmethod
+    def from_env(cls) -> 'EmbeddingProfile':
+        """Builds the profile from EMBEDDING_MODEL, EMBEDDING_DIMENSIONS and EMBEDDING_STORAGE_DTYPE
+        """
+        dimensions = os.getenv('EMBEDDING_DIMENSIONS')
+        return cls(
+            model=os.getenv('EMBEDDING_MODEL', cls.model),
+            dimensions=int(dimensions) if dimensions else None,
+            storage_dtype=os.getenv('EMBEDDING_STORAGE_DTYPE', cls.storage_dtype)
+        )
+
+    def encode(self, vector: Iterable[float]) -> Binary:
+        """Packs an embedding returned for this profile"""
+        return encode_embedding(vector, self.storage_dtype)
+
+    def prepare(self, values: Iterable[Union[bytes, list]]) -> np.ndarray:
+        """Decodes stored embeddings into a matrix comparable under this profile
+
+        Vectors stored at a larger size than the profile requests are
+        truncated, so documents written under an older profile stay usable,
+        also when they are mixed with documents written under this one.
+        """
+        values = list(values)
+        widths = {_stored_width(value) for value in values}
+        if len(widths) > 1 and self.dimensions is not None:
+            # rows differ in width, bring each one to the profile before stacking
+            return np.vstack([truncate_embeddings(decode_embedding(value)[None, :], self.dimensions)
+                              for value in values])
+        return truncate_embeddings(stack_embeddings(values, self.dimensions), self.dimensions)
@@ -0,0 +1,147 @@
+"""Hedged requests for tail latency
+
+A hedged call starts the request, and if it has not returned after the
+observed latency percentile for its key, starts a duplicate and keeps
+whichever finishes first. Hedges are limited to a fraction of calls so
+the extra spend stays bounded.
+"""
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+
+import asyncio
+import os
+import threading
+import time
+
+import numpy as np
+
+from src.utils.loggers import reg_logger
+
+
+logger = reg_logger('hedging')
+
+
+@dataclass
+class HedgePolicy:
+    """When to hedge and how much hedging is allowed
+    """
+    enabled: bool = False
+    percentile: float = 95.0
+    min_samples: int = 20
+    min_delay: float = 1.0
+    max_hedge_ratio: float = 0.1
+
+    @classmethod
+    def from_env(cls) -> 'HedgePolicy':
+        """Builds the policy from OPENAI_HEDGE_PERCENTILE and OPENAI_HEDGE_MAX_RATIO
+
+        Hedging is enabled when OPENAI_HEDGE_PERCENTILE is set.
+        """
+        percentile = os.getenv('OPENAI_HEDGE_PERCENTILE')
+        return cls(
+            enabled=percentile is not None,
+            percentile=float(percentile) if percentile else cls.percentile,
+            max_hedge_ratio=float(os.getenv('OPENAI_HEDGE_MAX_RATIO', cls.max_hedge_ratio))
+        )
+
+
+class LatencyTracker:
+    """Sliding window of successful call latencies per key
+    """
+
+    def __init__(self, window: int = 500):
+        self._samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._samples[key].append(seconds)
+
+    def percentile(self, key: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """Latency percentile of a key, None until min_samples calls were recorded"""
+        with self._lock:
+            samples = list(self._samples.get(key, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        return float(np.percentile(samples, q))
+
+
+class HedgeBudget:
+    """Caps hedges at a fraction of primary calls, plus one so the first slow call can hedge
+    """
+
+    def __init__(self, max_ratio: float):
+        self.max_ratio = max_ratio
+        self.calls = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def record_call(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.hedges >= self.max_ratio * self.calls + 1:
+                return False
+            self.hedges += 1
+            return True
+
+
+latency_tracker = LatencyTracker()
+
+
+async def hedged_call(
+    request: Callable[[], Awaitable],
+    key: str,
+    policy: HedgePolicy,
+    budget: HedgeBudget,
+    tracker: LatencyTracker = latency_tracker
+):
+    """Awaits request(), hedging it with a second request() when it runs long
+
+    Args:
+        request (Callable[[], Awaitable]): Starts one request each time it is called
+        key (str): Latency key, ex: model and prompt name
+        policy (HedgePolicy): Hedging settings
+        budget (HedgeBudget): Shared hedge budget
+        tracker (LatencyTracker, optional): Latency history. Defaults to the module tracker.
+
+    Returns:
+        The result of the first request to succeed
+    """
+    budget.record_call()
+    start = time.monotonic()
+    threshold = tracker.percentile(key, policy.percentile, policy.min_samples) \
+        if policy.enabled else None
+    primary = asyncio.ensure_future(request())
+    pending = {primary}
+    try:
+        if threshold is None:
+            result = await primary
+            tracker.record(key, time.monotonic() - start)
+            return result
+
+        done, _ = await asyncio.wait({primary}, timeout=max(threshold, policy.min_delay))
+        if done or not budget.try_acquire():
+            result = await primary
+            tracker.record(key, time.monotonic() - start)
+            return result
+
+        logger.info(f'{key}: hedging after {time.monotonic() - start:.1f}s')
+        pending.add(asyncio.ensure_future(request()))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    tracker.record(key, time.monotonic() - start)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # also runs when the caller is cancelled, so no request outlives the call
+        for task in pending:
+            if not task.done():
+                task.cancel()
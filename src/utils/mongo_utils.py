@@ -1,19 +1,25 @@
-from typing import List, Dict
+from dataclasses import dataclass
+from typing import Iterable, List, Dict, Set
 import certifi
 import os
 import secrets
+import threading
+import time
 
 from bson import ObjectId
 from dotenv import load_dotenv
 from src.utils.loggers import reg_logger
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+from src.utils.tracing import span
+from pymongo import InsertOne, MongoClient, UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError, DuplicateKeyError, NetworkTimeout
 
 
 load_dotenv()
 
 logger = reg_logger('mongo_utils')
 
+TRANSIENT_ERRORS = (AutoReconnect, NetworkTimeout)
+
 
 def connect_mongo(conn_str: str = None) -> MongoClient:
     """
@@ -65,7 +71,8 @@ def insert_data_into_collection(
     db = client[db_name]
     collection = db[collection_name]
     try:
-        result = collection.insert_one(kwargs)
+        with span('mongo.insert_one', db=db_name, collection=collection_name):
+            result = collection.insert_one(kwargs)
         logger.info(
             f'Inserted transcript with ec_id {result.inserted_id} into collection {collection_name}')
         return result.inserted_id
@@ -97,6 +104,73 @@ def id_exists(
     return document is not None
 
 
+def get_existing_ids(
+    client: MongoClient,
+    db_name: str,
+    collection_name: str,
+    d_ids: Iterable
+) -> Set:
+    """
+    Resolves which of the given IDs already exist with a single $in query.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        db_name (str): The name of the database where the collection resides.
+        collection_name (str): The name of the collection to check.
+        d_ids (Iterable): The document IDs to check.
+
+    Returns:
+        Set: The subset of d_ids that exist in the collection.
+    """
+    d_ids = list(set(d_ids))
+    if not d_ids:
+        return set()
+    db = client[db_name]
+    collection = db[collection_name]
+    documents = collection.find({"_id": {"$in": d_ids}}, {"_id": 1})
+    return {document["_id"] for document in documents}
+
+
+def insert_many_into_collection(
+    client: MongoClient,
+    db_name: str,
+    collection_name: str,
+    documents: List[Dict]
+) -> List:
+    """
+    Inserts documents with one unordered insert_many, skipping duplicate keys.
+
+    Args:
+        client (MongoClient): The MongoDB client object.
+        db_name (str): The name of the database where the collection resides.
+        collection_name (str): The name of the collection to insert data into.
+        documents (List[Dict]): The documents to insert.
+
+    Returns:
+        List: The IDs of the inserted documents.
+    """
+    if not documents:
+        return []
+    db = client[db_name]
+    collection = db[collection_name]
+    try:
+        with span('mongo.insert_many', db=db_name, collection=collection_name,
+                  documents=len(documents)):
+            result = collection.insert_many(documents, ordered=False)
+        inserted_ids = result.inserted_ids
+    except BulkWriteError as exc:
+        write_errors = exc.details.get('writeErrors', [])
+        if any(error['code'] != 11000 for error in write_errors):
+            raise
+        failed = {error['index'] for error in write_errors}
+        inserted_ids = [document['_id'] for i, document in enumerate(documents)
+                        if i not in failed and '_id' in document]
+        logger.warning(f'{len(failed)} keys already exist, moving on')
+    logger.info(
+        f'Inserted {len(inserted_ids)} documents into collection {collection_name}')
+    return inserted_ids
+
+
 def get_data_from_collection(
     client: MongoClient,
     db_name: str,
@@ -121,5 +195,140 @@ def get_data_from_collection(
     """
     db = client[db_name]
     collection = db[collection_name]
-    documents = collection.find(query, projection, limit=limit)
-    return list(documents)
+    with span('mongo.find', db=db_name, collection=collection_name) as current:
+        documents = list(collection.find(query, projection, limit=limit))
+        current.set_attributes(documents=len(documents))
+    return documents
+
+
+@dataclass
+class BulkWriteStats:
+    """Aggregate results of a BulkWriter
+    """
+    inserted: int = 0
+    upserted: int = 0
+    modified: int = 0
+    duplicates: int = 0
+    failed: int = 0
+    batches: int = 0
+
+    @property
+    def written(self) -> int:
+        return self.inserted + self.upserted + self.modified
+
+
+class BulkWriter:
+    """Buffers inserts and upserts into unordered bulk writes
+
+    Operations are flushed once batch_size of them are buffered, when an
+    operation arrives more than flush_interval seconds after the last flush,
+    and on close. Duplicate keys are counted instead of raised and
+    transient network errors are retried, which is safe because inserts carry
+    their _id after the first attempt and upserts are idempotent.
+
+    Usage:
+        with BulkWriter(client, 'tickers', 'all_tickers') as writer:
+            for company in companies:
+                writer.upsert({'_id': company['symbol']}, {'$set': company})
+    """
+
+    def __init__(
+        self,
+        client: MongoClient,
+        db_name: str,
+        collection_name: str,
+        batch_size: int = 1000,
+        flush_interval: float = 5.0,
+        max_retries: int = 3,
+        retry_delay: float = 0.5
+    ):
+        self.collection = client[db_name][collection_name]
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.stats = BulkWriteStats()
+        self._operations = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _add(self, operation) -> None:
+        with self._lock:
+            self._operations.append(operation)
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+            if len(self._operations) >= self.batch_size or due:
+                self._flush()
+
+    def insert(self, document: Dict) -> None:
+        """Buffers an insert, an _id is assigned to document when it has none"""
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        self._add(InsertOne(document))
+
+    def upsert(self, filter: Dict, update: Dict, upsert: bool = True) -> None:
+        """Buffers an update_one, an upsert by default"""
+        self._add(UpdateOne(filter, update, upsert=upsert))
+
+    def _write(self, operations: List) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span('mongo.bulk_write', collection=self.collection.name,
+                          operations=len(operations), attempt=attempt):
+                    result = self.collection.bulk_write(operations, ordered=False)
+                self.stats.inserted += result.inserted_count
+                self.stats.upserted += result.upserted_count
+                self.stats.modified += result.modified_count
+                return
+            except BulkWriteError as exc:
+                details = exc.details
+                self.stats.inserted += details.get('nInserted', 0)
+                self.stats.upserted += details.get('nUpserted', 0)
+                self.stats.modified += details.get('nModified', 0)
+                for error in details.get('writeErrors', []):
+                    if error['code'] == 11000:
+                        self.stats.duplicates += 1
+                    else:
+                        self.stats.failed += 1
+                        logger.error(
+                            f"{self.collection.name} write failed: {error.get('errmsg')}")
+                return
+            except TRANSIENT_ERRORS as exc:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                logger.warning(
+                    f'{self.collection.name} bulk write failed ({exc}), retrying in {delay}s')
+                time.sleep(delay)
+
+    def _flush(self) -> None:
+        operations, self._operations = self._operations, []
+        self._last_flush = time.monotonic()
+        if operations:
+            self._write(operations)
+            self.stats.batches += 1
+
+    def flush(self) -> None:
+        """Writes all buffered operations"""
+        with self._lock:
+            self._flush()
+
+    def close(self) -> BulkWriteStats:
+        """Flushes and logs the aggregate results
+
+        Returns:
+            BulkWriteStats: Counts over the lifetime of the writer
+        """
+        self.flush()
+        stats = self.stats
+        message = (f'{self.collection.name}: inserted {stats.inserted}, upserted {stats.upserted}, '
+                   f'modified {stats.modified} in {stats.batches} batches')
+        if stats.duplicates:
+            message += f', {stats.duplicates} keys already existed'
+        logger.info(message)
+        return stats
+
+    def __enter__(self) -> 'BulkWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        self.close()
@@ -0,0 +1,129 @@
+"""Requests and tokens per minute limits shared across processes
+
+Two token buckets, one for requests and one for tokens, live in shared
+memory so every worker process of a batch draws from the same quota. The
+limiter is created in the parent process and handed to workers through the
+pool initializer, which then makes it the process default with
+set_rate_limiter.
+
+Token counts are estimated before a call and corrected with the usage of
+the response, so the bucket tracks what OpenAI actually counted.
+"""
+from typing import Optional
+
+import asyncio
+import multiprocessing
+import os
+import time
+
+from src.utils.loggers import reg_logger
+
+
+logger = reg_logger('rate_limiter')
+
+
+class SharedRateLimiter:
+    """RPM/TPM token buckets in multiprocessing shared memory
+    """
+
+    def __init__(self, rpm: float, tpm: float, burst_seconds: float = 10.0, context=None):
+        """
+        Args:
+            rpm (float): Requests per minute
+            tpm (float): Tokens per minute
+            burst_seconds (float, optional): Bucket size in seconds of quota. Defaults to 10.0.
+            context (optional): multiprocessing context. Defaults to the default context.
+        """
+        context = context or multiprocessing.get_context()
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_capacity = max(rpm * burst_seconds / 60, 1.0)
+        self.token_capacity = max(tpm * burst_seconds / 60, 1.0)
+        self._lock = context.Lock()
+        self._requests = context.RawValue('d', self.request_capacity)
+        self._tokens = context.RawValue('d', self.token_capacity)
+        self._updated = context.RawValue('d', time.monotonic())
+        self._waited = context.RawValue('d', 0.0)
+
+    @classmethod
+    def from_env(cls, **kwargs) -> Optional['SharedRateLimiter']:
+        """Limiter from OPENAI_RPM and OPENAI_TPM, None when neither is set"""
+        rpm, tpm = os.getenv('OPENAI_RPM'), os.getenv('OPENAI_TPM')
+        if rpm is None and tpm is None:
+            return None
+        return cls(float(rpm or 'inf'), float(tpm or 'inf'), **kwargs)
+
+    @property
+    def waited(self) -> float:
+        """Seconds all processes spent waiting on the limiter"""
+        return self._waited.value
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(now - self._updated.value, 0.0)
+        self._requests.value = min(self.request_capacity, self._requests.value + elapsed * self.rpm / 60)
+        self._tokens.value = min(self.token_capacity, self._tokens.value + elapsed * self.tpm / 60)
+        self._updated.value = now
+
+    def try_acquire(self, tokens: int) -> float:
+        """Takes one request and tokens from the buckets if both have enough
+
+        Returns:
+            float: 0 when acquired, otherwise seconds until there should be enough
+        """
+        tokens = min(tokens, self.token_capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            missing_requests = 1 - self._requests.value
+            missing_tokens = tokens - self._tokens.value
+            if missing_requests <= 0 and missing_tokens <= 0:
+                self._requests.value -= 1
+                self._tokens.value -= tokens
+                return 0.0
+        delay = 0.01
+        if missing_requests > 0:
+            delay = max(delay, missing_requests * 60 / self.rpm)
+        if missing_tokens > 0:
+            delay = max(delay, missing_tokens * 60 / self.tpm)
+        return delay
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """Waits until a request with an estimated number of tokens fits the limits"""
+        start = time.monotonic()
+        while True:
+            delay = self.try_acquire(tokens)
+            if delay == 0:
+                break
+            await asyncio.sleep(delay)
+        waited = time.monotonic() - start
+        if waited > 0:
+            with self._lock:
+                self._waited.value += waited
+
+    def reconcile(self, estimated: int, actual: int) -> None:
+        """Corrects the token bucket once the actual usage of a call is known"""
+        if actual is None or actual == estimated:
+            return
+        with self._lock:
+            self._tokens.value = min(self.token_capacity, self._tokens.value + estimated - actual)
+
+
+_rate_limiter: Optional[SharedRateLimiter] = None
+
+
+def set_rate_limiter(limiter: Optional[SharedRateLimiter]) -> None:
+    """Sets the limiter sessions of this process use by default"""
+    global _rate_limiter
+    _rate_limiter = limiter
+
+
+def get_rate_limiter() -> Optional[SharedRateLimiter]:
+    """Process default limiter, created from OPENAI_RPM and OPENAI_TPM on first use"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = SharedRateLimiter.from_env()
+    return _rate_limiter
+
+
+def estimate_tokens(text: str, completion_tokens: int = 0) -> int:
+    """Rough token count of a request, about four characters per token"""
+    return len(text) // 4 + completion_tokens
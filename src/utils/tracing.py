@@ -0,0 +1,292 @@
+"""Lightweight tracing spans exported as JSONL
+
+A span times one stage of work and records attributes such as the
+transcript, excerpt or line item it worked on. The current span is kept in
+a context variable, so spans opened inside asyncio tasks nest under the
+span that was current when the task was created.
+
+Spans are exported when TRACE_FILE is set or after configure() is called,
+one JSON object per finished span. The report command summarizes an
+exported file:
+
+    python -m src.utils.tracing report logs/traces.jsonl
+    python -m src.utils.tracing report logs/traces.jsonl --root process_transcript --top 5
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional
+
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import secrets
+import threading
+import time
+
+import numpy as np
+
+
+_current_span: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+
+
+@dataclass
+class Span:
+    """One timed stage of work
+    """
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start: float = 0.0
+    end: Optional[float] = None
+    status: str = 'ok'
+    error: Optional[str] = None
+    attributes: Dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def set_attributes(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+
+class JsonlExporter:
+    """Appends finished spans to a JSONL file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def export(self, span: Span) -> None:
+        line = json.dumps({**asdict(span), 'duration': span.duration}, default=str)
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + '\n')
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+_exporter: Optional[JsonlExporter] = None
+
+
+def configure(path: str = None) -> Optional[JsonlExporter]:
+    """Sets the JSONL file spans are exported to
+
+    Args:
+        path (str, optional): Trace file, tracing is disabled when None. Defaults to None.
+
+    Returns:
+        Optional[JsonlExporter]: The active exporter
+    """
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+    _exporter = JsonlExporter(path) if path else None
+    return _exporter
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def set_attributes(**attributes) -> None:
+    """Adds attributes to the current span, if there is one"""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attributes(**attributes)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    """Times the enclosed block as a child of the current span
+
+    Args:
+        name (str): Stage name, ex: openai.chat
+        **attributes: Span attributes, ex: transcriptId
+
+    Yields:
+        Span: The open span
+    """
+    parent = _current_span.get()
+    current = Span(
+        name=name,
+        trace_id=parent.trace_id if parent else secrets.token_hex(8),
+        span_id=secrets.token_hex(8),
+        parent_id=parent.span_id if parent else None,
+        start=time.time(),
+        attributes=attributes
+    )
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as exc:
+        current.status = 'cancelled' if isinstance(exc, asyncio.CancelledError) else 'error'
+        current.error = f'{type(exc).__name__}: {exc}'
+        raise
+    finally:
+        current.end = time.time()
+        _current_span.reset(token)
+        if _exporter is not None:
+            _exporter.export(current)
+
+
+def traced(name: str = None):
+    """Decorator running a sync or async function inside a span
+
+    Args:
+        name (str, optional): Span name. Defaults to the function's qualified name.
+    """
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__qualname__
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def load_spans(path: str) -> List[Dict]:
+    """Reads an exported trace file, skipping truncated lines"""
+    spans = []
+    with open(path) as file:
+        for line in file:
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return spans
+
+
+def critical_path(root: Dict, children: Dict[str, List[Dict]]) -> List[Dict]:
+    """Walks back from the end of root through the children that finished last
+
+    Each step picks the latest-ending child that ended before the cursor,
+    recurses into it and moves the cursor to its start. Time on the path not
+    covered by a child is the parent's own time.
+
+    Args:
+        root (Dict): Root span
+        children (Dict[str, List[Dict]]): Child spans by parent span_id
+
+    Returns:
+        List[Dict]: Segments with name and seconds, in no particular order
+    """
+    segments = []
+    cursor = root['end']
+    candidates = sorted(children.get(root['span_id'], []), key=lambda item: item['end'], reverse=True)
+    for child in candidates:
+        if child['end'] > cursor or child['end'] <= root['start']:
+            continue
+        segments.append({'name': root['name'], 'seconds': cursor - child['end']})
+        segments += critical_path(child, children)
+        cursor = max(child['start'], root['start'])
+    segments.append({'name': root['name'], 'seconds': max(cursor - root['start'], 0.0)})
+    return segments
+
+
+def stage_latencies(spans: List[Dict]) -> List[Dict]:
+    """Count, percentiles and error count per span name"""
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    for item in spans:
+        durations[item['name']].append(item['duration'])
+        errors[item['name']] += item['status'] == 'error'
+    rows = []
+    for name, values in durations.items():
+        values = np.array(values)
+        rows.append({
+            'name': name,
+            'count': len(values),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99)),
+            'total': float(values.sum()),
+            'errors': errors[name],
+        })
+    return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+
+def report(path: str, root_name: str = None, top: int = 3) -> None:
+    """Prints per-stage latency percentiles and critical path breakdowns
+
+    Args:
+        path (str): Exported trace file
+        root_name (str, optional): Only analyze traces whose root span has this name. Defaults to None.
+        top (int, optional): Number of slowest traces to break down. Defaults to 3.
+    """
+    spans = [item for item in load_spans(path) if item.get('end') is not None]
+    children = defaultdict(list)
+    roots = []
+    for item in spans:
+        if item['parent_id'] is None:
+            roots.append(item)
+        else:
+            children[item['parent_id']].append(item)
+    if root_name is not None:
+        roots = [root for root in roots if root['name'] == root_name]
+        trace_ids = {root['trace_id'] for root in roots}
+        spans = [item for item in spans if item['trace_id'] in trace_ids]
+
+    print(f'{len(spans)} spans in {len(roots)} traces\n')
+    print(f"{'stage':<32}{'count':>8}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}{'total s':>11}{'errors':>8}")
+    for row in stage_latencies(spans):
+        print(f"{row['name']:<32}{row['count']:>8}{row['p50']:>10.3f}{row['p95']:>10.3f}"
+              f"{row['p99']:>10.3f}{row['total']:>11.2f}{row['errors']:>8}")
+
+    if not roots:
+        return
+    totals = defaultdict(float)
+    for root in roots:
+        for segment in critical_path(root, children):
+            totals[segment['name']] += segment['seconds']
+    elapsed = sum(root['duration'] for root in roots)
+    print('\nCritical path share over all traces')
+    for name, seconds in sorted(totals.items(), key=lambda item: item[1], reverse=True):
+        print(f'{name:<32}{seconds:>11.2f}s{seconds / elapsed:>9.1%}')
+
+    for root in sorted(roots, key=lambda item: item['duration'], reverse=True)[:top]:
+        segments = defaultdict(float)
+        for segment in critical_path(root, children):
+            segments[segment['name']] += segment['seconds']
+        attributes = ', '.join(f'{key}={value}' for key, value in root['attributes'].items())
+        print(f"\n{root['name']} {root['trace_id']} {root['duration']:.2f}s {attributes}")
+        for name, seconds in sorted(segments.items(), key=lambda item: item[1], reverse=True):
+            print(f'  {name:<30}{seconds:>11.2f}s{seconds / root["duration"]:>9.1%}')
+
+
+if os.getenv('TRACE_FILE'):
+    configure(os.getenv('TRACE_FILE'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize exported trace spans')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report_parser = subparsers.add_parser('report', help='Stage percentiles and critical paths')
+    report_parser.add_argument('path', help='JSONL trace file')
+    report_parser.add_argument('--root', help='Only traces with this root span name')
+    report_parser.add_argument('--top', type=int, default=3, help='Slowest traces to break down')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        report(args.path, args.root, args.top)
@@ -0,0 +1,161 @@
+"""Content-addressed, zstd-compressed on-disk cache of raw transcript responses
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, Optional
+
+import hashlib
+import json
+import os
+import tempfile
+
+import zstandard
+
+from src.utils.loggers import BASE_DIR, reg_logger
+
+
+logger = reg_logger('transcript_cache')
+
+CACHE_DIR = os.getenv('TRANSCRIPT_CACHE_DIR',
+                      os.path.join(BASE_DIR, 'cache', 'transcripts'))
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class TranscriptCache:
+    """Raw response cache keyed by source, ticker, quarter and year.
+
+    Response bodies are stored once per content hash under objects/, and
+    refs/<source>/<ticker>/<year>_<quarter>.json points a key at its
+    body together with the url, status code and fetch time.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, offline: bool = None, level: int = 10):
+        self.cache_dir = cache_dir
+        if offline is None:
+            offline = os.getenv('TRANSCRIPT_CACHE_OFFLINE', '0') == '1'
+        self.offline = offline
+        self.level = level
+
+    def _ref_path(self, source: str, ticker: str, quarter: str, year: int) -> str:
+        return os.path.join(self.cache_dir, 'refs', source, ticker.upper(), f'{year}_{quarter}.json')
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, 'objects', digest[:2], f'{digest}.zst')
+
+    def get_metadata(self, source: str, ticker: str, quarter: str, year: int) -> Optional[Dict]:
+        """Gets the metadata stored for a key
+
+        Returns:
+            Optional[Dict]: Metadata or None when the key is not cached
+        """
+        try:
+            with open(self._ref_path(source, ticker, quarter, year)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def get(
+        self,
+        source: str,
+        ticker: str,
+        quarter: str,
+        year: int,
+        max_age: timedelta = None
+    ) -> Optional[bytes]:
+        """Gets a cached response body
+
+        Args:
+            source (str): Response source, ex: dcf or fool
+            ticker (str): Company ticker
+            quarter (str): Fiscal quarter
+            year (int): Fiscal year
+            max_age (timedelta, optional): Treat older entries as stale. Ignored offline. Defaults to None.
+
+        Returns:
+            Optional[bytes]: Decompressed response body or None on a miss
+        """
+        metadata = self.get_metadata(source, ticker, quarter, year)
+        if metadata is None:
+            return None
+        if max_age is not None and not self.offline:
+            fetched_at = datetime.fromisoformat(metadata['fetchedAt'])
+            if datetime.now() - fetched_at > max_age:
+                return None
+        try:
+            with open(self._object_path(metadata['sha256']), 'rb') as file:
+                return zstandard.ZstdDecompressor().decompress(file.read())
+        except FileNotFoundError:
+            logger.warning(
+                f'cache object missing for {source} {ticker} {quarter} {year}')
+            return None
+
+    def put(
+        self,
+        source: str,
+        ticker: str,
+        quarter: str,
+        year: int,
+        content: bytes,
+        url: str = None,
+        status_code: int = 200
+    ) -> str:
+        """Stores a response body and points the key at it
+
+        Args:
+            source (str): Response source, ex: dcf or fool
+            ticker (str): Company ticker
+            quarter (str): Fiscal quarter
+            year (int): Fiscal year
+            content (bytes): Raw response body
+            url (str, optional): Url the body was fetched from. Defaults to None.
+            status_code (int, optional): HTTP status code. Defaults to 200.
+
+        Returns:
+            str: Content hash of the stored body
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            compressed = zstandard.ZstdCompressor(
+                level=self.level).compress(content)
+            _atomic_write(object_path, compressed)
+        metadata = {
+            'source': source,
+            'ticker': ticker.upper(),
+            'quarter': quarter,
+            'year': year,
+            'url': url,
+            'statusCode': status_code,
+            'sha256': digest,
+            'size': len(content),
+            'fetchedAt': datetime.now().isoformat()
+        }
+        _atomic_write(self._ref_path(source, ticker, quarter, year),
+                      json.dumps(metadata).encode())
+        return digest
+
+    def entries(self, source: str) -> Iterator[Dict]:
+        """Iterates the metadata of every cached key for a source
+
+        Args:
+            source (str): Response source, ex: dcf or fool
+
+        Yields:
+            Dict: Key metadata
+        """
+        source_dir = os.path.join(self.cache_dir, 'refs', source)
+        for root, _, files in os.walk(source_dir):
+            for name in sorted(files):
+                if name.endswith('.json'):
+                    with open(os.path.join(root, name)) as file:
+                        yield json.load(file)
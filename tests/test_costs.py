@@ -0,0 +1,22 @@
+import pytest
+
+from src.utils.costs import BudgetExceededError, CostBudget, token_cost
+
+
+def test_charge_accumulates_until_the_limit():
+    budget = CostBudget(1.0)
+    budget.charge(0.4)
+    budget.charge(0.4)
+    assert budget.calls == 2
+    with pytest.raises(BudgetExceededError):
+        budget.charge(0.4)
+
+
+def test_unpriced_calls_fail_closed():
+    budget = CostBudget(1.0)
+    assert token_cost('not-a-model', 100) is None
+    with pytest.raises(BudgetExceededError):
+        budget.check('not-a-model')
+    with pytest.raises(BudgetExceededError):
+        budget.charge(token_cost('not-a-model', 100), 'not-a-model')
+    budget.check('gpt-4')
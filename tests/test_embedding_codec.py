@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from src.utils.embedding_codec import EmbeddingProfile, encode_embedding, stack_embeddings
+
+
+def test_stack_embeddings_round_trip():
+    rows = np.arange(6, dtype=np.float32).reshape(2, 3)
+    stacked = stack_embeddings([encode_embedding(row, 'float32') for row in rows])
+    np.testing.assert_array_equal(stacked, rows)
+
+
+def test_empty_stack_keeps_requested_width():
+    assert stack_embeddings([]).shape == (0, 0)
+    assert stack_embeddings([], dim=8).shape == (0, 8)
+    assert EmbeddingProfile(dimensions=8).prepare([]).shape == (0, 8)
+
+
+@pytest.mark.parametrize('pack', [lambda row: encode_embedding(row, 'float32'), list])
+def test_prepare_truncates_rows_of_mixed_width(pack):
+    wide = np.arange(1, 9, dtype=np.float32)
+    narrow = np.arange(1, 5, dtype=np.float32)
+    prepared = EmbeddingProfile(dimensions=4).prepare([pack(wide), pack(narrow)])
+    assert prepared.shape == (2, 4)
+    np.testing.assert_allclose(prepared[0], wide[:4] / np.linalg.norm(wide[:4]), rtol=1e-6)
+    np.testing.assert_array_equal(prepared[1], narrow)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from src.similarity_engine import cosine_similarity_matrix, mutual_best_matches, one_to_one_matches
+
+
+@pytest.mark.parametrize('n_queries, n_targets', [(0, 3), (3, 0), (0, 0)])
+@pytest.mark.parametrize('match', [mutual_best_matches, one_to_one_matches])
+def test_empty_side_has_no_matches(match, n_queries, n_targets):
+    rng = np.random.default_rng(0)
+    queries = rng.normal(size=(n_queries, 4)).astype(np.float32)
+    targets = rng.normal(size=(n_targets, 4)).astype(np.float32)
+    query_idx, target_idx, scores = match(queries, targets)
+    assert len(query_idx) == len(target_idx) == len(scores) == 0
+
+
+def test_mutual_best_matches_pairs_nearest_neighbours():
+    queries = np.eye(3, dtype=np.float32)
+    targets = np.eye(3, dtype=np.float32)[[2, 0, 1]]
+    query_idx, target_idx, _ = mutual_best_matches(queries, targets, threshold=0.9)
+    assert dict(zip(query_idx, target_idx)) == {0: 1, 1: 2, 2: 0}
+
+
+def test_cosine_similarity_matrix_matches_dense_product():
+    rng = np.random.default_rng(1)
+    queries = rng.normal(size=(7, 5))
+    targets = rng.normal(size=(4, 5))
+    expected = (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ \
+        (targets / np.linalg.norm(targets, axis=1, keepdims=True)).T
+    scores = cosine_similarity_matrix(queries, targets, memory_cap_mb=1e-4)
+    assert scores.dtype == np.float32
+    np.testing.assert_allclose(scores, expected, rtol=1e-5, atol=1e-6)
+    assert cosine_similarity_matrix(queries[:0], targets).shape == (0, 4)
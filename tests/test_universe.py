@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+from src import universe
+
+
+class FakeCollection:
+    name = 'oef'
+
+    def __init__(self, docs):
+        self.docs = {doc['_id']: dict(doc) for doc in docs}
+
+    @property
+    def symbols(self):
+        return set(self.docs)
+
+    def find(self, query, projection=None):
+        if query.get('_id') == {'$type': 'objectId'}:
+            return [dict(doc) for key, doc in self.docs.items() if isinstance(key, ObjectId)]
+        return [dict(doc) for doc in self.docs.values()]
+
+    def delete_many(self, query):
+        for key in query['_id']['$in']:
+            self.docs.pop(key, None)
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            key = operation._filter['_id']
+            if key not in self.docs:
+                self.docs[key] = {'_id': key, **operation._doc.get('$setOnInsert', {})}
+            self.docs[key].update(operation._doc.get('$set', {}))
+        return SimpleNamespace(inserted_count=0, upserted_count=0, modified_count=len(operations))
+
+
+class FakeClient(dict):
+    def __init__(self, collection):
+        super().__init__({universe.DB_NAME: {'oef': collection}})
+
+
+def members(*symbols):
+    return [{'_id': symbol} for symbol in symbols]
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    universe.invalidate()
+
+
+@pytest.mark.parametrize('source', [{}, {'AAPL': {}}])
+def test_sync_refuses_empty_or_truncated_source(source):
+    collection = FakeCollection(members('AAPL', 'MSFT', 'IBM', 'GE'))
+    with pytest.raises(universe.UnsafeSyncError):
+        universe.sync_universe(FakeClient(collection), 'oef', source)
+    assert collection.symbols == {'AAPL', 'MSFT', 'IBM', 'GE'}
+
+
+def test_forced_sync_applies_removals():
+    collection = FakeCollection(members('AAPL', 'MSFT', 'IBM', 'GE'))
+    result = universe.sync_universe(FakeClient(collection), 'oef', {}, force=True)
+    assert result.removed == ['AAPL', 'GE', 'IBM', 'MSFT']
+    assert collection.symbols == set()
+
+
+def test_legacy_members_are_read_and_rekeyed_by_symbol():
+    legacy = [{'_id': ObjectId(), 'd_id': symbol, 'name': symbol.lower()} for symbol in ('AAPL', 'MSFT')]
+    collection = FakeCollection(legacy)
+    client = FakeClient(collection)
+    assert universe.get_members(client, 'oef') == {'AAPL', 'MSFT'}
+
+    result = universe.sync_universe(client, 'oef', {'AAPL': {}, 'MSFT': {}, 'IBM': {}})
+    assert result.added == ['IBM'] and result.removed == []
+    assert collection.symbols == {'AAPL', 'MSFT', 'IBM'}
+    assert collection.docs['AAPL'] == {'_id': 'AAPL', 'name': 'aapl'}
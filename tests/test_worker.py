@@ -0,0 +1,46 @@
+import asyncio
+
+from bson import ObjectId
+
+import worker
+from src import job_queue
+
+
+def test_claims_never_exceed_concurrency(monkeypatch):
+    queued = [{'_id': ObjectId(), 'type': 'run_transcript', 'payload': {}, 'attempts': 1, 'maxAttempts': 3}
+              for _ in range(20)]
+    leased = []
+    peak = 0
+
+    def claim(client, worker_id, job_types, lease_seconds):
+        nonlocal peak
+        if not queued:
+            return None
+        leased.append(queued.pop())
+        peak = max(peak, len(leased))
+        return leased[-1]
+
+    def complete(client, job_id, worker_id, result):
+        leased[:] = [job for job in leased if job['_id'] != job_id]
+        return True
+
+    async def handler(payload):
+        await asyncio.sleep(0.01)
+        return {}
+
+    monkeypatch.setattr(job_queue, 'claim', claim)
+    monkeypatch.setattr(job_queue, 'complete', complete)
+    monkeypatch.setattr(job_queue, 'create_indexes', lambda client: None)
+    monkeypatch.setattr(job_queue, 'requeue_expired', lambda client: 0)
+    monkeypatch.setitem(worker.JOB_HANDLERS, 'run_transcript', handler)
+
+    async def run():
+        queue_worker = worker.Worker(None, concurrency=2, poll_interval=0.01)
+        runner = asyncio.ensure_future(queue_worker.run())
+        while queued or leased:
+            await asyncio.sleep(0.01)
+        queue_worker.stop()
+        await runner
+
+    asyncio.run(asyncio.wait_for(run(), timeout=10))
+    assert peak == 2
@@ -0,0 +1,159 @@
+"""Queue worker: leases jobs from src.job_queue and runs them
+
+Run as many workers as needed, on any machine that can reach Mongo:
+
+    python worker.py --concurrency 4
+
+Each running job's lease is renewed by a heartbeat. When the heartbeat
+finds the lease was lost, the job is cancelled because another worker may
+already have it. On SIGTERM the worker stops claiming and releases the jobs
+it is still running, without counting the attempt, so they can be picked
+up elsewhere.
+"""
+from dotenv import find_dotenv, load_dotenv
+from typing import Awaitable, Callable, Dict
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import time
+import uuid
+
+from src import job_queue
+from src.utils.costs import BudgetExceededError
+from src.utils.loggers import reg_logger
+from src.utils.mongo_utils import connect_mongo
+
+
+load_dotenv(dotenv_path=find_dotenv(), override=True)
+
+logger = reg_logger('worker')
+
+POLL_INTERVAL = 5.0
+SWEEP_INTERVAL = 60.0
+
+
+async def run_transcript_job(payload: Dict) -> Dict:
+    from run_transcript import run_transcript_processor
+
+    staging_id = await run_transcript_processor(
+        payload['ticker'], payload['fiscalYear'], payload['fiscalQuarter'])
+    return {'stagingId': str(staging_id) if staging_id is not None else None}
+
+
+JOB_HANDLERS: Dict[str, Callable[[Dict], Awaitable[Dict]]] = {
+    'run_transcript': run_transcript_job,
+}
+
+
+class Worker:
+    """Claims and runs jobs until stopped
+    """
+
+    def __init__(self, client, concurrency: int = 1, lease_seconds: float = job_queue.LEASE_SECONDS,
+                 poll_interval: float = POLL_INTERVAL):
+        self.client = client
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self.running: Dict[object, asyncio.Task] = {}
+        # a slot is taken before claiming and freed when the job's task ends
+        self._slots = asyncio.Semaphore(concurrency)
+        self.stopping = False
+        self._last_sweep = 0.0
+
+    def stop(self) -> None:
+        if not self.stopping:
+            logger.info(f'{self.worker_id} stopping, releasing {len(self.running)} running jobs')
+        self.stopping = True
+        for task in self.running.values():
+            task.cancel()
+
+    async def _heartbeat(self, job_id, task: asyncio.Task) -> None:
+        while not task.done():
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not job_queue.heartbeat(self.client, job_id, self.worker_id, self.lease_seconds):
+                logger.warning(f'{self.worker_id} lost the lease on job {job_id}, cancelling it')
+                task.cancel()
+                return
+
+    async def _run(self, job: Dict) -> None:
+        handler = JOB_HANDLERS[job['type']]
+        task = asyncio.ensure_future(handler(job['payload']))
+        self.running[job['_id']] = task
+        heartbeat = asyncio.ensure_future(self._heartbeat(job['_id'], task))
+        start = time.monotonic()
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            if self.stopping:
+                job_queue.release(self.client, job['_id'], self.worker_id)
+        except BudgetExceededError as exc:
+            # the job is fine, the run is out of money
+            job_queue.release(self.client, job['_id'], self.worker_id)
+            logger.error(f'{exc}, stopping worker')
+            self.stop()
+        except Exception as exc:
+            status = job_queue.fail(self.client, job, self.worker_id, f'{type(exc).__name__}: {exc}')
+            logger.error(f"Job {job['_id']} attempt {job['attempts']} failed ({exc}), {status}")
+        else:
+            if job_queue.complete(self.client, job['_id'], self.worker_id, result):
+                logger.info(f"Job {job['_id']} done in {time.monotonic() - start:.1f}s: {result}")
+            else:
+                logger.warning(f"Job {job['_id']} finished after its lease was lost")
+        finally:
+            heartbeat.cancel()
+            self.running.pop(job['_id'], None)
+            self._slots.release()
+
+    def _sweep(self) -> None:
+        if time.monotonic() - self._last_sweep >= SWEEP_INTERVAL:
+            job_queue.requeue_expired(self.client)
+            self._last_sweep = time.monotonic()
+
+    async def run(self) -> None:
+        """Claims jobs while there is capacity, until stop() is called"""
+        logger.info(f'{self.worker_id} started with concurrency {self.concurrency}')
+        job_queue.create_indexes(self.client)
+        tasks = set()
+        while not self.stopping:
+            self._sweep()
+            await self._slots.acquire()
+            if self.stopping:
+                self._slots.release()
+                break
+            job = job_queue.claim(self.client, self.worker_id, list(JOB_HANDLERS), self.lease_seconds)
+            if job is None:
+                self._slots.release()
+                await asyncio.sleep(self.poll_interval)
+                continue
+            logger.info(f"{self.worker_id} claimed {job['type']} job {job['_id']} "
+                        f"(attempt {job['attempts']} of {job['maxAttempts']})")
+            task = asyncio.ensure_future(self._run(job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main(concurrency: int, lease_seconds: float) -> None:
+    mongo_client = connect_mongo()
+    worker = Worker(mongo_client, concurrency, lease_seconds)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.stop)
+    await worker.run()
+    mongo_client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run queued jobs')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('WORKER_CONCURRENCY', 1)),
+                        help='Jobs run at once by this worker')
+    parser.add_argument('--lease-seconds', type=float, default=job_queue.LEASE_SECONDS)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.concurrency, args.lease_seconds))